@@ -0,0 +1,547 @@
+"""基于asyncio的图片接收引擎
+
+与ImageReceiver使用相同的header/chunk/completion协议，区别在于：
+- 所有消息在一个事件循环中处理，无需全局锁
+- 接收状态按设备分片，路由为两次字典查找
+- 超时使用事件循环定时器，无需轮询线程
+- 图片校验和保存在线程池中异步执行
+
+运行方式：
+    python async_receiver.py                   # 连接MQTT服务器接收图片
+    python async_receiver.py --simulate 2000   # 进程内模拟2000台设备压测
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import paho.mqtt.client as mqtt
+
+from chunk_protocol import FORMAT_BINARY, FORMAT_JSON
+from device_simulator import DEFAULT_CHUNK_SIZE, build_image_messages, fake_jpeg
+from fleet import Fleet, FLEET_FILE
+from inprocess_broker import InProcessBroker
+from image_index import ImageIndex, INDEX_FILENAME
+from image_store import create_store
+from metrics import ReceiverMetrics, MetricsServer
+from receiver_log import get_logger, setup_logging, LOG_LEVEL, LOG_LEVELS
+from windows_receiver import (MQTT_BROKER, MQTT_PORT, MQTT_USERNAME, MQTT_PASSWORD,
+                              SAVE_DIR, TIMEOUT_SECONDS, WRITER_THREADS, NACK_WAIT_SECONDS,
+                              COMPLETED_HISTORY, SALVAGE_PARTIAL_IMAGES, STORE_BACKEND,
+                              build_ack, build_nack, control_topic, decode_message,
+                              image_summary, message_device, new_pending_image, touch_pending_image,
+                              write_partial_image, subscribed_topics, verify_chunk, write_image)
+
+class AsyncMQTTClient:
+    """异步MQTT客户端接口"""
+
+    async def connect(self):
+        raise NotImplementedError
+
+    async def subscribe(self, topic):
+        raise NotImplementedError
+
+    async def publish(self, topic, payload):
+        raise NotImplementedError
+
+    def messages(self):
+        """异步迭代收到的消息，产出(topic, payload)，断开连接后结束"""
+        raise NotImplementedError
+
+    async def disconnect(self):
+        raise NotImplementedError
+
+class PahoAsyncClient(AsyncMQTTClient):
+    """将paho客户端的回调转换为异步消息流"""
+
+    def __init__(self, broker=MQTT_BROKER, port=MQTT_PORT,
+                 username=MQTT_USERNAME, password=MQTT_PASSWORD):
+        self.broker = broker
+        self.port = port
+        self.client = mqtt.Client()
+        self.client.username_pw_set(username, password)
+        self.client.on_connect = self._on_connect
+        self.client.on_message = self._on_message
+        self.topics = []
+        self.loop = None
+        self.queue = None
+
+    async def connect(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        await self.loop.run_in_executor(None, self.client.connect, self.broker, self.port, 60)
+        self.client.loop_start()
+
+    async def subscribe(self, topic):
+        self.topics.append(topic)
+        self.client.subscribe(topic)
+
+    async def publish(self, topic, payload):
+        self.client.publish(topic, payload)
+
+    def _on_connect(self, client, userdata, flags, rc):
+        # 重连后重新订阅
+        if rc == 0:
+            for topic in self.topics:
+                client.subscribe(topic)
+
+    def _on_message(self, client, userdata, msg):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (msg.topic, msg.payload))
+
+    async def messages(self):
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+            yield item
+
+    async def disconnect(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+        self.queue.put_nowait(None)
+
+class AsyncImageReceiver:
+    """asyncio图片接收引擎"""
+
+    def __init__(self, client, save_dir=SAVE_DIR, timeout=TIMEOUT_SECONDS,
+                 writers=WRITER_THREADS, metrics_port=None, history_size=COMPLETED_HISTORY,
+                 store=None, fleet=None):
+        self.client = client
+        self.save_dir = save_dir
+        self.timeout = timeout
+        self.logger = get_logger("async")
+
+        # 按设备分片的接收状态: device_id -> {'images': {image_id: img_data}, 'index': {...}}
+        self.devices = {}
+        self.fleet = fleet if fleet is not None else Fleet.load(FLEET_FILE)
+        self.per_device_topics = set()  # 使用设备命名空间主题的设备
+        self.rejected_devices = set()
+        self.pending_count = 0
+        self.completed_images = OrderedDict()  # 最近保存的图片，最多history_size张
+        self.completed_count = 0
+        self.history_size = history_size
+        self.heartbeats = {}  # device_id -> 最近一次画面无变化的心跳
+        self.device_stats = {}  # device_id -> 最近一次上报的统计
+
+        # 校验和写文件在线程池中执行，不阻塞事件循环
+        self.executor = ThreadPoolExecutor(max_workers=writers)
+        self.write_tasks = set()
+        self.loop = None
+        self.ready = asyncio.Event()
+
+        # 各阶段指标，metrics_port不为None时通过HTTP输出
+        self.metrics = ReceiverMetrics(pending=lambda: self.pending_count,
+                                       writer_queue=lambda: len(self.write_tasks))
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+        self.store = store if store is not None else create_store(STORE_BACKEND, save_dir)
+        self.image_index = ImageIndex(os.path.join(save_dir, INDEX_FILENAME))
+        self.store.set_digest_lookup(self.image_index.find_md5)
+
+    def log(self, message, level=logging.INFO):
+        """输出日志"""
+        self.logger.log(level, message)
+
+    def debug(self, message):
+        """输出逐条消息、逐块的详细日志"""
+        self.log(message, logging.DEBUG)
+
+    async def run(self):
+        """接收消息直到客户端断开"""
+        self.loop = asyncio.get_running_loop()
+        if self.metrics_port is not None:
+            self.metrics_server = MetricsServer(self.metrics.render, self.metrics_port)
+            self.metrics_server.start()
+            self.log(f"📊 指标地址: http://{self.metrics_server.host}:{self.metrics_port}/metrics")
+        await self.client.connect()
+        topics = subscribed_topics(self.fleet.subscribed_devices())
+        for topic in topics:
+            await self.client.subscribe(topic)
+        self.log(f"已订阅主题: {', '.join(topics)}")
+        self.ready.set()
+
+        try:
+            async for topic, payload in self.client.messages():
+                self.on_message(topic, payload)
+        finally:
+            await self.drain()
+
+    async def drain(self):
+        """等待写入任务完成并取消超时定时器"""
+        if self.write_tasks:
+            await asyncio.gather(*self.write_tasks, return_exceptions=True)
+
+        for device in self.devices.values():
+            for img_data in device['images'].values():
+                img_data['timer'].cancel()
+        self.devices.clear()
+        self.pending_count = 0
+        self.executor.shutdown(wait=True)
+        self.store.close()
+        self.image_index.close()
+
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
+
+    def on_message(self, topic, payload):
+        """处理一条MQTT消息"""
+        try:
+            self.metrics.messages.inc(topic=topic.rsplit('/', 1)[-1])
+            self.metrics.bytes_received.inc(len(payload))
+            data = decode_message(topic, payload)
+            self.debug(f"📨 收到消息: {topic}")
+
+            device_id, per_device = message_device(topic, data)
+            if not self.fleet.allowed(device_id):
+                self.reject_device(device_id)
+                return
+            if per_device:
+                self.per_device_topics.add(device_id)
+
+            if topic.endswith("/header"):
+                self.handle_header(data)
+            elif topic.endswith("/chunk"):
+                self.handle_chunk(data)
+            elif topic.endswith("/completion"):
+                self.handle_completion(data)
+            elif topic.endswith("/heartbeat"):
+                self.handle_heartbeat(data)
+            elif topic.endswith("/stats"):
+                self.handle_stats(data)
+
+        except Exception as e:
+            self.log(f"❌ 处理消息时出错: {e}", logging.ERROR)
+
+    def reject_device(self, device_id):
+        """忽略设备清单中禁用或不在清单中的设备，每个设备只提示一次"""
+        self.metrics.messages_rejected.inc(reason="fleet")
+        if device_id not in self.rejected_devices:
+            self.rejected_devices.add(device_id)
+            self.log(f"⚠️ 设备 {device_id} 不在设备清单中或已禁用，忽略其消息", logging.WARNING)
+
+    def handle_header(self, data):
+        """处理图片信息头"""
+        try:
+            image_id, img_data = new_pending_image(data, self.store.dedup)
+        except ValueError as e:
+            self.log(f"❌ {e}", logging.ERROR)
+            return
+
+        device = self.devices.setdefault(data['device_id'], {'images': {}, 'index': {}})
+        if image_id in device['images']:
+            self.log(f"⚠️ 图片 {image_id} 已存在，跳过重复的头信息", logging.WARNING)
+            return
+
+        # 超时定时器，收到新块时只更新截止时间，定时器到期时再检查
+        img_data['deadline'] = img_data['start_time'] + self.timeout
+        img_data['timer'] = self.loop.call_later(self.timeout, self.expire_image,
+                                                 data['device_id'], image_id)
+        device['images'][image_id] = img_data
+        device['index'][data.get('image_id')] = image_id
+        device['index'][None] = image_id
+        self.pending_count += 1
+        self.metrics.images_started.inc()
+
+        self.debug(f"📸 开始接收图片: {image_id} ({data['total_chunks']} 块, {data['image_size']} 字节)")
+
+    def handle_heartbeat(self, data):
+        """处理画面无变化的心跳"""
+        self.heartbeats[data['device_id']] = data
+        self.metrics.heartbeats.inc()
+        self.debug(f"💓 设备 {data['device_id']} 画面无变化 (连续 {data.get('unchanged', 1)} 张)")
+
+    def handle_stats(self, data):
+        """处理设备定期上报的统计"""
+        self.device_stats[data['device_id']] = data
+        self.metrics.record_device_stats(data)
+
+    def find_pending_image(self, data):
+        """查找消息对应的正在接收的图片，返回(device, image_id)"""
+        device = self.devices.get(data.get('device_id', ''))
+        if device is None:
+            return None, None
+        return device, device['index'].get(data.get('image_id'))
+
+    def handle_chunk(self, data):
+        """处理图片数据块"""
+        device, image_id = self.find_pending_image(data)
+        if image_id is None:
+            self.debug(f"⚠️ 未找到对应的图片头信息，跳过块 {data['chunk_index']}")
+            return
+
+        img_data = device['images'][image_id]
+        assembler = img_data['assembler']
+        chunk_index = data['chunk_index']
+
+        if chunk_index < assembler.total_chunks and assembler.has_chunk(chunk_index):
+            self.metrics.duplicates.inc()
+            img_data['duplicates'] += 1
+            self.debug(f"⚠️ 块 {chunk_index} 已接收，跳过重复")
+            return
+
+        try:
+            checksum = verify_chunk(data)
+        except ValueError as e:
+            self.metrics.checksum_failures.inc(kind="chunk")
+            self.log(f"❌ 图片 {image_id} {e}", logging.ERROR)
+            return
+
+        try:
+            assembler.add_chunk(chunk_index, data['chunk_data'])
+        except ValueError as e:
+            self.log(f"❌ 图片 {image_id} 块 {chunk_index} 写入失败: {e}", logging.ERROR)
+            return
+
+        touch_pending_image(img_data, self.timeout)
+        self.debug(f"✅ 接收块 {chunk_index + 1}/{img_data['total_chunks']} ({checksum})")
+
+        if assembler.is_complete():
+            self.debug(f"🎉 图片 {image_id} 所有块接收完成!")
+            self.metrics.transfer_seconds.observe(time.time() - img_data['start_time'])
+            self.finish_image(data['device_id'], image_id)
+
+    def handle_completion(self, data):
+        """处理完成信号"""
+        device, image_id = self.find_pending_image(data)
+        if image_id is None:
+            self.debug("⚠️ 未找到对应的图片，跳过完成信号")
+            return
+
+        img_data = device['images'][image_id]
+        assembler = img_data['assembler']
+        if assembler.is_complete():
+            self.finish_image(data['device_id'], image_id)
+        else:
+            self.log(f"⚠️ 收到完成信号，但图片 {image_id} 还有 {assembler.total_chunks - assembler.received_chunks} 个块未接收",
+                     logging.WARNING)
+            self.request_retransmission(image_id, img_data)
+
+    def publish_control(self, device_id, message):
+        """向设备发送控制消息"""
+        topic = control_topic(device_id, device_id in self.per_device_topics)
+        task = self.loop.create_task(self.client.publish(topic, json.dumps(message)))
+        self.write_tasks.add(task)
+        task.add_done_callback(self.write_tasks.discard)
+
+    def request_retransmission(self, image_id, img_data):
+        """请求设备重传缺失的块，并重新设置超时定时器"""
+        nack = build_nack(img_data)
+        if nack is None:
+            return False
+
+        self.log(f"🔁 请求重传图片 {image_id} 的 {len(nack['missing'])} 个块 (第 {nack['round']} 轮)")
+        self.metrics.nacks.inc()
+        self.publish_control(img_data['device_id'], nack)
+
+        img_data['timer'].cancel()
+        img_data['timer'] = self.loop.call_later(NACK_WAIT_SECONDS, self.expire_image,
+                                                 img_data['device_id'], image_id)
+        return True
+
+    def remove_pending_image(self, device_id, image_id):
+        """从设备状态中移除图片"""
+        device = self.devices[device_id]
+        img_data = device['images'].pop(image_id)
+        img_data['timer'].cancel()
+        self.pending_count -= 1
+
+        for key in (img_data['image_id'], None):
+            if device['index'].get(key) == image_id:
+                del device['index'][key]
+
+        if not device['images']:
+            del self.devices[device_id]
+
+        return img_data
+
+    def finish_image(self, device_id, image_id):
+        """将接收完成的图片交给线程池保存"""
+        img_data = self.remove_pending_image(device_id, image_id)
+        task = self.loop.create_task(self.save_image(image_id, img_data))
+        self.write_tasks.add(task)
+        task.add_done_callback(self.write_tasks.discard)
+
+    async def save_image(self, image_id, img_data):
+        """校验并保存图片"""
+        write_start = time.time()
+        try:
+            filename, image_md5, deduplicated = await self.loop.run_in_executor(
+                self.executor, write_image, image_id, img_data, self.store)
+        except ValueError as e:
+            # 图片校验失败
+            self.metrics.checksum_failures.inc(kind="image")
+            self.metrics.images_failed.inc(reason="checksum")
+            self.log(f"❌ 组装图片时出错: {e}", logging.ERROR)
+            return
+        except Exception as e:
+            self.metrics.images_failed.inc(reason="write")
+            self.log(f"❌ 组装图片时出错: {e}", logging.ERROR)
+            return
+
+        saved_time = time.time()
+        self.metrics.write_seconds.observe(saved_time - write_start)
+        self.metrics.save_latency_seconds.observe(saved_time - img_data['start_time'])
+        img_data['deduplicated'] = deduplicated
+        if deduplicated:
+            self.metrics.images_deduplicated.inc()
+        else:
+            self.metrics.bytes_written.inc(img_data['assembler'].image_size)
+        self.metrics.images_completed.inc()
+
+        record = {
+            'filename': filename,
+            'size': img_data['assembler'].image_size,
+            'md5': image_md5,
+            'device_id': img_data['device_id'],
+            'timestamp': img_data['header']['timestamp'],
+            'saved_time': saved_time
+        }
+        self.completed_images[image_id] = record
+        while len(self.completed_images) > self.history_size:
+            self.completed_images.popitem(last=False)
+        self.completed_count += 1
+        self.log(image_summary(filename, img_data, saved_time))
+
+        # 图片已保存，索引写入失败不影响图片的结果，可用image_index.py rebuild补建
+        # add()只放入队列，由索引的后台线程写入SQLite，不会阻塞事件循环
+        try:
+            self.image_index.add(image_id, record)
+        except Exception as e:
+            self.log(f"⚠️ 写入图片索引失败 {image_id}: {e}", logging.WARNING)
+
+        ack = build_ack(img_data)
+        if ack:
+            self.publish_control(img_data['device_id'], ack)
+
+    def expire_image(self, device_id, image_id):
+        """超时定时器回调，期间收到过新块时按新的截止时间重新设置定时器"""
+        img_data = self.devices[device_id]['images'][image_id]
+        remaining = img_data['deadline'] - time.time()
+        if remaining > 0:
+            img_data['timer'] = self.loop.call_later(remaining, self.expire_image, device_id, image_id)
+            return
+
+        # 超时时设备已不再等待重传请求，重传请求只在收到完成信号时发送
+        assembler = img_data['assembler']
+        self.log(f"⏰ 图片 {image_id} 接收超时 (已收到 {assembler.received_chunks}/{assembler.total_chunks} 块)",
+                 logging.WARNING)
+        self.metrics.images_failed.inc(reason="timeout")
+        self.remove_pending_image(device_id, image_id)
+
+        if SALVAGE_PARTIAL_IMAGES and assembler.received_chunks:
+            task = self.loop.create_task(self.salvage_image(image_id, img_data))
+            self.write_tasks.add(task)
+            task.add_done_callback(self.write_tasks.discard)
+
+    async def salvage_image(self, image_id, img_data):
+        """保存超时图片已收到的部分"""
+        try:
+            filename, size = await self.loop.run_in_executor(
+                self.executor, write_partial_image, image_id, img_data, self.store)
+        except Exception as e:
+            self.log(f"❌ 保存不完整的图片 {image_id} 时出错: {e}", logging.ERROR)
+            return
+
+        if filename is not None:
+            self.metrics.images_salvaged.inc()
+            self.log(f"🩹 图片 {image_id} 不完整，已保存前 {size}/{img_data['assembler'].image_size} 字节: {filename}",
+                     logging.WARNING)
+
+    def get_status(self):
+        """获取当前状态"""
+        return {
+            'pending_count': self.pending_count,
+            'completed_count': self.completed_count,
+            'device_count': len(self.devices),
+            'writer_queue': len(self.write_tasks),
+            'heartbeat_devices': len(self.heartbeats)
+        }
+
+async def simulate(devices, images_per_device, image_size, chunk_size=DEFAULT_CHUNK_SIZE,
+                   chunk_format=FORMAT_BINARY):
+    """通过进程内代理模拟大量设备并发发送图片"""
+    broker = InProcessBroker()
+    save_dir = tempfile.mkdtemp(prefix="async_receiver_")
+    receiver = AsyncImageReceiver(broker.async_client(), save_dir=save_dir, fleet=Fleet())
+    receiver_task = asyncio.create_task(receiver.run())
+    await receiver.ready.wait()
+
+    async def device(n):
+        device_id = f"sim{n:05d}"
+        image_data = fake_jpeg(image_size)
+        for image_id in range(images_per_device):
+            for topic, payload in build_image_messages(device_id, image_id, image_data,
+                                                       chunk_size, chunk_format):
+                broker.publish(topic, payload)
+                # 让出事件循环，模拟设备交错发送
+                await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+
+    await asyncio.gather(*(device(n) for n in range(devices)))
+    await receiver.client.disconnect()
+    await receiver_task
+
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    completed = receiver.completed_count
+    shutil.rmtree(save_dir, ignore_errors=True)
+
+    print(f"设备数: {devices}, 每台图片数: {images_per_device}, 图片大小: {image_size} 字节")
+    print(f"完成图片: {completed}/{devices * images_per_device}")
+    print(f"消息数: {broker.published_count}, 数据量: {broker.published_bytes / 1024 / 1024:.1f} MB")
+    print(f"耗时: {elapsed:.2f} 秒, CPU: {cpu:.2f} 秒")
+    print(f"吞吐量: {completed / elapsed:.1f} 张/秒, {broker.published_count / elapsed:.0f} 消息/秒")
+    return completed
+
+def run_receiver(metrics_port=None, store_backend=STORE_BACKEND, fleet_file=FLEET_FILE):
+    """连接MQTT服务器运行asyncio接收引擎"""
+    print("🚀 启动asyncio图片接收器...")
+    print(f"MQTT服务器: {MQTT_BROKER}:{MQTT_PORT}")
+    print(f"保存目录: {SAVE_DIR}")
+    print("=" * 50)
+
+    async def runner():
+        receiver = AsyncImageReceiver(PahoAsyncClient(), metrics_port=metrics_port,
+                                      store=create_store(store_backend, SAVE_DIR),
+                                      fleet=Fleet.load(fleet_file))
+        await receiver.run()
+
+    try:
+        asyncio.run(runner())
+    except KeyboardInterrupt:
+        print("\n🛑 用户中断，正在关闭...")
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="asyncio图片接收引擎")
+    parser.add_argument("--simulate", type=int, metavar="N", help="进程内模拟N台设备压测")
+    parser.add_argument("--images", type=int, default=1, help="每台模拟设备发送的图片数")
+    parser.add_argument("--image-size", type=int, default=60000, help="模拟图片大小（字节）")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="分块大小")
+    parser.add_argument("--format", choices=[FORMAT_BINARY, FORMAT_JSON], default=FORMAT_BINARY,
+                        help="块格式")
+    parser.add_argument("--log-level", choices=LOG_LEVELS,
+                        help=f"日志级别，默认{LOG_LEVEL}，模拟压测时默认WARNING")
+    args = parser.parse_args()
+    setup_logging(args.log_level or ("WARNING" if args.simulate else LOG_LEVEL))
+
+    if args.simulate:
+        asyncio.run(simulate(args.simulate, args.images, args.image_size,
+                             args.chunk_size, args.format))
+    else:
+        run_receiver()
+
+if __name__ == "__main__":
+    main()
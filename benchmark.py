@@ -0,0 +1,237 @@
+"""分块传输协议端到端压测
+
+模拟N台设备按main_chunked.send_image_chunks_via_mqtt的格式发送图片，
+通过进程内代理送入windows_receiver.ImageReceiver（无需网络），
+统计吞吐量、从收到信息头到图片落盘的延迟、内存峰值和每张图片的CPU时间。
+模拟丢包时，模拟设备按接收端的重传请求(nack)补发缺失的块（补发的块同样按丢包率丢失）。
+
+示例：
+    python benchmark.py --devices 200 --images 5
+    python benchmark.py --devices 50 --loss 0.01 --reorder 0.1 --format json
+    python benchmark.py --checksum md5   # 与旧版本的MD5校验比较CPU时间
+    python benchmark.py --json > result.json   # 输出JSON便于比较回归
+"""
+import argparse
+import json
+import logging
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from chunk_protocol import FORMAT_BINARY, FORMAT_JSON, CHECKSUM_CRC32, CHECKSUMS
+from device_simulator import DEFAULT_CHUNK_SIZE, NackResponder, build_image_messages, fake_jpeg
+from inprocess_broker import InProcessBroker
+from windows_receiver import ImageReceiver
+from fleet import Fleet
+
+class BenchmarkReceiver(ImageReceiver):
+    """压测用接收器，只统计错误日志"""
+
+    def __init__(self, client, save_dir, history_size):
+        self.error_count = 0
+        super().__init__(client=client, save_dir=save_dir, history_size=history_size, fleet=Fleet())
+
+    def log(self, message, level=logging.INFO):
+        if level >= logging.ERROR:
+            self.error_count += 1
+
+def peak_rss_mb():
+    """进程内存峰值（MB），无法获取时返回None"""
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux单位为KB，macOS为字节
+        return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss) / 1024 / 1024
+    return None
+
+def percentile(values, pct):
+    """计算百分位数"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+def is_chunk(message):
+    return message[0].endswith("/chunk")
+
+def generate_traffic(args, rng):
+    """生成所有设备的消息，按设备交错排列
+
+    返回(消息列表, {(device_id, image_id): 完整消息}, 有块丢失的图片数)
+    """
+    streams = []
+    images = {}
+    lossy_images = 0
+
+    for n in range(args.devices):
+        device_id = f"bench{n:05d}"
+        messages = []
+        for image_id in range(args.images):
+            image_data = fake_jpeg(rng.randint(args.min_size, args.max_size))
+            image_messages = build_image_messages(device_id, image_id, image_data,
+                                                  args.chunk_size, args.format,
+                                                  checksum=args.checksum)
+            images[(device_id, image_id)] = image_messages
+            header, chunks, completion = image_messages[0], image_messages[1:-1], image_messages[-1]
+
+            # 模拟丢包
+            kept = [c for c in chunks if rng.random() >= args.loss]
+            if len(kept) < len(chunks):
+                lossy_images += 1
+
+            # 模拟乱序：相邻块按概率交换
+            for i in range(len(kept) - 1):
+                if rng.random() < args.reorder:
+                    kept[i], kept[i + 1] = kept[i + 1], kept[i]
+
+            messages.append(header)
+            messages.extend(kept)
+            messages.append(completion)
+        streams.append(messages)
+
+    # 各设备轮流发送一条消息
+    traffic = []
+    positions = [0] * len(streams)
+    active = list(range(len(streams)))
+    while active:
+        rng.shuffle(active)
+        still_active = []
+        for n in active:
+            traffic.append(streams[n][positions[n]])
+            positions[n] += 1
+            if positions[n] < len(streams[n]):
+                still_active.append(n)
+        active = still_active
+
+    return traffic, images, lossy_images
+
+def run_benchmark(args):
+    """运行压测并返回结果"""
+    rng = random.Random(args.seed)
+    traffic, images, lossy_images = generate_traffic(args, rng)
+    total_images = args.devices * args.images
+    chunk_count = sum(1 for message in traffic if is_chunk(message))
+    rss_before = peak_rss_mb()
+
+    save_dir = tempfile.mkdtemp(prefix="benchmark_")
+    broker = InProcessBroker()
+    # 内存中保留全部图片的记录，用于统计延迟
+    receiver = BenchmarkReceiver(broker.client(), save_dir, total_images)
+    receiver.client.connect()
+    receiver.writer_pool.start()
+
+    responder = NackResponder(broker)
+    for (device_id, image_id), image_messages in images.items():
+        responder.remember(device_id, image_id, image_messages)
+
+    try:
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+
+        for topic, payload in traffic:
+            broker.publish(topic, payload)
+            # 补发接收端请求重传的块，补发的块同样会丢失
+            for message in responder.drain():
+                if is_chunk(message) and rng.random() < args.loss:
+                    continue
+                chunk_count += is_chunk(message)
+                broker.publish(*message)
+        receiver.writer_pool.join()
+
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+    finally:
+        receiver.writer_pool.stop()
+        receiver.store.close()
+        receiver.image_index.close()
+        receiver.client.disconnect()
+        shutil.rmtree(save_dir, ignore_errors=True)
+
+    completed = list(receiver.completed_images.values())
+    latencies = [(c['saved_time'] - c['start_time']) * 1000 for c in completed]
+
+    return {
+        'devices': args.devices,
+        'images_per_device': args.images,
+        'format': args.format,
+        'chunk_size': args.chunk_size,
+        'loss': args.loss,
+        'reorder': args.reorder,
+        'messages': broker.published_count,
+        'bytes': broker.published_bytes,
+        'expected_images': total_images,
+        'lossy_images': lossy_images,
+        'nacks': responder.nacks,
+        'resent_chunks': responder.resent_chunks,
+        'completed_images': len(completed),
+        'errors': receiver.error_count,
+        'elapsed_s': elapsed,
+        'images_per_s': len(completed) / elapsed if elapsed else 0.0,
+        'chunks_per_s': chunk_count / elapsed if elapsed else 0.0,
+        'latency_p50_ms': percentile(latencies, 50),
+        'latency_p99_ms': percentile(latencies, 99),
+        'cpu_ms_per_image': cpu * 1000 / len(completed) if completed else 0.0,
+        'rss_before_mb': rss_before,
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+def print_report(result):
+    """打印压测结果"""
+    print("=" * 50)
+    print(f"设备数: {result['devices']}, 每台图片数: {result['images_per_device']}")
+    print(f"块格式: {result['format']}, 块大小: {result['chunk_size']}")
+    print(f"丢包率: {result['loss']}, 乱序率: {result['reorder']}")
+    print("-" * 50)
+    print(f"消息数: {result['messages']}, 数据量: {result['bytes'] / 1024 / 1024:.1f} MB")
+    print(f"完成图片: {result['completed_images']}/{result['expected_images']} (错误日志 {result['errors']} 条)")
+    if result['lossy_images']:
+        print(f"丢块图片: {result['lossy_images']} 张, 重传请求 {result['nacks']} 次, "
+              f"补发 {result['resent_chunks']} 块")
+    print(f"耗时: {result['elapsed_s']:.2f} 秒")
+    print(f"吞吐量: {result['images_per_s']:.1f} 张/秒, {result['chunks_per_s']:.0f} 块/秒")
+    print(f"延迟(信息头→落盘): p50 {result['latency_p50_ms']:.1f} ms, p99 {result['latency_p99_ms']:.1f} ms")
+    print(f"CPU: {result['cpu_ms_per_image']:.2f} ms/张")
+    if result['peak_rss_mb'] is not None:
+        print(f"内存峰值: {result['peak_rss_mb']:.1f} MB (回放前 {result['rss_before_mb']:.1f} MB)")
+    print("=" * 50)
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="分块传输协议端到端压测")
+    parser.add_argument("--devices", type=int, default=100, help="模拟设备数")
+    parser.add_argument("--images", type=int, default=5, help="每台设备发送的图片数")
+    parser.add_argument("--min-size", type=int, default=40000, help="最小图片大小（字节）")
+    parser.add_argument("--max-size", type=int, default=200000, help="最大图片大小（字节）")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="分块大小")
+    parser.add_argument("--format", choices=[FORMAT_BINARY, FORMAT_JSON], default=FORMAT_BINARY,
+                        help="块格式")
+    parser.add_argument("--checksum", choices=CHECKSUMS, default=CHECKSUM_CRC32, help="校验方式")
+    parser.add_argument("--loss", type=float, default=0.0, help="块丢失概率")
+    parser.add_argument("--reorder", type=float, default=0.0, help="相邻块交换概率")
+    parser.add_argument("--seed", type=int, default=1, help="随机数种子")
+    parser.add_argument("--json", action="store_true", help="以JSON格式输出结果")
+    args = parser.parse_args()
+
+    result = run_benchmark(args)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""相机管理（ESP32端）
+
+相机只初始化一次并保持帧缓冲区常驻，省去每次拍照重新上电传感器、
+等待曝光稳定的时间，也避免反复分配帧缓冲区造成堆内存碎片。
+只有在拍照出错或相机配置变化时才重新初始化。
+"""
+import time
+try:
+    import _thread
+except ImportError:
+    # 固件未启用线程支持时只能顺序拍照和上传
+    _thread = None
+import device_stats
+from camera import Camera, GrabMode, PixelFormat, FrameSize
+from config import (CAMERA_JPEG_QUALITY, CAMERA_FRAME_SIZE, CAMERA_FB_COUNT,
+                    CAMERA_WARMUP_SECONDS)
+
+FRAME_SIZE_MAP = {
+    "VGA": FrameSize.VGA,
+    "SVGA": FrameSize.SVGA,
+    "XGA": FrameSize.XGA,
+    "HD": FrameSize.HD,
+    "SXGA": FrameSize.SXGA,
+    "UXGA": FrameSize.UXGA
+}
+
+CAPTURE_RETRIES = 2  # 拍照失败时重新初始化相机后重试的次数
+PIPELINE_POLL_SECONDS = 0.01  # 流水线等待槽位的轮询间隔（秒）
+PIPELINE_STOP_TIMEOUT = 10  # 停止流水线时等待拍照线程退出的时间（秒）
+IDLE_POLL_SECONDS = 0.1  # 等待下次拍照期间调用idle回调的间隔（秒）
+
+def wait(seconds, idle=None):
+    """等待seconds秒，期间定期调用idle（如维持MQTT连接）"""
+    if idle is None:
+        time.sleep(seconds)
+        return
+    deadline = time.time() + seconds
+    while True:
+        idle()
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        time.sleep(min(remaining, IDLE_POLL_SECONDS))
+
+class CameraManager:
+    """长期持有的相机会话"""
+
+    def __init__(self, frame_size=CAMERA_FRAME_SIZE, jpeg_quality=CAMERA_JPEG_QUALITY,
+                 fb_count=CAMERA_FB_COUNT, warmup=CAMERA_WARMUP_SECONDS):
+        self.cam = None
+        self.settings = None
+        self.warmup = warmup
+        self.configure(frame_size, jpeg_quality, fb_count)
+
+    def configure(self, frame_size, jpeg_quality, fb_count):
+        """更新相机配置，配置有变化时在下次拍照前重新初始化"""
+        settings = (frame_size, jpeg_quality, fb_count)
+        if settings != self.settings:
+            self.close()
+            self.settings = settings
+
+    def open(self):
+        """初始化相机并等待曝光稳定，已初始化时直接返回"""
+        if self.cam is not None:
+            return
+
+        frame_size, jpeg_quality, fb_count = self.settings
+        cam = Camera(pixel_format=PixelFormat.JPEG,
+                     frame_size=FRAME_SIZE_MAP.get(frame_size, FrameSize.HD),
+                     jpeg_quality=jpeg_quality,
+                     fb_count=fb_count,
+                     grab_mode=GrabMode.LATEST)
+        cam.init()
+        time.sleep(self.warmup)
+        self.cam = cam
+        print(f"📷 相机已初始化: {frame_size}, 质量 {jpeg_quality}, 帧缓冲区 {fb_count}")
+
+    def close(self):
+        """释放相机"""
+        if self.cam is None:
+            return
+        try:
+            self.cam.deinit()
+        except Exception as e:
+            print(f"⚠️ 释放相机时出错: {e}")
+        self.cam = None
+
+    def capture(self):
+        """拍摄一张照片，出错时重新初始化相机后重试"""
+        for attempt in range(CAPTURE_RETRIES + 1):
+            try:
+                self.open()
+                start = device_stats.ticks_ms()
+                img = self.cam.capture()
+                if not img:
+                    raise OSError("未获取到图像数据")
+                # 复制出帧缓冲区，缓冲区交还驱动继续使用
+                image_data = bytes(img)
+                device_stats.observe("capture_ms", device_stats.elapsed_ms(start))
+                device_stats.incr("frames_captured")
+                return image_data
+            except Exception as e:
+                print(f"⚠️ 拍照失败 (第 {attempt + 1} 次): {e}")
+                device_stats.incr("capture_errors")
+                self.close()
+
+        raise OSError("相机拍照失败")
+
+    def burst(self, count, interval=0):
+        """连拍count张，返回图片列表（注意每张图片都会占用内存）"""
+        images = []
+        for i in range(count):
+            if i and interval:
+                time.sleep(interval)
+            images.append(self.capture())
+        return images
+
+    def frames(self, interval, burst_count=1, burst_interval=0, idle=None):
+        """按固定周期连续拍照的生成器
+
+        每个周期连拍burst_count张，逐张交给调用方发送，
+        发送耗时计入周期内，周期剩余时间再等待，等待期间定期调用idle；
+        interval为0时发送完立即拍下一张
+        """
+        while True:
+            cycle_start = time.time()
+            for image_data in self.burst(burst_count, burst_interval):
+                yield image_data
+
+            remaining = interval - (time.time() - cycle_start)
+            if remaining > 0:
+                print(f"等待 {remaining:.1f} 秒后再次拍照...")
+                wait(remaining, idle)
+
+def pipeline_available():
+    """固件是否支持拍照/上传流水线（需要_thread）"""
+    return _thread is not None
+
+class CapturePipeline:
+    """拍照与上传并行的流水线（双缓冲）
+
+    拍照线程把图片放入唯一的待发送槽位，主线程取走后发送，发送期间拍照线程拍下一张。
+    槽位未被取走说明上传跟不上，拍照线程等待槽位空出，错过的拍照周期直接跳过，
+    因此内存中最多同时存在两张图片（发送中一张、待发送一张）
+    """
+
+    def __init__(self, camera, interval, burst_count=1, burst_interval=0):
+        self.camera = camera
+        self.interval = interval
+        self.burst_count = burst_count
+        self.burst_interval = burst_interval
+        self.lock = _thread.allocate_lock()
+        self.slot = None
+        self.running = False
+        self.stopped = True
+        self.error = None
+        self.captured = 0
+        self.skipped = 0
+
+    def start(self):
+        """启动拍照线程"""
+        self.running = True
+        self.stopped = False
+        _thread.start_new_thread(self._capture_loop, ())
+
+    def stop(self):
+        """停止拍照线程并等待其退出"""
+        self.running = False
+        deadline = time.time() + PIPELINE_STOP_TIMEOUT
+        while not self.stopped and time.time() < deadline:
+            time.sleep(PIPELINE_POLL_SECONDS)
+        with self.lock:
+            self.slot = None
+
+    def _capture_loop(self):
+        """拍照线程主循环"""
+        next_cycle = time.time()
+        shots = 0
+
+        try:
+            while self.running:
+                now = time.time()
+
+                if shots == 0:
+                    if now < next_cycle:
+                        time.sleep(PIPELINE_POLL_SECONDS)
+                        continue
+                    shots = self.burst_count
+                    next_cycle = now + self.interval
+
+                if self.slot is not None:
+                    if self.interval and now >= next_cycle:
+                        # 上传跟不上，放弃本周期剩余的拍照
+                        print(f"⚠️ 上传跟不上，跳过 {shots} 张")
+                        self.skipped += shots
+                        shots = 0
+                    else:
+                        time.sleep(PIPELINE_POLL_SECONDS)
+                    continue
+
+                image_data = self.camera.capture()
+                with self.lock:
+                    self.slot = image_data
+                image_data = None
+                self.captured += 1
+                shots -= 1
+
+                if shots and self.burst_interval:
+                    time.sleep(self.burst_interval)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.running = False
+            self.stopped = True
+
+    def frames(self, idle=None):
+        """按拍照顺序取出待发送图片的生成器，拍照线程出错时抛出异常
+
+        等待拍照期间在主线程中定期调用idle（如维持MQTT连接）
+        """
+        last_idle = 0
+        while True:
+            with self.lock:
+                image_data = self.slot
+                self.slot = None
+
+            if image_data is None:
+                if self.error is not None:
+                    raise self.error
+                if self.stopped:
+                    return
+                if idle is not None and time.time() - last_idle >= IDLE_POLL_SECONDS:
+                    idle()
+                    last_idle = time.time()
+                time.sleep(PIPELINE_POLL_SECONDS)
+                continue
+
+            yield image_data
+            image_data = None
@@ -0,0 +1,87 @@
+"""画面变化检测（ESP32端）
+
+MicroPython中无法高效解码JPEG，这里直接扫描压缩数据：按重启标记(RST)把扫描数据分段，
+各段的压缩长度反映对应图像区域的细节量，作为画面签名与上次发送的图片比较。
+重启段少于MIN_SEGMENTS时（如JPEG编码器未启用重启间隔）签名只剩整体长度，
+大小相近的不同画面无法区分，此时不跳过任何图片。
+"""
+from config import CHANGE_THRESHOLD, CHANGE_FORCE_EVERY
+
+MIN_SEGMENTS = 8  # 签名至少需要的重启段数，少于此值时不判断为无变化
+
+def jpeg_signature(image_data):
+    """返回扫描数据各重启段的压缩长度列表"""
+    sos = image_data.find(b'\xff\xda')
+    if sos < 0 or sos + 4 > len(image_data):
+        return [len(image_data)]
+
+    start = pos = sos + 2 + ((image_data[sos + 2] << 8) | image_data[sos + 3])
+    segments = []
+
+    while True:
+        pos = image_data.find(b'\xff', pos)
+        if pos < 0 or pos + 1 >= len(image_data):
+            segments.append(len(image_data) - start)
+            break
+
+        marker = image_data[pos + 1]
+        if 0xd0 <= marker <= 0xd7:  # RST0-RST7
+            segments.append(pos - start)
+            start = pos + 2
+        elif marker == 0xd9:  # EOI
+            segments.append(pos - start)
+            break
+        pos += 2
+
+    return segments
+
+def signature_distance(current, previous):
+    """两个签名的差异比例（各段长度差的绝对值之和 / 上次总长度）"""
+    if len(current) != len(previous):
+        return 1.0
+
+    total = sum(previous)
+    if total == 0:
+        return 1.0
+    return sum(abs(a - b) for a, b in zip(current, previous)) / total
+
+class ChangeDetector:
+    """与上次发送的图片比较，判断画面是否有明显变化"""
+
+    def __init__(self, threshold=CHANGE_THRESHOLD, force_every=CHANGE_FORCE_EVERY):
+        self.threshold = threshold
+        self.force_every = force_every
+        self.reference = None  # 上次发送图片的签名
+        self.candidate = None  # 当前图片的签名，发送成功后成为新的参照
+        self.unchanged = 0  # 连续未发送的图片数
+        self.warned = False  # 是否已提示图片缺少重启标记
+
+    def check(self, image_data):
+        """返回(是否需要发送, 差异比例)"""
+        self.candidate = jpeg_signature(image_data)
+
+        if len(self.candidate) < MIN_SEGMENTS:
+            # 只靠整体长度会把大小相近的不同画面当作无变化而丢失
+            if not self.warned:
+                print("⚠️ 图片缺少重启标记，无法检测画面变化，所有图片照常发送")
+                self.warned = True
+            return True, 1.0
+
+        if self.reference is None:
+            return True, 1.0
+
+        score = signature_distance(self.candidate, self.reference)
+        if score >= self.threshold:
+            return True, score
+
+        # 长时间无变化时仍定期发送一张，便于接收端确认画面
+        if self.force_every and self.unchanged + 1 >= self.force_every:
+            return True, score
+
+        self.unchanged += 1
+        return False, score
+
+    def mark_sent(self):
+        """当前图片已发送，作为之后比较的参照"""
+        self.reference = self.candidate
+        self.unchanged = 0
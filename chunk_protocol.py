@@ -0,0 +1,101 @@
+"""分块传输协议编解码（ESP32端与接收端共用）
+
+二进制块格式: 固定长度的块头 + 设备ID + 原始JPEG数据，
+相比base64+JSON省去约33%的编码开销和JSON封装。
+"""
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+
+try:
+    import ubinascii as binascii
+except ImportError:
+    import binascii
+
+# 协议版本
+PROTOCOL_VERSION = 1
+
+# 块格式
+FORMAT_JSON = "json"
+FORMAT_BINARY = "binary"
+
+# 二进制块头: magic(2) 版本(1) 标志(1) 图片ID(4) 块索引(2) 总块数(2) CRC32(4) 设备ID长度(1)
+BINARY_MAGIC = b"\xe5\x32"
+BINARY_HEADER_FORMAT = ">2sBBIHHIB"
+BINARY_HEADER_SIZE = struct.calcsize(BINARY_HEADER_FORMAT)
+
+# 标志位
+FLAG_LAST = 0x01
+
+# 校验方式，由设备在信息头的checksum字段中声明，缺省为md5（旧版本设备）
+# crc32: 每块和整张图片使用CRC32，计算量远小于MD5，足以发现传输中的损坏
+# md5: JSON块使用MD5，整张图片使用MD5，兼容旧版本接收端
+CHECKSUM_CRC32 = "crc32"
+CHECKSUM_MD5 = "md5"
+CHECKSUMS = (CHECKSUM_CRC32, CHECKSUM_MD5)
+
+def crc32(data, value=0):
+    """计算CRC32校验值（无符号）"""
+    return binascii.crc32(data, value) & 0xffffffff
+
+def pack_binary_chunk(device_id, image_id, chunk_index, total_chunks, chunk_data):
+    """打包二进制数据块"""
+    device_bytes = device_id.encode('utf-8')
+    flags = FLAG_LAST if chunk_index == total_chunks - 1 else 0
+    header = struct.pack(BINARY_HEADER_FORMAT, BINARY_MAGIC, PROTOCOL_VERSION, flags,
+                         image_id, chunk_index, total_chunks, crc32(chunk_data),
+                         len(device_bytes))
+    return header + device_bytes + bytes(chunk_data)
+
+def pack_binary_chunk_into(buffer, device_id, image_id, chunk_index, total_chunks, chunk_data):
+    """把二进制数据块打包到预分配的缓冲区，返回消息长度
+
+    供ESP32端复用同一个发送缓冲区，避免每个块都分配新的bytes对象
+    """
+    device_bytes = device_id.encode('utf-8')
+    flags = FLAG_LAST if chunk_index == total_chunks - 1 else 0
+    data_offset = BINARY_HEADER_SIZE + len(device_bytes)
+    length = data_offset + len(chunk_data)
+    if len(buffer) < length:
+        raise ValueError("缓冲区长度不足")
+
+    struct.pack_into(BINARY_HEADER_FORMAT, buffer, 0, BINARY_MAGIC, PROTOCOL_VERSION, flags,
+                     image_id, chunk_index, total_chunks, crc32(chunk_data), len(device_bytes))
+    buffer[BINARY_HEADER_SIZE:data_offset] = device_bytes
+    buffer[data_offset:length] = chunk_data
+    return length
+
+def is_binary_chunk(payload):
+    """根据magic判断是否为二进制数据块（JSON消息以'{'开头）"""
+    return len(payload) >= BINARY_HEADER_SIZE and payload[:2] == BINARY_MAGIC
+
+def peek_binary_device_id(payload):
+    """只读取二进制块中的设备ID，不解析整个块"""
+    device_id_len = payload[BINARY_HEADER_SIZE - 1]
+    return bytes(payload[BINARY_HEADER_SIZE:BINARY_HEADER_SIZE + device_id_len]).decode('utf-8')
+
+def unpack_binary_chunk(payload):
+    """解析二进制数据块，返回与JSON块字段一致的字典"""
+    (magic, version, flags, image_id, chunk_index, total_chunks,
+     chunk_crc32, device_id_len) = struct.unpack_from(BINARY_HEADER_FORMAT, payload, 0)
+
+    if version != PROTOCOL_VERSION:
+        raise ValueError(f"不支持的协议版本: {version}")
+
+    data_offset = BINARY_HEADER_SIZE + device_id_len
+    if len(payload) < data_offset:
+        raise ValueError("二进制块长度不足")
+
+    view = memoryview(payload)
+    return {
+        "type": "chunk",
+        "format": FORMAT_BINARY,
+        "device_id": bytes(view[BINARY_HEADER_SIZE:data_offset]).decode('utf-8'),
+        "image_id": image_id,
+        "chunk_index": chunk_index,
+        "total_chunks": total_chunks,
+        "chunk_data": view[data_offset:],
+        "chunk_crc32": chunk_crc32,
+        "is_last": bool(flags & FLAG_LAST)
+    }
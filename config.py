@@ -5,15 +5,64 @@ WIFI_PASSWORD = "#1Bosttown"
 # MQTT配置
 MQTT_BROKER = "****.com"  # 你的mqtt服务器地址
 MQTT_PORT = 26701
-MQTT_CLIENT_ID = "wifitest"  # 登录客户端ID
+MQTT_CLIENT_ID = None  # 登录客户端ID，None时使用设备ID
 MQTT_USERNAME = "***"   # 你的mqtt账号
 MQTT_PASSWORD = "****"  # 账号所对应的密码
 MQTT_TOPIC = "esp32/camera"  # 订阅的topic
 
+# 设备标识配置
+DEVICE_ID = None  # 设备ID，None时读取DEVICE_ID_FILE，仍没有时由WiFi MAC地址生成
+DEVICE_ID_FILE = "device_id.txt"  # 部署时写入闪存的设备ID文件，批量部署时所有设备可共用同一份config.py
+PER_DEVICE_TOPICS = True  # 发布到{MQTT_TOPIC}/{设备ID}/...；False时使用所有设备共用的旧主题，兼容旧接收端
+
+# 连接配置
+MQTT_KEEPALIVE = 60  # MQTT保活间隔（秒），空闲超过一半时发送PING
+WIFI_CONNECT_TIMEOUT = 10  # 每次连接WiFi的等待时间（秒）
+RECONNECT_MIN_SECONDS = 1  # 重连失败后的初始等待时间（秒），之后每次加倍
+RECONNECT_MAX_SECONDS = 60  # 重连等待时间上限（秒）
+IMAGE_QOS = 0  # 图片消息的QoS等级，1为可靠传输（服务器确认每条消息）
+MQTT_INFLIGHT_WINDOW = 8  # QoS 1时允许未确认的消息数，达到上限才等待确认
+MQTT_ACK_TIMEOUT = 10  # 等待服务器确认(PUBACK)的超时时间（秒）
+
 # 相机配置
 CAMERA_JPEG_QUALITY = 90  # 质量可自己调试
 CAMERA_FRAME_SIZE = "HD"  # 可选: VGA, SVGA, XGA, HD, SXGA, UXGA
 CAMERA_FB_COUNT = 2
+CAMERA_WARMUP_SECONDS = 2  # 相机初始化后等待曝光稳定的时间（秒），只在首次或重新初始化时等待
 
 # 程序配置
-PHOTO_INTERVAL = 30  # 拍照间隔（秒） 
+PHOTO_INTERVAL = 30  # 拍照间隔（秒），0表示连续拍照（发送完立即拍下一张）
+BURST_COUNT = 1  # 每次拍照连拍的张数
+BURST_INTERVAL = 0.2  # 连拍间隔（秒）
+PIPELINE = False  # 拍照与上传并行（双缓冲，需要固件支持_thread），上传跟不上时跳过拍照
+
+# 变化检测配置
+CHANGE_DETECTION = False  # 画面与上次发送的图片相比无明显变化时只发送心跳，不上传图片
+CHANGE_THRESHOLD = 0.03  # 压缩数据的差异比例低于此值视为无变化
+CHANGE_FORCE_EVERY = 20  # 连续多少张无变化后仍强制发送一张，0为不强制
+
+# 分块传输配置
+CHUNK_FORMAT = "binary"  # 可选: binary(二进制块，推荐), json(base64+JSON，兼容旧接收端)
+CHECKSUM = "auto"  # 可选: auto(接收端确认支持后改用crc32), crc32(比MD5快得多), md5(兼容旧接收端)
+
+# 自适应分块配置
+ADAPTIVE_CHUNKING = True  # 根据发送结果自动调整块大小和块间隔，False时固定为3KB块、100毫秒间隔
+CHUNK_SIZE_MIN = 1024  # 最小块大小（字节）
+CHUNK_SIZE_MAX = 16384  # 最大块大小（字节），不要超过MQTT服务器允许的消息大小
+CHUNK_DELAY_MIN = 0.005  # 最小块间隔（秒）
+CHUNK_DELAY_MAX = 0.5  # 最大块间隔（秒）
+
+# 统计配置
+STATS_INTERVAL = 60  # 设备统计发布到{MQTT_TOPIC}/{设备ID}/stats的间隔（秒），0为关闭
+
+# 离线缓存配置
+SPOOL_ENABLED = True  # 网络不可用时把图片缓存到闪存，恢复连接后补发
+SPOOL_DIR = "/spool"  # 缓存目录
+SPOOL_MAX_BYTES = 1024 * 1024  # 缓存字节预算，超出时淘汰最早的图片
+SPOOL_MIN_FREE_BYTES = 256 * 1024  # 闪存至少保留的剩余空间（字节）
+SPOOL_DRAIN_BATCH = 2  # 每次拍照后最多补发的缓存图片数
+SPOOL_DRAIN_DELAY = 1  # 补发图片之间的间隔（秒）
+
+# 重传配置
+NACK_WAIT_SECONDS = 5  # 发送完成后等待接收端确认或重传请求的时间（秒）
+NACK_MAX_ROUNDS = 3  # 每张图片最多重传的轮数
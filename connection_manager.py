@@ -0,0 +1,291 @@
+"""网络连接管理（ESP32端）
+
+负责WiFi断线重连、MQTT按指数退避重连和保活PING，
+并提供带在途窗口的QoS 1发布：连续发送多条消息而不逐条等待服务器确认(PUBACK)，
+未确认的消息达到窗口上限时才等待，兼顾吞吐量和可靠性。
+连接断开时未确认的消息保留在窗口中，重连后设置DUP标志按原报文ID重发。
+拍照间隔较长时，主程序在等待期间调用service()发送PING，避免空闲超过保活时间被服务器断开。
+"""
+import network
+import random
+import time
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+from umqtt.simple import MQTTClient
+import device_identity
+from config import (WIFI_SSID, WIFI_PASSWORD, MQTT_BROKER, MQTT_PORT, MQTT_CLIENT_ID,
+                    MQTT_USERNAME, MQTT_PASSWORD, MQTT_KEEPALIVE, WIFI_CONNECT_TIMEOUT,
+                    RECONNECT_MIN_SECONDS, RECONNECT_MAX_SECONDS, MQTT_INFLIGHT_WINDOW,
+                    MQTT_ACK_TIMEOUT)
+
+MQTT_PUBACK = 0x40  # PUBACK报文类型
+MQTT_PUBLISH_QOS1 = 0x32  # QoS 1的PUBLISH报文首字节
+MQTT_DUP = 0x08  # 重发标志
+ACK_POLL_SECONDS = 0.005  # 等待PUBACK时的轮询间隔（秒）
+
+class ConnectionManager:
+    """WiFi与MQTT连接管理，接口与umqtt的MQTTClient兼容（publish/check_msg）"""
+
+    def __init__(self, callback=None, subscriptions=()):
+        self.wlan = network.WLAN(network.STA_IF)
+        self.client = None
+        self.callback = callback
+        self.subscriptions = list(subscriptions)
+        self.backoff = RECONNECT_MIN_SECONDS
+        self.next_attempt = 0  # 下次允许重连的时间
+        self.last_activity = 0
+        self.in_flight = {}  # 等待PUBACK的报文ID -> (主题, 消息)，重连后重发
+        self.last_pid = 0  # 最近使用的报文ID，重连后继续递增，避免与重发的报文ID冲突
+        self.reconnects = 0
+
+    def connect_wifi(self):
+        """连接WiFi"""
+        self.wlan.active(True)
+
+        if self.wlan.isconnected():
+            return True
+
+        print(f"正在连接到WiFi: {WIFI_SSID}")
+        try:
+            # 清除上一次未完成的连接，避免重复connect报错
+            self.wlan.disconnect()
+        except OSError:
+            pass
+        self.wlan.connect(WIFI_SSID, WIFI_PASSWORD)
+
+        max_wait = WIFI_CONNECT_TIMEOUT
+        while max_wait > 0:
+            if self.wlan.isconnected():
+                break
+            max_wait -= 1
+            print("等待WiFi连接...")
+            time.sleep(1)
+
+        if self.wlan.isconnected():
+            print(f"WiFi连接成功! IP: {self.wlan.ifconfig()[0]}")
+            return True
+
+        print("WiFi连接失败!")
+        return False
+
+    def connect_mqtt(self):
+        """连接MQTT服务器并恢复订阅"""
+        # 每台设备的客户端ID必须不同，否则服务器会断开先连接的设备
+        client = MQTTClient(MQTT_CLIENT_ID or device_identity.device_id(), MQTT_BROKER, port=MQTT_PORT,
+                            user=MQTT_USERNAME, password=MQTT_PASSWORD,
+                            keepalive=MQTT_KEEPALIVE)
+        if self.callback is not None:
+            client.set_callback(self.callback)
+        client.connect()
+        for topic in self.subscriptions:
+            client.subscribe(topic)
+
+        client.pid = self.last_pid
+        self.client = client
+        self.last_activity = time.time()
+        print("MQTT连接成功!")
+        self._resend_in_flight()
+
+    def connect(self, block=True):
+        """建立WiFi和MQTT连接，失败时按指数退避重试
+        
+        block为True时重试直到成功；为False时最多尝试一次，
+        退避等待期内直接返回None，供离线时继续拍照使用
+        """
+        while True:
+            if not block and time.time() < self.next_attempt:
+                return None
+
+            try:
+                if not self.connect_wifi():
+                    raise OSError("WiFi连接失败")
+                if self.client is None:
+                    self.connect_mqtt()
+                self.backoff = RECONNECT_MIN_SECONDS
+                self.next_attempt = 0
+                return self.client
+            except Exception as e:
+                self.close()
+                # 加入随机抖动，避免多台设备在服务器恢复后同时重连
+                delay = self.backoff * (1 + random.random() / 2)
+                self.next_attempt = time.time() + delay
+                self.backoff = min(self.backoff * 2, RECONNECT_MAX_SECONDS)
+                print(f"⚠️ 连接失败: {e}，{delay:.1f} 秒后重试")
+                if not block:
+                    return None
+                time.sleep(delay)
+
+    def is_connected(self):
+        """MQTT连接是否可用"""
+        return self.client is not None and self.wlan.isconnected()
+
+    def ensure_connected(self, block=True):
+        """检查连接，空闲超过保活间隔一半时发送PING，连接断开时重连
+        
+        block为False时不等待重连，连接不可用时返回None
+        """
+        if self.client is not None and not self.wlan.isconnected():
+            print("⚠️ WiFi连接已断开")
+            self.close()
+
+        self.keepalive()
+
+        if self.client is None and (block or time.time() >= self.next_attempt):
+            self.reconnects += 1
+            print(f"🔁 正在重新连接 (第 {self.reconnects} 次)")
+            self.connect(block)
+
+        return self.client
+
+    def keepalive(self):
+        """空闲超过保活间隔一半时发送PING"""
+        if self.client is not None and time.time() - self.last_activity >= MQTT_KEEPALIVE / 2:
+            try:
+                self.client.ping()
+                self.last_activity = time.time()
+            except OSError as e:
+                self.mark_failed(e)
+
+    def service(self):
+        """等待拍照期间维持连接：按需发送PING并处理收到的消息，不重连
+
+        连接出错时关闭连接，由下次拍照前的ensure_connected重连
+        """
+        if self.client is None:
+            return
+        self.keepalive()
+        try:
+            if self.client is not None:
+                self.check_msg()
+        except OSError:
+            pass
+
+    def mark_failed(self, error):
+        """连接出错，关闭连接等待下次重连"""
+        print(f"⚠️ MQTT连接出错: {error}")
+        self.close()
+
+    def close(self):
+        """断开MQTT连接"""
+        if self.client is not None:
+            try:
+                self.client.disconnect()
+            except Exception:
+                pass
+            try:
+                self.client.sock.close()
+            except Exception:
+                pass
+            self.client = None
+
+    def publish(self, topic, msg, qos=0):
+        """发布消息；QoS 1时不等待PUBACK，在途消息达到窗口上限时才等待"""
+        if self.client is None:
+            raise OSError("MQTT未连接")
+
+        try:
+            if qos == 0:
+                self.client.publish(topic, msg)
+            else:
+                while len(self.in_flight) >= MQTT_INFLIGHT_WINDOW:
+                    self._wait_puback()
+                self._publish_qos1(topic, msg)
+            self.last_activity = time.time()
+        except OSError as e:
+            self.mark_failed(e)
+            raise
+
+    def check_msg(self):
+        """处理收到的消息（控制消息回调、PINGRESP、PUBACK）"""
+        if self.client is None:
+            raise OSError("MQTT未连接")
+
+        try:
+            op = self.client.check_msg()
+            if op == MQTT_PUBACK:
+                self._read_puback()
+            return op
+        except OSError as e:
+            self.mark_failed(e)
+            raise
+
+    def flush(self):
+        """等待所有QoS 1消息被服务器确认"""
+        try:
+            while self.in_flight:
+                self._wait_puback()
+        except OSError as e:
+            self.mark_failed(e)
+            raise
+
+    def _publish_qos1(self, topic, msg, pid=None):
+        """发送QoS 1的PUBLISH报文，不等待PUBACK
+
+        umqtt.simple的publish在QoS 1时会阻塞到收到本条消息的PUBACK，无法连续发送，
+        这里按相同的报文格式自行发送并记录报文ID。
+        消息复制一份保存在窗口中用于重连后重发（调用方可能复用发送缓冲区）；
+        pid不为None时为重发，设置DUP标志并沿用原报文ID
+        """
+        client = self.client
+        if isinstance(topic, str):
+            topic = topic.encode('utf-8')
+
+        pkt = bytearray(b"\0\0\0\0")
+        pkt[0] = MQTT_PUBLISH_QOS1 if pid is None else MQTT_PUBLISH_QOS1 | MQTT_DUP
+        sz = 2 + len(topic) + 2 + len(msg)
+        i = 1
+        while sz > 0x7f:
+            pkt[i] = (sz & 0x7f) | 0x80
+            sz >>= 7
+            i += 1
+        pkt[i] = sz
+        client.sock.write(pkt, i + 1)
+        client._send_str(topic)
+
+        if pid is None:
+            client.pid = client.pid % 0xffff + 1  # 报文ID取值1~65535
+            pid = self.last_pid = client.pid
+            msg = bytes(msg)
+        struct.pack_into("!H", pkt, 0, pid)
+        client.sock.write(pkt, 2)
+        client.sock.write(msg)
+        self.in_flight[pid] = (topic, msg)
+
+    def _resend_in_flight(self):
+        """重连后按报文ID顺序重发未确认的消息"""
+        if not self.in_flight:
+            return
+        print(f"🔁 重发 {len(self.in_flight)} 条未确认的消息")
+        try:
+            for pid in sorted(self.in_flight):
+                topic, msg = self.in_flight[pid]
+                self._publish_qos1(topic, msg, pid)
+            self.last_activity = time.time()
+        except OSError as e:
+            self.mark_failed(e)
+            raise
+
+    def _read_puback(self):
+        """读取PUBACK的剩余部分（umqtt的wait_msg只读取了报文类型）"""
+        sock = self.client.sock
+        # check_msg把套接字设为非阻塞，与wait_msg一样先恢复阻塞模式再读取报文剩余部分
+        sock.setblocking(True)
+        size = sock.read(1)
+        if size != b"\x02":
+            raise OSError("PUBACK报文格式错误")
+        pid = sock.read(2)
+        self.in_flight.pop(pid[0] << 8 | pid[1], None)
+
+    def _wait_puback(self):
+        """等待至少一条PUBACK"""
+        deadline = time.time() + MQTT_ACK_TIMEOUT
+        while time.time() < deadline:
+            op = self.client.check_msg()
+            if op == MQTT_PUBACK:
+                self._read_puback()
+                return
+            if op is None:
+                time.sleep(ACK_POLL_SECONDS)
+        raise OSError("等待PUBACK超时")
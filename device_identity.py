@@ -0,0 +1,49 @@
+"""设备标识和主题（ESP32端）
+
+设备ID按以下顺序确定：
+1. config.py中的DEVICE_ID
+2. 部署时写入闪存的DEVICE_ID_FILE，批量部署时每台设备写入不同的ID，所有设备共用同一份config.py
+3. 由WiFi MAC地址生成，如esp32-a1b2c3d4e5f6
+
+设备ID同时用作MQTT客户端ID（MQTT_CLIENT_ID为None时）和主题命名空间，
+各设备发布到{MQTT_TOPIC}/{设备ID}/header等主题，接收端用通配符订阅。
+"""
+import network
+import ubinascii
+from config import MQTT_TOPIC, DEVICE_ID, DEVICE_ID_FILE, PER_DEVICE_TOPICS
+
+_device_id = None
+
+def read_provisioned_id():
+    """读取部署时写入的设备ID，没有时返回None"""
+    try:
+        with open(DEVICE_ID_FILE) as f:
+            device_id = f.read().strip()
+    except OSError:
+        return None
+    return device_id or None
+
+def mac_device_id():
+    """由WiFi MAC地址生成设备ID"""
+    wlan = network.WLAN(network.STA_IF)
+    wlan.active(True)
+    return "esp32-" + ubinascii.hexlify(wlan.config('mac')).decode()
+
+def device_id():
+    """本设备的ID"""
+    global _device_id
+    if _device_id is None:
+        _device_id = DEVICE_ID or read_provisioned_id() or mac_device_id()
+    return _device_id
+
+def topic(suffix):
+    """设备发布消息的主题"""
+    if PER_DEVICE_TOPICS:
+        return f"{MQTT_TOPIC}/{device_id()}/{suffix}"
+    return f"{MQTT_TOPIC}/{suffix}"
+
+def control_topic():
+    """接收端发送确认(ack)和重传请求(nack)的主题"""
+    if PER_DEVICE_TOPICS:
+        return topic("control")
+    return f"{MQTT_TOPIC}/control/{device_id()}"
@@ -0,0 +1,137 @@
+"""模拟ESP32设备的分块传输流量
+
+生成与main_chunked.send_image_chunks_via_mqtt相同格式的header/chunk/completion消息，
+用于在PC上测试和压测接收器；NackResponder模拟设备按接收端的重传请求补发缺失的块。
+"""
+import base64
+import hashlib
+import json
+import os
+import time
+from collections import deque
+
+import chunk_protocol
+from chunk_protocol import PROTOCOL_VERSION, FORMAT_BINARY, CHECKSUM_CRC32
+
+DEFAULT_TOPIC = "esp32/camera"
+DEFAULT_CHUNK_SIZE = 3072
+
+def fake_jpeg(size):
+    """生成指定大小的随机JPEG数据（带SOI/EOI标记）"""
+    if size < 4:
+        raise ValueError("图片大小至少为4字节")
+    return b'\xff\xd8' + os.urandom(size - 4) + b'\xff\xd9'
+
+def build_image_messages(device_id, image_id, image_data, chunk_size=DEFAULT_CHUNK_SIZE,
+                         chunk_format=FORMAT_BINARY, topic=None, timestamp=None,
+                         checksum=CHECKSUM_CRC32):
+    """生成一张图片的全部消息，返回[(topic, payload), ...]
+
+    topic为None时发布到设备命名空间（esp32/camera/{device_id}），与main_chunked的默认配置一致
+    """
+    if topic is None:
+        topic = f"{DEFAULT_TOPIC}/{device_id}"
+    if timestamp is None:
+        timestamp = time.time()
+
+    if checksum == CHECKSUM_CRC32:
+        image_checksum = {"checksum": checksum, "image_crc32": "%08x" % chunk_protocol.crc32(image_data)}
+    else:
+        image_checksum = {"checksum": checksum, "image_md5": hashlib.md5(image_data).hexdigest()}
+
+    if chunk_format == FORMAT_BINARY:
+        payload = memoryview(image_data)
+    else:
+        payload = base64.b64encode(image_data).decode('utf-8')
+
+    total_chunks = (len(payload) + chunk_size - 1) // chunk_size
+
+    messages = [(f"{topic}/header", json.dumps({
+        "type": "header",
+        "version": PROTOCOL_VERSION,
+        "format": chunk_format,
+        "timestamp": timestamp,
+        "device_id": device_id,
+        "image_id": image_id,
+        **image_checksum,
+        "total_chunks": total_chunks,
+        "chunk_size": chunk_size,
+        "image_size": len(image_data)
+    }).encode('utf-8'))]
+
+    for chunk_index in range(total_chunks):
+        chunk_data = payload[chunk_index * chunk_size:(chunk_index + 1) * chunk_size]
+
+        if chunk_format == FORMAT_BINARY:
+            chunk_message = chunk_protocol.pack_binary_chunk(device_id, image_id, chunk_index,
+                                                             total_chunks, chunk_data)
+        else:
+            chunk = {
+                "type": "chunk",
+                "chunk_index": chunk_index,
+                "total_chunks": total_chunks,
+                "chunk_data": chunk_data,
+                "device_id": device_id,
+                "image_id": image_id,
+                "is_last": (chunk_index == total_chunks - 1)
+            }
+            if checksum == CHECKSUM_CRC32:
+                chunk["chunk_crc32"] = chunk_protocol.crc32(chunk_data.encode('utf-8'))
+            else:
+                chunk["chunk_md5"] = hashlib.md5(chunk_data.encode('utf-8')).hexdigest()
+            chunk_message = json.dumps(chunk).encode('utf-8')
+
+        messages.append((f"{topic}/chunk", chunk_message))
+
+    messages.append((f"{topic}/completion", json.dumps({
+        "type": "completion",
+        "timestamp": time.time(),
+        "device_id": device_id,
+        "image_id": image_id,
+        **image_checksum,
+        "total_chunks": total_chunks
+    }).encode('utf-8')))
+
+    return messages
+
+class NackResponder:
+    """模拟设备对接收端控制消息的响应
+
+    订阅各设备的控制主题，保留每张图片的消息直到收到ack；收到nack时把缺失的块和完成信号放入队列。
+    与真实设备一样在接收端的回调之外补发：调用方在发送下一条消息前用drain()取出并发布，
+    避免在接收端处理消息的过程中嵌套投递。
+    """
+
+    def __init__(self, broker, topic=DEFAULT_TOPIC):
+        self.images = {}  # (device_id, image_id) -> build_image_messages生成的消息
+        self.queue = deque()
+        self.nacks = 0  # 收到的重传请求数
+        self.resent_chunks = 0
+        broker.subscribe(f"{topic}/+/control", self.on_control)
+
+    def remember(self, device_id, image_id, messages):
+        """记录已发送图片的消息，用于重传"""
+        self.images[(device_id, image_id)] = messages
+
+    def on_control(self, topic, payload):
+        message = json.loads(payload)
+        key = (topic.split('/')[-2], message.get('image_id'))
+        if message.get('type') == 'ack':
+            self.images.pop(key, None)
+            return
+        if message.get('type') != 'nack' or key not in self.images:
+            return
+
+        messages = self.images[key]
+        chunks = messages[1:-1]
+        self.nacks += 1
+        for chunk_index in message.get('missing', []):
+            if 0 <= chunk_index < len(chunks):
+                self.queue.append(chunks[chunk_index])
+                self.resent_chunks += 1
+        self.queue.append(messages[-1])
+
+    def drain(self):
+        """依次取出待补发的消息，取出过程中收到的新请求也会被取出"""
+        while self.queue:
+            yield self.queue.popleft()
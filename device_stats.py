@@ -0,0 +1,58 @@
+"""设备端统计（ESP32端）
+
+记录拍照、编码、发布等各阶段的耗时和计数，定期发布到{MQTT_TOPIC}/{设备ID}/stats主题，
+由接收端转换为Prometheus指标。耗时按上报周期汇总（次数、平均值、最大值），
+上报后清零；计数器为启动以来的累计值。
+"""
+import time
+try:
+    from time import ticks_ms, ticks_diff
+except ImportError:
+    # 非MicroPython环境
+    def ticks_ms():
+        return int(time.time() * 1000)
+
+    def ticks_diff(end, start):
+        return end - start
+
+_counters = {}
+_timings = {}  # 名称 -> [次数, 总和, 最大值]
+_last_report = time.time()
+
+def incr(name, amount=1):
+    """计数器加一"""
+    _counters[name] = _counters.get(name, 0) + amount
+
+def observe(name, value):
+    """记录一次耗时（毫秒）"""
+    timing = _timings.get(name)
+    if timing is None:
+        _timings[name] = [1, value, value]
+    else:
+        timing[0] += 1
+        timing[1] += value
+        if value > timing[2]:
+            timing[2] = value
+
+def elapsed_ms(start):
+    """从start（ticks_ms()的返回值）到现在经过的毫秒数"""
+    return ticks_diff(ticks_ms(), start)
+
+def due(interval):
+    """是否到了上报时间"""
+    return interval > 0 and time.time() - _last_report >= interval
+
+def snapshot(gauges=None):
+    """生成上报内容并清零本周期的耗时统计"""
+    global _last_report
+    timings = {}
+    for name, (count, total, maximum) in _timings.items():
+        timings[name] = {"count": count, "avg": total / count, "max": maximum}
+    _timings.clear()
+    _last_report = time.time()
+
+    return {
+        "counters": dict(_counters),
+        "gauges": gauges or {},
+        "timings": timings
+    }
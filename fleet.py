@@ -0,0 +1,123 @@
+"""设备清单
+
+接收端启动时加载设备清单（默认为当前目录下的fleet.json），没有清单文件时接收所有设备：
+
+    {
+        "allow_unknown": false,
+        "devices": [
+            {"device_id": "esp32-a1b2c3d4e5f6", "name": "前门"},
+            {"device_id": "esp32-0a1b2c3d4e5f", "name": "仓库", "enabled": false}
+        ]
+    }
+
+allow_unknown为true（默认）时用通配符订阅所有设备的主题，只忽略清单中禁用的设备；
+为false时只订阅清单中启用的设备，多个接收端加载不同的清单即可按设备分担负载。
+
+示例：
+    python fleet.py list
+    python fleet.py add esp32-a1b2c3d4e5f6 --name 前门
+    python fleet.py disable esp32-a1b2c3d4e5f6
+"""
+import argparse
+import json
+import os
+
+FLEET_FILE = "fleet.json"  # 默认的设备清单文件
+
+class Fleet:
+    """设备清单，加载后只读，可在多个线程中使用"""
+
+    def __init__(self, devices=(), allow_unknown=True):
+        self.devices = {}  # device_id -> 设备信息
+        for device in devices:
+            if not device.get('device_id'):
+                raise ValueError(f"设备清单中的设备缺少device_id: {device}")
+            self.devices[device['device_id']] = device
+        self.allow_unknown = allow_unknown
+
+    @classmethod
+    def load(cls, path=FLEET_FILE):
+        """加载设备清单，文件不存在时返回接收所有设备的空清单"""
+        if not os.path.exists(path):
+            return cls()
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+        except ValueError as e:
+            raise ValueError(f"设备清单 {path} 格式错误: {e}")
+        return cls(data.get('devices', ()), data.get('allow_unknown', True))
+
+    def save(self, path=FLEET_FILE):
+        """保存设备清单"""
+        data = {"allow_unknown": self.allow_unknown, "devices": list(self.devices.values())}
+        tmp = path + ".tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+        os.replace(tmp, path)
+
+    def allowed(self, device_id):
+        """是否接收该设备的消息"""
+        device = self.devices.get(device_id)
+        if device is None:
+            return self.allow_unknown
+        return device.get('enabled', True)
+
+    def name(self, device_id):
+        """设备名称，未设置时返回设备ID"""
+        device = self.devices.get(device_id)
+        if device is None:
+            return device_id
+        return device.get('name') or device_id
+
+    def subscribed_devices(self):
+        """需要逐个订阅的设备ID，接收所有设备（使用通配符订阅）时返回None"""
+        if self.allow_unknown:
+            return None
+        return sorted(device_id for device_id in self.devices if self.allowed(device_id))
+
+    def __len__(self):
+        return len(self.devices)
+
+def main():
+    """命令行查看和修改设备清单"""
+    parser = argparse.ArgumentParser(description="设备清单")
+    parser.add_argument("--file", default=FLEET_FILE, help="设备清单文件")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("list", help="列出设备")
+    add = commands.add_parser("add", help="添加或更新设备")
+    add.add_argument("device_id", help="设备ID")
+    add.add_argument("--name", help="设备名称")
+    for command, help_text in (("enable", "启用设备"), ("disable", "禁用设备"), ("remove", "删除设备")):
+        commands.add_parser(command, help=help_text).add_argument("device_id", help="设备ID")
+    allow = commands.add_parser("allow-unknown", help="是否接收清单以外的设备")
+    allow.add_argument("value", choices=["yes", "no"])
+    args = parser.parse_args()
+
+    fleet = Fleet.load(args.file)
+    if args.command == "list":
+        print(f"清单以外的设备: {'接收' if fleet.allow_unknown else '忽略'}")
+        for device_id, device in sorted(fleet.devices.items()):
+            state = "启用" if device.get('enabled', True) else "禁用"
+            print(f"{device_id}  {device.get('name', '')}  {state}")
+        return
+
+    if args.command == "allow-unknown":
+        fleet.allow_unknown = args.value == "yes"
+    elif args.command == "add":
+        device = fleet.devices.setdefault(args.device_id, {"device_id": args.device_id})
+        if args.name:
+            device['name'] = args.name
+    elif args.device_id not in fleet.devices:
+        print(f"❌ 清单中没有设备: {args.device_id}")
+        raise SystemExit(1)
+    elif args.command == "remove":
+        del fleet.devices[args.device_id]
+    else:
+        fleet.devices[args.device_id]['enabled'] = args.command == "enable"
+
+    fleet.save(args.file)
+    print(f"✅ 设备清单已保存: {args.file}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+"""已保存图片的磁盘索引
+
+接收器内存中只保留最近保存的图片，完整的历史记录写入保存目录下的SQLite索引，
+按(device_id, timestamp)建立索引，支持按设备和时间范围查询。
+记录先放入内存队列，由后台线程按INDEX_COMMIT_SECONDS批量写入，每批一个短事务，
+多进程分片的工作进程可以共用同一个索引文件。
+索引丢失或损坏时可以扫描保存目录（包括段文件的偏移索引）重建。
+
+示例：
+    python image_index.py query --device wifitest --since 2024-01-01 --until 2024-01-02
+    python image_index.py rebuild
+"""
+import argparse
+import os
+import re
+import sqlite3
+import threading
+from datetime import datetime
+
+from receiver_log import get_logger
+from segment_store import iter_entries, location
+
+INDEX_FILENAME = "index.sqlite3"  # 索引文件名，位于图片保存目录下
+INDEX_COMMIT_SECONDS = 1  # 批量写入的间隔（秒），避免每张图片一个事务
+INDEX_BUSY_TIMEOUT = 10  # 多进程同时写入时等待锁的时间（秒）
+
+# 图片文件名: image_{device_id}_{image_id}_{保存时间}.jpg
+FILENAME_PATTERN = re.compile(r'^image_(.+)_(\d{8}_\d{6})\.jpg$')
+FILENAME_TIME_FORMAT = "%Y%m%d_%H%M%S"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    image_id TEXT PRIMARY KEY,
+    device_id TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    filename TEXT NOT NULL,
+    size INTEGER,
+    md5 TEXT,
+    saved_time REAL
+);
+CREATE INDEX IF NOT EXISTS images_device_time ON images (device_id, timestamp);
+CREATE INDEX IF NOT EXISTS images_time ON images (timestamp);
+CREATE INDEX IF NOT EXISTS images_md5 ON images (md5);
+"""
+
+INSERT_SQL = "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?)"
+
+COLUMNS = ("image_id", "device_id", "timestamp", "filename", "size", "md5", "saved_time")
+
+def parse_filename(name):
+    """从图片文件名解析(image_id, device_id, 保存时间)，不是图片文件时返回None"""
+    match = FILENAME_PATTERN.match(name)
+    if not match:
+        return None
+    image_id = match.group(1)
+    saved_time = datetime.strptime(match.group(2), FILENAME_TIME_FORMAT).timestamp()
+    return image_id, image_id.rsplit('_', 1)[0], saved_time
+
+class ImageIndex:
+    """SQLite图片索引，可在多个线程中使用
+
+    add()只把记录放入内存队列，不访问数据库，可在事件循环和写入线程中直接调用；
+    后台线程每INDEX_COMMIT_SECONDS把队列中的记录在一个短事务中写入并立即提交，
+    调用之间不保留未提交的写事务，多进程共用同一个索引文件时各进程只在写入的瞬间持有写锁。
+    读取使用单独的连接，WAL模式下不会被写入阻塞。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()  # 保护待写入队列
+        self.write_lock = threading.Lock()  # 写连接
+        self.read_lock = threading.Lock()  # 读连接
+        self.conn = sqlite3.connect(path, timeout=INDEX_BUSY_TIMEOUT, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.reader = sqlite3.connect(path, timeout=INDEX_BUSY_TIMEOUT, check_same_thread=False)
+        self.pending = []  # 等待写入的记录
+        self.pending_md5 = {}  # 等待写入的记录的MD5 -> 保存位置，写入前也能用于去重
+        self.closed = False
+        self.stopped = threading.Event()
+        self.logger = get_logger("index")
+        self.committer = threading.Thread(target=self._commit_loop, daemon=True)
+        self.committer.start()
+
+    def add(self, image_id, record):
+        """记录一张已保存的图片，record包含device_id、timestamp、filename、size、md5、saved_time"""
+        row = (image_id, record['device_id'], record['timestamp'], record['filename'],
+               record.get('size'), record.get('md5'), record.get('saved_time'))
+        with self.lock:
+            if self.closed:
+                return
+            self.pending.append(row)
+            if row[5] is not None:
+                self.pending_md5[row[5]] = row[3]
+
+    def get(self, image_id):
+        """按image_id查询，不存在时返回None"""
+        with self.read_lock:
+            row = self.reader.execute("SELECT * FROM images WHERE image_id = ?",
+                                      (image_id,)).fetchone()
+        return dict(zip(COLUMNS, row)) if row else None
+
+    def find_md5(self, md5):
+        """按MD5查找最近保存的同内容图片，返回保存位置，不存在时返回None
+
+        用于存储去重；其他进程写入的记录提交后（最多INDEX_COMMIT_SECONDS）才能查到
+        """
+        with self.lock:
+            if self.closed:
+                return None
+            filename = self.pending_md5.get(md5)
+        if filename is not None:
+            return filename
+        with self.read_lock:
+            row = self.reader.execute(
+                "SELECT filename FROM images WHERE md5 = ? ORDER BY saved_time DESC LIMIT 1",
+                (md5,)).fetchone()
+        return row[0] if row else None
+
+    def query(self, device_id=None, start=None, end=None, limit=None):
+        """按设备和时间范围[start, end)查询，按时间排序"""
+        conditions, params = [], []
+        if device_id is not None:
+            conditions.append("device_id = ?")
+            params.append(device_id)
+        if start is not None:
+            conditions.append("timestamp >= ?")
+            params.append(start)
+        if end is not None:
+            conditions.append("timestamp < ?")
+            params.append(end)
+
+        sql = "SELECT * FROM images"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY timestamp"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+
+        with self.read_lock:
+            rows = self.reader.execute(sql, params).fetchall()
+        return [dict(zip(COLUMNS, row)) for row in rows]
+
+    def count(self):
+        """索引中的图片数（不含尚未写入的记录）"""
+        with self.read_lock:
+            return self.reader.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+    def rebuild(self, save_dir):
+        """清空索引并扫描保存目录重建，返回图片数
+
+        文件名中只有保存时间，重建后的timestamp为保存时间而非拍照时间，md5为空；
+        段文件中的图片从段索引重建，同样使用保存时间
+        """
+        rows = []
+        for dirpath, _, filenames in os.walk(save_dir):
+            for name in filenames:
+                parsed = parse_filename(name)
+                if parsed is None:
+                    continue
+                image_id, device_id, saved_time = parsed
+                path = os.path.join(dirpath, name)
+                rows.append((image_id, device_id, saved_time, path,
+                             os.path.getsize(path), None, saved_time))
+        for path, entry in iter_entries(save_dir):
+            if entry['kind'] != "image":
+                continue
+            rows.append((entry['image_id'], entry['device_id'], entry['timestamp'],
+                         location(path, entry['offset'], entry['size']),
+                         entry['size'], entry['md5'], entry['timestamp']))
+
+        with self.write_lock:
+            with self.conn:
+                self.conn.execute("DELETE FROM images")
+                self.conn.executemany(INSERT_SQL, rows)
+        return len(rows)
+
+    def flush(self):
+        """立即写入队列中的记录"""
+        with self.lock:
+            rows, self.pending = self.pending, []
+        if not rows:
+            return
+        try:
+            with self.write_lock:
+                with self.conn:
+                    self.conn.executemany(INSERT_SQL, rows)
+        except sqlite3.Error:
+            # 放回队列，下次再写
+            with self.lock:
+                self.pending[:0] = rows
+            raise
+
+        with self.lock:
+            for row in rows:
+                if row[5] is not None and self.pending_md5.get(row[5]) == row[3]:
+                    del self.pending_md5[row[5]]
+
+    def close(self):
+        """写入剩余记录并关闭索引"""
+        self.stopped.set()
+        self.committer.join()
+        try:
+            self.flush()
+        finally:
+            with self.lock:
+                self.closed = True
+                self.pending_md5.clear()
+            with self.write_lock:
+                self.conn.close()
+            with self.read_lock:
+                self.reader.close()
+
+    def _commit_loop(self):
+        """定期写入队列中的记录"""
+        while not self.stopped.wait(INDEX_COMMIT_SECONDS):
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                self.logger.warning(f"⚠️ 写入图片索引失败，稍后重试: {e}")
+
+def parse_time(value):
+    """解析命令行中的时间：Unix时间戳或ISO格式日期时间"""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+def main():
+    """命令行查询和重建索引"""
+    from windows_receiver import SAVE_DIR
+
+    parser = argparse.ArgumentParser(description="已保存图片的索引")
+    parser.add_argument("--dir", default=SAVE_DIR, help="图片保存目录")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    query = commands.add_parser("query", help="按设备和时间范围查询")
+    query.add_argument("--device", help="设备ID")
+    query.add_argument("--since", type=parse_time, help="开始时间（含），时间戳或ISO格式")
+    query.add_argument("--until", type=parse_time, help="结束时间（不含），时间戳或ISO格式")
+    query.add_argument("--limit", type=int, help="最多返回的图片数")
+
+    commands.add_parser("rebuild", help="扫描保存目录重建索引")
+    args = parser.parse_args()
+
+    index = ImageIndex(os.path.join(args.dir, INDEX_FILENAME))
+    try:
+        if args.command == "rebuild":
+            count = index.rebuild(args.dir)
+            print(f"✅ 索引重建完成，共 {count} 张图片")
+        else:
+            for record in index.query(args.device, args.since, args.until, args.limit):
+                captured = datetime.fromtimestamp(record['timestamp']).strftime("%Y-%m-%d %H:%M:%S")
+                print(f"{captured}  {record['device_id']}  {record['size']} 字节  {record['filename']}")
+    finally:
+        index.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+"""接收端图片存储
+
+接收器通过ImageStore接口保存图片，可按需要替换存储方式：
+- flat: 所有图片保存在同一目录（旧版本的布局）
+- sharded: 按 日期/设备 分子目录保存，并按MD5去重，相同内容的图片只保存一份
+- segment: 追加写入大的段文件，适合高帧率，见segment_store.py
+
+文件先写入临时文件再重命名，读取方不会看到写了一半的图片；
+fsync按批进行，写入线程每FSYNC_BATCH张同步一次，后台线程每FSYNC_INTERVAL秒同步一次，
+没有新图片时最近一批也会及时落盘。重命名在同步之前，
+断电时最近一批尚未同步的图片可能丢失，或文件存在但为空、不完整（此时设备可能已收到确认）；
+去重时长度与新图片不一致的已保存文件视为不存在，会重新保存。
+
+去重先查内存中最近图片的MD5，查不到时再查图片索引（见set_digest_lookup），
+接收端重启后或多进程分片时其他工作进程保存过的图片也不会重复保存。
+"""
+import os
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+TMP_SUFFIX = ".tmp"
+FSYNC_BATCH = 32  # 累计多少张图片后同步到磁盘
+FSYNC_INTERVAL = 1  # 后台线程的同步间隔（秒）
+DEDUP_CACHE_SIZE = 10000  # 用于去重的最近图片MD5数量
+
+SAFE_NAME_PATTERN = re.compile(r'[^A-Za-z0-9_.-]')
+
+def safe_name(name):
+    """把设备ID、图片ID转换为安全的文件名，避免路径穿越"""
+    return SAFE_NAME_PATTERN.sub('_', str(name)).lstrip('.') or '_'
+
+def saved_size(filename):
+    """已保存图片文件的长度，不存在时返回None
+
+    断电时尚未同步的文件可能为空或不完整，去重前用长度确认文件完整
+    """
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return None
+
+class RecentDigests:
+    """最近保存图片的MD5 -> 保存位置，用于去重
+
+    lookup(md5)用于查询持久的索引，内存中没有记录时调用，返回保存位置或None。
+    """
+
+    def __init__(self, size=DEDUP_CACHE_SIZE, lookup=None):
+        self.size = size
+        self.lookup = lookup
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, md5):
+        with self.lock:
+            location = self.items.get(md5)
+            if location is not None:
+                self.items.move_to_end(md5)
+                return location
+        if self.lookup is None:
+            return None
+
+        location = self.lookup(md5)
+        if location is not None:
+            self.add(md5, location)
+        return location
+
+    def add(self, md5, location):
+        with self.lock:
+            self.items[md5] = location
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+class ImageStore:
+    """图片存储接口，实现需支持多个写入线程同时调用"""
+
+    dedup = False  # 是否按MD5去重，不去重时save的md5参数可能为None
+
+    def save(self, image_id, device_id, data, md5):
+        """保存校验通过的图片，返回(文件名, 是否与已保存的图片内容相同)"""
+        raise NotImplementedError
+
+    def save_partial(self, image_id, device_id, data):
+        """保存超时图片已收到的部分，返回文件名"""
+        raise NotImplementedError
+
+    def set_digest_lookup(self, lookup):
+        """设置去重时查询持久索引的函数lookup(md5)，返回已保存图片的位置或None"""
+
+    def flush(self):
+        """把已保存的图片同步到磁盘"""
+
+    def close(self):
+        """同步并关闭存储"""
+        self.stop_flushing()
+        self.flush()
+
+    def start_flushing(self):
+        """启动每FSYNC_INTERVAL秒同步一次的后台线程"""
+        self.stopped = threading.Event()
+        self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self.flusher.start()
+
+    def stop_flushing(self):
+        """停止后台同步线程"""
+        flusher = getattr(self, 'flusher', None)
+        if flusher is not None:
+            self.stopped.set()
+            flusher.join()
+            self.flusher = None
+
+    def _flush_loop(self):
+        """定期同步，没有新图片时最近一批也会落盘"""
+        while not self.stopped.wait(FSYNC_INTERVAL):
+            try:
+                self.flush()
+            except OSError:
+                # 同步失败不影响接收，下一批的同步或关闭存储时会再次暴露磁盘错误
+                pass
+
+class FileImageStore(ImageStore):
+    """每张图片一个文件，写入临时文件后重命名、批量同步、可选按MD5去重"""
+
+    def __init__(self, save_dir, dedup=False):
+        self.save_dir = save_dir
+        self.dedup = dedup
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.recent = RecentDigests()
+        self.unsynced = []  # 已重命名但尚未fsync的文件
+        self.dirs = set()  # 已创建的目录
+        self.start_flushing()
+
+    def set_digest_lookup(self, lookup):
+        self.recent.lookup = lookup
+
+    def directory(self, device_id):
+        """图片所在目录"""
+        return self.save_dir
+
+    def path(self, prefix, image_id, device_id):
+        """新图片的文件路径"""
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        return os.path.join(self.directory(device_id), f"{prefix}_{safe_name(image_id)}_{timestamp}.jpg")
+
+    def save(self, image_id, device_id, data, md5):
+        if self.dedup:
+            existing = self.recent.get(md5)
+            if existing is not None and saved_size(existing) == len(data):
+                return existing, True
+
+        filename = self.path("image", image_id, device_id)
+        self.write(filename, data)
+
+        if self.dedup:
+            self.recent.add(md5, filename)
+        return filename, False
+
+    def save_partial(self, image_id, device_id, data):
+        filename = self.path("partial", image_id, device_id)
+        self.write(filename, data)
+        return filename
+
+    def write(self, filename, data):
+        """写入临时文件后重命名，按批同步"""
+        directory = os.path.dirname(filename)
+        if directory not in self.dirs:
+            os.makedirs(directory, exist_ok=True)
+            self.dirs.add(directory)
+
+        tmp = filename + TMP_SUFFIX
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, filename)
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+        with self.lock:
+            self.unsynced.append(filename)
+            due = len(self.unsynced) >= FSYNC_BATCH
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.sync_lock:
+            with self.lock:
+                files, self.unsynced = self.unsynced, []
+
+            directories = set()
+            for filename in files:
+                try:
+                    fd = os.open(filename, os.O_RDWR)
+                except OSError:
+                    continue
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                directories.add(os.path.dirname(filename))
+
+            # 同步目录项，确保重命名已落盘（Windows不支持打开目录）
+            if os.name != 'nt':
+                for directory in directories:
+                    try:
+                        fd = os.open(directory, os.O_RDONLY)
+                    except OSError:
+                        continue
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+
+class FlatImageStore(FileImageStore):
+    """所有图片保存在同一目录"""
+
+class ShardedImageStore(FileImageStore):
+    """按 保存目录/日期/设备/ 分目录保存，按MD5去重"""
+
+    def __init__(self, save_dir, dedup=True):
+        super().__init__(save_dir, dedup)
+
+    def directory(self, device_id):
+        return os.path.join(self.save_dir, datetime.now().strftime("%Y-%m-%d"), safe_name(device_id))
+
+STORE_BACKENDS = ("sharded", "flat", "segment")
+
+def create_store(backend, save_dir):
+    """按名称创建存储"""
+    if backend == "sharded":
+        return ShardedImageStore(save_dir)
+    if backend == "flat":
+        return FlatImageStore(save_dir)
+    if backend == "segment":
+        # segment_store依赖本模块，在这里导入避免循环导入
+        from segment_store import SegmentImageStore
+        return SegmentImageStore(save_dir)
+    raise ValueError(f"未知的存储方式: {backend}，可选: {', '.join(STORE_BACKENDS)}")
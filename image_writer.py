@@ -0,0 +1,61 @@
+"""图片落盘线程池
+
+MQTT回调线程只负责记录数据块，接收完成的图片交给线程池校验和保存，
+避免磁盘写入阻塞所有设备的数据接收。
+"""
+import queue
+import threading
+
+class ImageWriterPool:
+    """有界队列 + 固定数量的写入线程"""
+
+    def __init__(self, handler, workers=2, queue_size=32, log=print):
+        self.handler = handler  # 处理函数，参数为提交的任务
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.log = log
+        self.threads = []
+
+    def start(self):
+        """启动写入线程"""
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"image-writer-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, job, timeout=None):
+        """提交任务，队列已满且超时返回False"""
+        try:
+            self.queue.put(job, timeout=timeout)
+            return True
+        except queue.Full:
+            return False
+
+    def pending(self):
+        """队列中等待处理的任务数"""
+        return self.queue.qsize()
+
+    def join(self):
+        """等待队列中的任务全部处理完成"""
+        self.queue.join()
+
+    def stop(self):
+        """处理完剩余任务后停止写入线程"""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def _worker(self):
+        """写入线程主循环"""
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                self.handler(job)
+            except Exception as e:
+                self.log(f"❌ 图片写入任务出错: {e}")
+            finally:
+                self.queue.task_done()
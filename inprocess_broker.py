@@ -0,0 +1,158 @@
+"""进程内MQTT代理
+
+在同一进程内转发消息，无需网络和MQTT服务器，用于测试和压测接收器。
+提供与paho客户端接口兼容的同步客户端，以及供asyncio接收引擎使用的异步客户端。
+"""
+import asyncio
+import threading
+
+def topic_matches(topic_filter, topic):
+    """检查主题是否匹配订阅过滤器（支持+和#通配符）"""
+    filter_parts = topic_filter.split('/')
+    topic_parts = topic.split('/')
+
+    for i, part in enumerate(filter_parts):
+        if part == '#':
+            return True
+        if i >= len(topic_parts):
+            return False
+        if part != '+' and part != topic_parts[i]:
+            return False
+
+    return len(filter_parts) == len(topic_parts)
+
+class InProcessMessage:
+    """与paho.mqtt.client.MQTTMessage字段一致的消息"""
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+class InProcessBroker:
+    """进程内消息代理，发布时同步投递给所有匹配的订阅者"""
+
+    def __init__(self):
+        self.subscriptions = []  # (主题过滤器, 回调)
+        self.lock = threading.Lock()
+        self.published_count = 0
+        self.published_bytes = 0
+
+    def subscribe(self, topic_filter, callback):
+        """订阅主题，回调参数为(topic, payload)"""
+        with self.lock:
+            self.subscriptions.append((topic_filter, callback))
+
+    def unsubscribe_all(self, callback):
+        """取消回调的所有订阅"""
+        with self.lock:
+            self.subscriptions = [(f, cb) for f, cb in self.subscriptions if cb != callback]
+
+    def publish(self, topic, payload):
+        """发布消息"""
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+
+        with self.lock:
+            self.published_count += 1
+            self.published_bytes += len(payload)
+            targets = [cb for f, cb in self.subscriptions if topic_matches(f, topic)]
+
+        for callback in targets:
+            callback(topic, payload)
+
+    def client(self):
+        """创建与paho客户端接口兼容的同步客户端"""
+        return InProcessClient(self)
+
+    def async_client(self):
+        """创建供asyncio接收引擎使用的异步客户端"""
+        return InProcessAsyncClient(self)
+
+class InProcessClient:
+    """与paho.mqtt.client.Client接口兼容的进程内客户端"""
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.on_connect = None
+        self.on_message = None
+        self.on_disconnect = None
+        self.connected = threading.Event()
+        self.stopped = threading.Event()
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def connect(self, host=None, port=None, keepalive=60):
+        self.connected.set()
+        self.stopped.clear()
+        if self.on_connect:
+            self.on_connect(self, None, {}, 0)
+        return 0
+
+    def subscribe(self, topic, qos=0):
+        self.broker.subscribe(topic, self._deliver)
+        return (0, 1)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.broker.publish(topic, payload if payload is not None else b'')
+
+    def _deliver(self, topic, payload):
+        if self.on_message:
+            self.on_message(self, None, InProcessMessage(topic, payload))
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def loop_forever(self):
+        self.stopped.wait()
+
+    def disconnect(self):
+        self.broker.unsubscribe_all(self._deliver)
+        self.connected.clear()
+        self.stopped.set()
+        if self.on_disconnect:
+            self.on_disconnect(self, None, 0)
+
+class InProcessAsyncClient:
+    """进程内异步客户端，接口与async_receiver.AsyncMQTTClient一致"""
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.loop = None
+        self.queue = None
+
+    async def connect(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+
+    async def subscribe(self, topic):
+        self.broker.subscribe(topic, self._deliver)
+
+    async def publish(self, topic, payload):
+        self.broker.publish(topic, payload)
+
+    def _deliver(self, topic, payload):
+        # 发布者可能在其他线程中
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+
+        if running is self.loop:
+            self.queue.put_nowait((topic, payload))
+        else:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, (topic, payload))
+
+    async def messages(self):
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+            yield item
+
+    async def disconnect(self):
+        self.broker.unsubscribe_all(self._deliver)
+        self.queue.put_nowait(None)
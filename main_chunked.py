@@ -1,77 +1,87 @@
-import network
 import time
-from umqtt.simple import MQTTClient
 import json
 import ubinascii
 import hashlib
 import gc
-from camera import Camera, GrabMode, PixelFormat, FrameSize, GainCeiling
+import random
+import device_identity
+import device_stats
+from camera_manager import CameraManager, CapturePipeline, pipeline_available
+from change_detector import ChangeDetector
+from connection_manager import ConnectionManager
+from offline_spool import OfflineSpool
 from config import *
+from chunk_protocol import (PROTOCOL_VERSION, FORMAT_BINARY, FORMAT_JSON, BINARY_HEADER_SIZE,
+                            CHECKSUM_CRC32, CHECKSUM_MD5, crc32, pack_binary_chunk_into)
 
 # 分块传输配置
-CHUNK_SIZE = 3072  # 3KB
+CHUNK_SIZE = 3072  # 初始块大小，关闭自适应分块时为固定块大小
+CHUNK_DELAY = 0.1  # 初始块间隔（秒）
 MAX_CHUNKS_PER_MESSAGE = 1  # 每个MQTT消息只包含一个块
+CHUNK_MEMORY_RATIO = 8  # 块大小不超过空闲内存的1/8，为消息打包和发送留出余量
+GC_INTERVAL = 8  # 每发送多少个块进行一次垃圾回收
 
-def connect_wifi():
-    """连接WiFi"""
-    wlan = network.WLAN(network.STA_IF)
-    wlan.active(True)
-    
-    if not wlan.isconnected():
-        print(f"正在连接到WiFi: {WIFI_SSID}")
-        wlan.connect(WIFI_SSID, WIFI_PASSWORD)
-        
-        max_wait = 10
-        while max_wait > 0:
-            if wlan.isconnected():
-                break
-            max_wait -= 1
-            print("等待WiFi连接...")
-            time.sleep(1)
-        
-        if wlan.isconnected():
-            print(f"WiFi连接成功! IP: {wlan.ifconfig()[0]}")
-            return True
-        else:
-            print("WiFi连接失败!")
-            return False
-    
-    return True
+# 图片ID，每张图片递增，接收端据此区分同一设备的不同图片
+_next_image_id = random.getrandbits(30)
 
-def connect_mqtt():
-    """连接MQTT服务器"""
-    try:
-        client = MQTTClient(MQTT_CLIENT_ID, MQTT_BROKER, port=MQTT_PORT, 
-                           user=MQTT_USERNAME, password=MQTT_PASSWORD)
-        client.connect()
-        print("MQTT连接成功!")
-        return client
-    except Exception as e:
-        print(f"MQTT连接失败: {e}")
-        return None
+# 设备ID（预置或由MAC地址生成），消息发布到该设备的主题命名空间
+_device_id = device_identity.device_id()
 
-def camera_img():
-    """拍照功能"""
-    frame_size_map = {
-        "VGA": FrameSize.VGA,
-        "SVGA": FrameSize.SVGA,
-        "XGA": FrameSize.XGA,
-        "HD": FrameSize.HD,
-        "SXGA": FrameSize.SXGA,
-        "UXGA": FrameSize.UXGA
-    }
+# 控制主题，接收端通过该主题发送确认(ack)和重传请求(nack)
+CONTROL_TOPIC = device_identity.control_topic()
+MAX_CONTROL_MESSAGES = 8  # 缓存的控制消息上限
+_control_messages = []
+
+# 复用的块消息缓冲区，块大小增大时重新分配
+_frame = None
+
+# 接收端在确认中声明支持crc32后，CHECKSUM为auto时改用crc32
+_receiver_crc32 = False
+
+# 接收端是否发送确认和重传请求：None为未知，等待第一张图片的确认后确定；
+# 旧版本接收端不发送确认，之后的图片不再等待，收到任何确认或重传请求后恢复等待
+_receiver_acks = None
+
+class AdaptivePacer:
+    """自适应块大小和块间隔
+    
+    块发送成功时缩短间隔，图片无需重传即被确认时增大块大小；
+    发布出错或收到重传请求时减小块大小并拉长间隔
+    """
+    
+    def __init__(self):
+        self.chunk_size = CHUNK_SIZE
+        self.delay = CHUNK_DELAY
+    
+    def image_chunk_size(self):
+        """本张图片使用的块大小，发送过程中保持不变并记录在信息头中"""
+        if not ADAPTIVE_CHUNKING:
+            return CHUNK_SIZE
+        
+        gc.collect()
+        size = min(self.chunk_size, gc.mem_free() // CHUNK_MEMORY_RATIO)
+        size = max(CHUNK_SIZE_MIN, size)
+        # 取4的倍数，base64文本块才能被接收端逐块解码
+        return size - size % 4
     
-    cam = Camera(pixel_format=PixelFormat.JPEG,
-                 frame_size=frame_size_map.get(CAMERA_FRAME_SIZE, FrameSize.HD),
-                 jpeg_quality=CAMERA_JPEG_QUALITY,
-                 fb_count=CAMERA_FB_COUNT,
-                 grab_mode=GrabMode.LATEST)
+    def chunk_delay(self):
+        """当前块间隔（秒）"""
+        return self.delay if ADAPTIVE_CHUNKING else CHUNK_DELAY
+    
+    def on_chunk_sent(self):
+        """块发布成功"""
+        self.delay = max(CHUNK_DELAY_MIN, self.delay * 0.9)
+    
+    def on_ack(self):
+        """图片无需重传即被接收端确认"""
+        self.chunk_size = min(CHUNK_SIZE_MAX, self.chunk_size + self.chunk_size // 2)
+    
+    def on_error(self):
+        """发布出错或收到重传请求"""
+        self.chunk_size = max(CHUNK_SIZE_MIN, self.chunk_size // 2)
+        self.delay = min(CHUNK_DELAY_MAX, max(self.delay * 2, CHUNK_DELAY_MIN))
 
-    cam.init()
-    time.sleep(2)
-    img = cam.capture()
-    cam.deinit()
-    return bytes(img)
+_pacer = AdaptivePacer()
 
 def calculate_md5(data):
     """计算MD5校验和"""
@@ -79,80 +89,290 @@ def calculate_md5(data):
     md5_hash = hashlib.md5(data).digest()
     return ubinascii.hexlify(md5_hash).decode('utf-8')
 
-def send_image_chunks_via_mqtt(client, image_data):
-    """分块发送图片数据"""
+def checksum_mode():
+    """本张图片使用的校验方式"""
+    if CHECKSUM == "auto":
+        return CHECKSUM_CRC32 if _receiver_crc32 else CHECKSUM_MD5
+    return CHECKSUM_CRC32 if CHECKSUM == CHECKSUM_CRC32 else CHECKSUM_MD5
+
+def image_checksum(image_data, checksum):
+    """整张图片的校验字段，随信息头和完成信号发送"""
+    if checksum == CHECKSUM_CRC32:
+        return {"checksum": checksum, "image_crc32": "%08x" % crc32(image_data)}
+    return {"checksum": checksum, "image_md5": calculate_md5(image_data)}
+
+def next_image_id():
+    """生成下一个图片ID"""
+    global _next_image_id
+    _next_image_id = (_next_image_id + 1) & 0xffffffff
+    return _next_image_id
+
+def on_control_message(topic, msg):
+    """接收端控制消息回调"""
+    global _receiver_acks
     try:
-        # 计算图片的MD5校验和
-        image_md5 = calculate_md5(image_data)
+        message = json.loads(msg)
+    except ValueError:
+        print("⚠️ 无法解析控制消息")
+        return
+    if message.get('type') in ('ack', 'nack'):
+        _receiver_acks = True
+    if len(_control_messages) < MAX_CONTROL_MESSAGES:
+        _control_messages.append(message)
+
+def frame_buffer(size):
+    """返回至少size字节的发送缓冲区"""
+    global _frame
+    if _frame is None or len(_frame) < size:
+        _frame = None
+        gc.collect()
+        _frame = bytearray(size)
+    return _frame
+
+def raw_chunk_size(chunk_size, chunk_format):
+    """每块对应的原始JPEG字节数（JSON格式中chunk_size为base64字符数）"""
+    if chunk_format == FORMAT_BINARY:
+        return chunk_size
+    return chunk_size // 4 * 3
+
+def send_chunk(client, image_view, chunk_format, checksum, image_id, chunk_index, total_chunks, chunk_size):
+    """编码并发送单个数据块
+    
+    直接从图片的memoryview中取出本块数据，编码到复用的发送缓冲区，
+    额外占用的内存不超过一个块
+    """
+    encode_start = device_stats.ticks_ms()
+    raw_size = raw_chunk_size(chunk_size, chunk_format)
+    start_pos = chunk_index * raw_size
+    end_pos = min(start_pos + raw_size, len(image_view))
+    chunk_data = image_view[start_pos:end_pos]
+    
+    if chunk_format == FORMAT_BINARY:
+        frame = frame_buffer(BINARY_HEADER_SIZE + len(_device_id.encode('utf-8')) + chunk_size)
+        length = pack_binary_chunk_into(frame, _device_id, image_id, chunk_index,
+                                        total_chunks, chunk_data)
+    else:
+        # 逐块base64编码，原始块长度为3的倍数，结果与整张图片编码后再切片相同
+        encoded = ubinascii.b2a_base64(chunk_data)
+        chunk_text = memoryview(encoded)[:len(encoded) - 1]  # 去掉末尾换行
+        
+        # 计算当前块的校验值
+        if checksum == CHECKSUM_CRC32:
+            chunk_checksum = '"chunk_crc32": %d' % crc32(chunk_text)
+        else:
+            chunk_checksum = '"chunk_md5": "%s"' % calculate_md5(chunk_text)
         
-        # 使用ubinascii进行base64编码
-        image_base64 = ubinascii.b2a_base64(image_data).decode('utf-8').rstrip('\n')
+        # base64字符无需JSON转义，直接拼接消息
+        prefix = ('{"type": "chunk", "chunk_index": %d, "total_chunks": %d, "chunk_data": "'
+                  % (chunk_index, total_chunks)).encode('utf-8')
+        suffix = ('", %s, "device_id": %s, "image_id": %d, "is_last": %s}'
+                  % (chunk_checksum, json.dumps(_device_id), image_id,
+                     "true" if chunk_index == total_chunks - 1 else "false")).encode('utf-8')
+        
+        length = len(prefix) + len(chunk_text) + len(suffix)
+        frame = frame_buffer(length)
+        frame[:len(prefix)] = prefix
+        frame[len(prefix):len(prefix) + len(chunk_text)] = chunk_text
+        frame[len(prefix) + len(chunk_text):length] = suffix
+    
+    publish_start = device_stats.ticks_ms()
+    device_stats.observe("encode_ms", device_stats.ticks_diff(publish_start, encode_start))
+    
+    client.publish(device_identity.topic("chunk"), memoryview(frame)[:length], qos=IMAGE_QOS)
+    device_stats.observe("publish_ms", device_stats.elapsed_ms(publish_start))
+    device_stats.incr("chunks_sent")
+    device_stats.incr("bytes_sent", length)
+
+def send_completion(client, image_id, checksum_fields, total_chunks):
+    """发送完成信号"""
+    completion_message = {
+        "type": "completion",
+        "timestamp": time.time(),
+        "device_id": _device_id,
+        "image_id": image_id,
+        "total_chunks": total_chunks
+    }
+    completion_message.update(checksum_fields)
+    
+    client.publish(device_identity.topic("completion"), json.dumps(completion_message), qos=IMAGE_QOS)
+
+def send_heartbeat(client, image_size, change, unchanged):
+    """画面无变化时发送心跳，代替上传图片"""
+    heartbeat_message = {
+        "type": "heartbeat",
+        "timestamp": time.time(),
+        "device_id": _device_id,
+        "image_size": image_size,
+        "change": change,
+        "unchanged": unchanged
+    }
+    
+    client.publish(device_identity.topic("heartbeat"), json.dumps(heartbeat_message))
+
+def send_stats(client, gauges):
+    """发布设备统计"""
+    stats_message = device_stats.snapshot(gauges)
+    stats_message["type"] = "stats"
+    stats_message["timestamp"] = time.time()
+    stats_message["device_id"] = _device_id
+    
+    client.publish(device_identity.topic("stats"), json.dumps(stats_message))
+
+def collect_gauges(conn, spool, pipeline):
+    """设备当前状态，随统计一起上报"""
+    gauges = {
+        "mem_free": gc.mem_free(),
+        "chunk_size": _pacer.chunk_size,
+        "chunk_delay_ms": _pacer.chunk_delay() * 1000,
+        "reconnects": conn.reconnects,
+        "in_flight": len(conn.in_flight)
+    }
+    if spool is not None:
+        gauges["spool_images"] = len(spool)
+        gauges["spool_bytes"] = spool.total_bytes
+        gauges["spool_evicted"] = spool.evicted
+    if pipeline is not None:
+        gauges["pipeline_captured"] = pipeline.captured
+        gauges["pipeline_skipped"] = pipeline.skipped
+    return gauges
+
+def wait_for_repair(client, payload, chunk_format, image_id, checksum_fields, total_chunks, chunk_size):
+    """等待接收端确认，按重传请求补发缺失的块
+    
+    返回True表示接收端已确认，False表示重传次数用尽，None表示等待超时（旧版本接收端不发送确认）。
+    本次运行中还没收到过接收端的确认时只等待第一张图片，之后只处理已到达的控制消息，不再等待
+    """
+    global _receiver_crc32, _receiver_acks
+    rounds = 0
+    deadline = time.time() + (0 if _receiver_acks is False else NACK_WAIT_SECONDS)
+    wait_start = device_stats.ticks_ms()
+    
+    while True:
+        client.check_msg()
+        
+        while _control_messages:
+            message = _control_messages.pop(0)
+            if message.get('image_id') != image_id:
+                continue
+            
+            if message.get('type') == 'ack':
+                print("✅ 接收端已确认图片保存成功")
+                device_stats.observe("ack_wait_ms", device_stats.elapsed_ms(wait_start))
+                if rounds == 0:
+                    _pacer.on_ack()
+                if not _receiver_crc32 and CHECKSUM_CRC32 in message.get('checksums', ()):
+                    _receiver_crc32 = True
+                    if CHECKSUM == "auto":
+                        print("✅ 接收端支持CRC32校验，之后的图片改用CRC32")
+                return True
+            
+            if message.get('type') == 'nack':
+                if rounds >= NACK_MAX_ROUNDS:
+                    print(f"❌ 已重传 {rounds} 轮，放弃该图片")
+                    return False
+                
+                rounds += 1
+                device_stats.incr("nack_rounds")
+                _pacer.on_error()
+                missing = [i for i in message.get('missing', []) if 0 <= i < total_chunks]
+                print(f"🔁 第 {rounds} 轮重传，缺失 {len(missing)} 个块")
+                
+                for chunk_index in missing:
+                    send_chunk(client, payload, chunk_format, checksum_fields["checksum"], image_id,
+                               chunk_index, total_chunks, chunk_size)
+                    time.sleep(_pacer.chunk_delay())
+                    gc.collect()
+                
+                send_completion(client, image_id, checksum_fields, total_chunks)
+                deadline = time.time() + NACK_WAIT_SECONDS
+        
+        if time.time() >= deadline:
+            break
+        time.sleep(0.05)
+    
+    if _receiver_acks is False:
+        return None
+    if _receiver_acks is None:
+        # 第一张图片也没有收到确认，按旧版本接收端处理
+        _receiver_acks = False
+        print("⚠️ 接收端未发送确认，之后的图片不再等待确认")
+    else:
+        print("⚠️ 等待接收端确认超时")
+    device_stats.incr("ack_timeouts")
+    return None
+
+def send_image_chunks_via_mqtt(client, image_data, timestamp=None):
+    """分块发送图片数据，timestamp为拍照时间（补发离线缓存的图片时使用）"""
+    try:
+        upload_start = device_stats.ticks_ms()
+        
+        # 计算整张图片的校验值
+        checksum = checksum_mode()
+        checksum_fields = image_checksum(image_data, checksum)
+        device_stats.observe("hash_ms", device_stats.elapsed_ms(upload_start))
+        image_id = next_image_id()
+        
+        # 二进制格式直接发送原始JPEG数据，JSON格式在发送每块时再进行base64编码
+        chunk_format = FORMAT_BINARY if CHUNK_FORMAT == FORMAT_BINARY else FORMAT_JSON
+        payload = memoryview(image_data)
         
         # 计算分块数量
-        total_chunks = (len(image_base64) + CHUNK_SIZE - 1) // CHUNK_SIZE
+        chunk_size = _pacer.image_chunk_size()
+        raw_size = raw_chunk_size(chunk_size, chunk_format)
+        total_chunks = (len(image_data) + raw_size - 1) // raw_size
         
-        print(f"图片大小: {len(image_data)} 字节")
-        print(f"Base64大小: {len(image_base64)} 字符")
-        print(f"总分块数: {total_chunks}")
-        print(f"每块大小: {CHUNK_SIZE} 字符")
+        print(f"图片 {image_id}: {len(image_data)} 字节, {chunk_format}格式, {checksum}校验, {total_chunks} 块 x "
+              f"{chunk_size} {'字节' if chunk_format == FORMAT_BINARY else '字符'}, "
+              f"块间隔 {_pacer.chunk_delay() * 1000:.0f} 毫秒")
         
         # 发送图片信息头
         header_message = {
             "type": "header",
-            "timestamp": time.time(),
-            "device_id": MQTT_CLIENT_ID,
-            "image_md5": image_md5,
+            "version": PROTOCOL_VERSION,
+            "format": chunk_format,
+            "timestamp": timestamp if timestamp is not None else time.time(),
+            "device_id": _device_id,
+            "image_id": image_id,
             "total_chunks": total_chunks,
-            "chunk_size": CHUNK_SIZE,
+            "chunk_size": chunk_size,
             "image_size": len(image_data)
         }
+        header_message.update(checksum_fields)
         
-        client.publish(f"{MQTT_TOPIC}/header", json.dumps(header_message))
-        print("✅ 图片信息头发送成功!")
+        client.publish(device_identity.topic("header"), json.dumps(header_message), qos=IMAGE_QOS)
         
         # 分块发送图片数据
         for chunk_index in range(total_chunks):
-            start_pos = chunk_index * CHUNK_SIZE
-            end_pos = min(start_pos + CHUNK_SIZE, len(image_base64))
-            chunk_data = image_base64[start_pos:end_pos]
+            send_chunk(client, payload, chunk_format, checksum, image_id, chunk_index,
+                       total_chunks, chunk_size)
             
-            # 计算当前块的MD5
-            chunk_md5 = calculate_md5(chunk_data.encode('utf-8'))
+            # 短暂延迟，避免发送过快；间隔随发送结果自适应调整
+            _pacer.on_chunk_sent()
+            time.sleep(_pacer.chunk_delay())
             
-            chunk_message = {
-                "type": "chunk",
-                "chunk_index": chunk_index,
-                "total_chunks": total_chunks,
-                "chunk_data": chunk_data,
-                "chunk_md5": chunk_md5,
-                "device_id": MQTT_CLIENT_ID,
-                "is_last": (chunk_index == total_chunks - 1)
-            }
-            
-            client.publish(f"{MQTT_TOPIC}/chunk", json.dumps(chunk_message))
-            print(f"✅ 块 {chunk_index + 1}/{total_chunks} 发送成功")
-            
-            # 短暂延迟，避免发送过快
-            time.sleep(0.1)
-            
-            # 垃圾回收，释放内存
-            gc.collect()
+            # 定期垃圾回收，释放内存
+            if chunk_index % GC_INTERVAL == GC_INTERVAL - 1:
+                gc.collect()
         
         # 发送完成信号
-        completion_message = {
-            "type": "completion",
-            "timestamp": time.time(),
-            "device_id": MQTT_CLIENT_ID,
-            "image_md5": image_md5,
-            "total_chunks": total_chunks
-        }
+        send_completion(client, image_id, checksum_fields, total_chunks)
+        upload_ms = device_stats.elapsed_ms(upload_start)
+        device_stats.observe("upload_ms", upload_ms)
+        print(f"✅ 图片 {image_id} 的 {total_chunks} 块已发送 (用时 {upload_ms} 毫秒)")
         
-        client.publish(f"{MQTT_TOPIC}/completion", json.dumps(completion_message))
-        print("✅ 图片传输完成信号发送成功!")
+        # 保留本张图片数据，等待接收端确认或补发缺失的块
+        if wait_for_repair(client, payload, chunk_format, image_id,
+                           checksum_fields, total_chunks, chunk_size) is False:
+            device_stats.incr("images_failed")
+            return False
         
+        device_stats.incr("images_sent")
         return True
         
     except Exception as e:
+        # 发布出错，下一张图片使用更小的块和更长的间隔
+        _pacer.on_error()
+        device_stats.incr("images_failed")
         print(f"❌ 发送图片失败: {e}")
         return False
 
@@ -160,42 +380,117 @@ def main():
     """主函数"""
     print("ESP32-S3 Sense 分块传输相机MQTT程序启动")
     
-    # 连接WiFi
-    if not connect_wifi():
-        return
+    # 连接WiFi和MQTT，失败时按指数退避重试
+    # 启用离线缓存时不等待连接成功，启动时网络不可用也先拍照存入闪存，之后在主循环中重连
+    conn = ConnectionManager(on_control_message, [CONTROL_TOPIC])
+    if conn.connect(block=not SPOOL_ENABLED) is None:
+        print("⚠️ 网络暂不可用，先拍照存入离线缓存")
     
-    # 连接MQTT
-    mqtt_client = connect_mqtt()
-    if mqtt_client is None:
-        return
+    # 相机只初始化一次，之后保持常驻
+    camera = CameraManager()
+    print(f"开始拍照... (间隔: {PHOTO_INTERVAL}秒, 每次 {BURST_COUNT} 张)")
+    
+    use_pipeline = PIPELINE and pipeline_available()
+    if PIPELINE and not use_pipeline:
+        print("⚠️ 固件不支持线程，拍照和上传改为顺序进行")
+    
+    if use_pipeline:
+        # 后台线程拍下一张的同时，主线程发送当前这张
+        pipeline = CapturePipeline(camera, PHOTO_INTERVAL, BURST_COUNT, BURST_INTERVAL)
+        pipeline.start()
+        frames = pipeline.frames(conn.service)
+        print("已启用拍照/上传流水线")
+    else:
+        pipeline = None
+        frames = camera.frames(PHOTO_INTERVAL, BURST_COUNT, BURST_INTERVAL, conn.service)
+    
+    detector = ChangeDetector() if CHANGE_DETECTION else None
+    
+    # 断网期间的图片缓存到闪存，恢复连接后补发
+    spool = OfflineSpool() if SPOOL_ENABLED else None
+    
+    def send_spooled(image_data, timestamp):
+        """补发一张缓存的图片"""
+        print(f"\n💾 补发离线缓存的图片 (剩余 {len(spool)} 张)")
+        sent = send_image_chunks_via_mqtt(conn, image_data, timestamp)
+        # 连接正常但接收端多次重传仍失败时也移出缓存，避免一张坏图片阻塞队列
+        return sent or conn.is_connected()
     
     try:
-        while True:
-            print(f"\n开始拍照... (间隔: {PHOTO_INTERVAL}秒)")
+        for image_data in frames:
+            timestamp = time.time()
+            print(f"\n拍照完成，图片大小: {len(image_data)} 字节")
+            
+            # 检查连接，断开时自动重连；启用离线缓存时不等待重连，先把图片存入闪存
+            client = conn.ensure_connected(block=spool is None)
+            
+            # 定期上报设备统计
+            if client is not None and device_stats.due(STATS_INTERVAL):
+                try:
+                    send_stats(conn, collect_gauges(conn, spool, pipeline))
+                except Exception as e:
+                    print(f"❌ 发送统计失败: {e}")
             
-            # 拍照
-            image_data = camera_img()
-            print(f"拍照完成，图片大小: {len(image_data)} 字节")
+            # 画面无明显变化时只发送心跳
+            if detector is not None:
+                changed, change = detector.check(image_data)
+                if not changed:
+                    print(f"画面无变化 (差异 {change * 100:.1f}%)，发送心跳")
+                    device_stats.incr("unchanged_frames")
+                    try:
+                        if client is not None:
+                            send_heartbeat(conn, len(image_data), change, detector.unchanged)
+                    except Exception as e:
+                        print(f"❌ 发送心跳失败: {e}")
+                    image_data = None
+                    continue
+            
+            if client is None:
+                print("⚠️ 网络不可用，图片存入离线缓存")
+                device_stats.incr("spooled")
+                spool.push(image_data, timestamp)
+                image_data = None
+                continue
             
             # 分块发送图片
-            if send_image_chunks_via_mqtt(mqtt_client, image_data):
+            sent = send_image_chunks_via_mqtt(conn, image_data, timestamp)
+            if not sent and not conn.is_connected():
+                if spool is not None:
+                    print("⚠️ 发送过程中连接断开，图片存入离线缓存")
+                    device_stats.incr("spooled")
+                    spool.push(image_data, timestamp)
+                else:
+                    # 发送过程中连接断开，重连后重新发送本张图片
+                    conn.ensure_connected()
+                    sent = send_image_chunks_via_mqtt(conn, image_data, timestamp)
+            
+            if sent:
                 print("图片已成功分块发送到MQTT服务器")
+                if detector is not None:
+                    detector.mark_sent()
             else:
                 print("图片发送失败")
             
-            print(f"等待 {PHOTO_INTERVAL} 秒后再次拍照...")
-            time.sleep(PHOTO_INTERVAL)
+            # 释放本张图片，保证内存中最多同时存在两张
+            image_data = None
+            
+            # 连接正常时限速补发离线缓存的图片
+            if spool is not None and len(spool) and conn.is_connected():
+                spool.drain(send_spooled, SPOOL_DRAIN_BATCH, SPOOL_DRAIN_DELAY)
+            
+            if pipeline is not None:
+                print(f"流水线: 已拍 {pipeline.captured} 张, 跳过 {pipeline.skipped} 张")
             
     except KeyboardInterrupt:
         print("\n程序被用户中断")
     except Exception as e:
         print(f"程序运行出错: {e}")
     finally:
-        try:
-            mqtt_client.disconnect()
-            print("MQTT连接已断开")
-        except:
-            pass
+        if pipeline is not None:
+            pipeline.stop()
+        camera.close()
+        conn.close()
+        print("MQTT连接已断开")
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
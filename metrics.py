@@ -0,0 +1,265 @@
+"""接收端指标统计
+
+提供计数器、仪表和直方图，以Prometheus文本格式通过本地HTTP端点输出，
+用于定位传输、校验、落盘各阶段的耗时，以及设备通过stats主题上报的拍照、编码、发布耗时。
+
+示例：
+    python windows_receiver.py --metrics-port 9108
+    curl http://127.0.0.1:9108/metrics
+"""
+import bisect
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PORT = 9108  # 指标HTTP端口
+METRICS_HOST = "127.0.0.1"  # 只监听本机，需要远程抓取时改为0.0.0.0
+
+# 直方图默认分桶（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def format_value(value):
+    """格式化指标值"""
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(value)
+    return str(value)
+
+def escape_label(value):
+    """转义标签值中的特殊字符"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values, extra=None):
+    """生成{name="value",...}标签文本"""
+    pairs = [f'{n}="{escape_label(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Metric:
+    """指标基类，按标签值分别记录"""
+    type_name = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"指标 {self.name} 的标签应为: {self.label_names}")
+        return tuple(labels[n] for n in self.label_names)
+
+    def get(self, **labels):
+        """读取当前值"""
+        with self.lock:
+            return self.values.get(self._key(labels), 0)
+
+    def render(self):
+        """输出Prometheus文本格式"""
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.type_name}"]
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{format_labels(self.label_names, key)} {format_value(value)}")
+        return lines
+
+class Counter(Metric):
+    """只增不减的计数器"""
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """可增可减的仪表，也可以在输出时调用函数取值"""
+    type_name = "gauge"
+
+    def __init__(self, name, help_text, labels=(), function=None):
+        super().__init__(name, help_text, labels)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def render(self):
+        if self.function is not None:
+            try:
+                self.set(self.function())
+            except Exception:
+                pass
+        return super().render()
+
+class Histogram(Metric):
+    """分桶直方图"""
+    type_name = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def get(self, **labels):
+        """返回(观测次数, 总和)"""
+        with self.lock:
+            state = self.values.get(self._key(labels))
+            return (state[2], state[1]) if state else (0, 0.0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            items = sorted((key, (list(s[0]), s[1], s[2])) for key, s in self.values.items())
+
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = format_labels(self.label_names, key, f'le="{format_value(float(bound))}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.label_names, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+class Registry:
+    """指标集合"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self.register(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=(), function=None):
+        return self.register(Gauge(name, help_text, labels, function))
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help_text, labels, buckets))
+
+    def render(self):
+        """输出全部指标的Prometheus文本"""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+class ReceiverMetrics:
+    """接收器各阶段的指标"""
+
+    def __init__(self, pending=None, writer_queue=None):
+        self.registry = Registry()
+        r = self.registry
+
+        self.messages = r.counter("esp32_messages_total", "按主题统计收到的MQTT消息数", ("topic",))
+        self.bytes_received = r.counter("esp32_received_bytes_total", "收到的MQTT消息字节数")
+        self.messages_rejected = r.counter("esp32_messages_rejected_total", "按原因统计丢弃的消息数",
+                                           ("reason",))
+        self.images_started = r.counter("esp32_images_started_total", "收到信息头的图片数")
+        self.images_completed = r.counter("esp32_images_completed_total", "校验通过并保存的图片数")
+        self.images_failed = r.counter("esp32_images_failed_total", "按原因统计未能保存的图片数",
+                                       ("reason",))
+        self.images_salvaged = r.counter("esp32_images_salvaged_total", "超时后保存了部分数据的图片数")
+        self.images_deduplicated = r.counter("esp32_images_deduplicated_total",
+                                             "内容与已保存图片相同、未重复写入的图片数")
+        self.duplicates = r.counter("esp32_duplicate_chunks_total", "重复收到的数据块数")
+        self.checksum_failures = r.counter("esp32_checksum_failures_total", "校验失败次数",
+                                           ("kind",))
+        self.nacks = r.counter("esp32_nack_requests_total", "发出的重传请求数")
+        self.heartbeats = r.counter("esp32_heartbeats_total", "收到的画面无变化心跳数")
+        self.bytes_written = r.counter("esp32_written_bytes_total", "写入磁盘的图片字节数")
+
+        self.transfer_seconds = r.histogram("esp32_transfer_seconds",
+                                            "从收到信息头到所有块接收完成的时间")
+        self.save_latency_seconds = r.histogram("esp32_save_latency_seconds",
+                                                "从收到信息头到图片落盘的时间")
+        self.write_seconds = r.histogram("esp32_write_seconds", "图片校验和写入文件的耗时")
+
+        self.pending_images = r.gauge("esp32_pending_images", "正在接收的图片数", function=pending)
+        self.writer_queue = r.gauge("esp32_writer_queue", "等待保存的图片数", function=writer_queue)
+        self.device_stats = r.gauge("esp32_device_stat", "设备通过stats主题上报的统计值",
+                                    ("device_id", "stat"))
+
+    def record_device_stats(self, data):
+        """记录设备上报的统计：计数器、仪表直接输出，耗时输出平均值和最大值"""
+        device_id = data['device_id']
+        for name, value in data.get('counters', {}).items():
+            self.device_stats.set(value, device_id=device_id, stat=name)
+        for name, value in data.get('gauges', {}).items():
+            self.device_stats.set(value, device_id=device_id, stat=name)
+        for name, timing in data.get('timings', {}).items():
+            self.device_stats.set(timing.get('avg', 0), device_id=device_id, stat=f"{name}_avg")
+            self.device_stats.set(timing.get('max', 0), device_id=device_id, stat=f"{name}_max")
+
+    def render(self):
+        return self.registry.render()
+
+class MetricsServer:
+    """在后台线程中通过HTTP输出指标"""
+
+    def __init__(self, render, port=METRICS_PORT, host=METRICS_HOST):
+        self.render = render
+        self.port = port
+        self.host = host
+        self.server = None
+
+    def start(self):
+        """启动HTTP服务"""
+        render = self.render
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ("/metrics", "/"):
+                    self.send_error(404)
+                    return
+                body = render().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        """停止HTTP服务"""
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -0,0 +1,167 @@
+"""离线图片缓存（ESP32端）
+
+上行链路不可用时把拍到的图片写入闪存，恢复连接后按拍照顺序限速补发。
+缓存按字节预算组成环形队列，超出预算时淘汰最早的图片。
+每张图片一个文件，文件名包含序号和拍照时间，重启后可从目录恢复队列。
+"""
+import os
+import time
+from config import SPOOL_DIR, SPOOL_MAX_BYTES, SPOOL_MIN_FREE_BYTES
+
+SPOOL_IO_CHUNK = 4096  # 读写闪存的块大小（字节）
+TMP_SUFFIX = ".tmp"
+
+class OfflineSpool:
+    """闪存上的图片环形缓存"""
+
+    def __init__(self, directory=SPOOL_DIR, max_bytes=SPOOL_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = []  # [(序号, 拍照时间, 大小)]，按序号排列
+        self.total_bytes = 0
+        self.evicted = 0
+        self.load()
+
+    def path(self, seq, timestamp):
+        """缓存文件路径"""
+        return f"{self.directory}/{seq:08d}_{timestamp}.jpg"
+
+    def load(self):
+        """扫描缓存目录，恢复重启前未发送的图片"""
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            os.mkdir(self.directory)
+            names = []
+
+        self.entries = []
+        for name in names:
+            if name.endswith(TMP_SUFFIX):
+                # 写入过程中断电留下的临时文件
+                self._remove(f"{self.directory}/{name}")
+                continue
+            if not name.endswith(".jpg"):
+                continue
+            try:
+                seq, timestamp = name[:-4].split("_")
+                seq, timestamp = int(seq), int(timestamp)
+                size = os.stat(f"{self.directory}/{name}")[6]
+            except (ValueError, OSError):
+                continue
+            self.entries.append((seq, timestamp, size))
+
+        self.entries.sort()
+        self.total_bytes = sum(entry[2] for entry in self.entries)
+        if self.entries:
+            print(f"💾 离线缓存中有 {len(self.entries)} 张图片待发送 ({self.total_bytes} 字节)")
+
+    def __len__(self):
+        return len(self.entries)
+
+    def free_bytes(self):
+        """闪存剩余空间（字节），无法获取时返回None"""
+        try:
+            stat = os.statvfs(self.directory)
+            return stat[0] * stat[4]
+        except (AttributeError, OSError):
+            return None
+
+    def push(self, image_data, timestamp):
+        """缓存一张图片，超出字节预算时淘汰最早的图片"""
+        size = len(image_data)
+        if size > self.max_bytes:
+            print("⚠️ 图片超过离线缓存预算，丢弃")
+            return False
+
+        while self.entries and (self.total_bytes + size > self.max_bytes or
+                                not self._has_room(size)):
+            self._evict_oldest()
+
+        seq = self.entries[-1][0] + 1 if self.entries else 0
+        timestamp = int(timestamp)
+        path = self.path(seq, timestamp)
+
+        # 分块写入临时文件后重命名，断电不会留下不完整的图片
+        view = memoryview(image_data)
+        try:
+            with open(path + TMP_SUFFIX, "wb") as f:
+                for pos in range(0, size, SPOOL_IO_CHUNK):
+                    f.write(view[pos:pos + SPOOL_IO_CHUNK])
+            os.rename(path + TMP_SUFFIX, path)
+        except OSError as e:
+            print(f"❌ 写入离线缓存失败: {e}")
+            self._remove(path + TMP_SUFFIX)
+            return False
+
+        self.entries.append((seq, timestamp, size))
+        self.total_bytes += size
+        print(f"💾 已缓存到闪存 ({len(self.entries)} 张, {self.total_bytes} 字节)")
+        return True
+
+    def peek(self):
+        """读取最早的一张图片，返回(图片数据, 拍照时间)，缓存为空时返回None"""
+        if not self.entries:
+            return None
+
+        seq, timestamp, size = self.entries[0]
+        image_data = bytearray(size)
+        view = memoryview(image_data)
+        try:
+            with open(self.path(seq, timestamp), "rb") as f:
+                pos = 0
+                while pos < size:
+                    count = f.readinto(view[pos:pos + SPOOL_IO_CHUNK])
+                    if not count:
+                        raise OSError("缓存文件不完整")
+                    pos += count
+        except OSError as e:
+            print(f"❌ 读取离线缓存失败，丢弃: {e}")
+            self.pop()
+            return None
+
+        return image_data, timestamp
+
+    def pop(self):
+        """删除最早的一张图片"""
+        if not self.entries:
+            return
+        seq, timestamp, size = self.entries.pop(0)
+        self.total_bytes -= size
+        self._remove(self.path(seq, timestamp))
+
+    def drain(self, send, max_images, delay):
+        """按拍照顺序补发缓存的图片，每次最多max_images张，图片之间间隔delay秒
+
+        send(image_data, timestamp)返回是否发送成功；发送失败时停止补发，图片保留在缓存中
+        """
+        sent = 0
+        while self.entries and sent < max_images:
+            if sent and delay:
+                time.sleep(delay)
+
+            item = self.peek()
+            if item is None:
+                continue
+
+            if not send(*item):
+                return sent
+            item = None
+            self.pop()
+            sent += 1
+
+        return sent
+
+    def _has_room(self, size):
+        free = self.free_bytes()
+        return free is None or free - size >= SPOOL_MIN_FREE_BYTES
+
+    def _evict_oldest(self):
+        print("⚠️ 离线缓存已满，淘汰最早的图片")
+        self.pop()
+        self.evicted += 1
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,108 @@
+"""图片重组缓冲区
+
+按图片信息头中的image_size和chunk_size预分配缓冲区，
+每个块到达时直接解码写入对应位置，接收完成后即为连续的完整图片，
+无需拼接和二次解码。
+
+整张图片的校验值随块的到达增量计算：从第一块开始连续收到的部分立即计入，
+乱序到达的块在前面的块补齐后计入，每个字节只计算一次，接收完成时校验值已经就绪。
+设备使用crc32校验时计算CRC32；MD5只在设备使用md5校验或存储需要按MD5去重时计算。
+"""
+import binascii
+import hashlib
+
+from chunk_protocol import FORMAT_BINARY, CHECKSUM_CRC32, CHECKSUM_MD5, CHECKSUMS, crc32
+
+class ImageAssembler:
+    """单张图片的预分配重组缓冲区"""
+
+    def __init__(self, image_size, chunk_size, total_chunks, chunk_format, checksum=CHECKSUM_MD5,
+                 md5=True):
+        """md5为False且使用crc32校验时不计算MD5，image_md5()返回None"""
+        if checksum not in CHECKSUMS:
+            raise ValueError(f"不支持的校验方式: {checksum}")
+
+        if chunk_format == FORMAT_BINARY:
+            # 二进制块为原始数据
+            self.raw_chunk_size = chunk_size
+        else:
+            # base64每4个字符对应3个字节，块大小为4的倍数时每块可以独立解码
+            if chunk_size % 4 != 0:
+                raise ValueError(f"JSON块大小必须是4的倍数: {chunk_size}")
+            self.raw_chunk_size = chunk_size // 4 * 3
+
+        expected_chunks = (image_size + self.raw_chunk_size - 1) // self.raw_chunk_size
+        if total_chunks != expected_chunks:
+            raise ValueError(f"总分块数与图片大小不符: {total_chunks} != {expected_chunks}")
+
+        self.image_size = image_size
+        self.total_chunks = total_chunks
+        self.chunk_format = chunk_format
+        self.buffer = bytearray(image_size)
+        self.view = memoryview(self.buffer)
+        self.bitmap = bytearray((total_chunks + 7) // 8)
+        self.received_chunks = 0
+        self.hashed_chunks = 0  # 已计入校验值的连续块数
+        self.md5 = hashlib.md5() if md5 or checksum == CHECKSUM_MD5 else None
+        self.crc = 0 if checksum == CHECKSUM_CRC32 else None
+
+    def has_chunk(self, chunk_index):
+        """检查块是否已接收"""
+        return bool(self.bitmap[chunk_index >> 3] & (1 << (chunk_index & 7)))
+
+    def add_chunk(self, chunk_index, chunk_data):
+        """将块数据写入缓冲区对应位置，返回是否为新块"""
+        if not 0 <= chunk_index < self.total_chunks:
+            raise ValueError(f"块索引越界: {chunk_index}")
+
+        if self.has_chunk(chunk_index):
+            return False
+
+        if self.chunk_format != FORMAT_BINARY:
+            # 最后一块可能缺少padding
+            padding = -len(chunk_data) % 4
+            chunk_data = binascii.a2b_base64(chunk_data + '=' * padding)
+
+        start = chunk_index * self.raw_chunk_size
+        end = min(start + self.raw_chunk_size, self.image_size)
+        if len(chunk_data) != end - start:
+            raise ValueError(f"块 {chunk_index} 长度错误: {len(chunk_data)} != {end - start}")
+
+        self.view[start:end] = chunk_data
+        self.bitmap[chunk_index >> 3] |= 1 << (chunk_index & 7)
+        self.received_chunks += 1
+        self.update_digest()
+        return True
+
+    def update_digest(self):
+        """把从第一块开始连续收到、尚未计入的块计入整张图片的校验值"""
+        while self.hashed_chunks < self.total_chunks and self.has_chunk(self.hashed_chunks):
+            start = self.hashed_chunks * self.raw_chunk_size
+            data = self.view[start:min(start + self.raw_chunk_size, self.image_size)]
+            if self.md5 is not None:
+                self.md5.update(data)
+            if self.crc is not None:
+                self.crc = crc32(data, self.crc)
+            self.hashed_chunks += 1
+
+    def image_md5(self):
+        """整张图片的MD5（十六进制），需在接收完成后调用，未计算MD5时返回None"""
+        if self.md5 is None:
+            return None
+        return self.md5.hexdigest()
+
+    def image_crc32(self):
+        """整张图片的CRC32（8位十六进制），需在接收完成后调用"""
+        return "%08x" % self.crc
+
+    def is_complete(self):
+        """检查是否所有块都已接收"""
+        return self.received_chunks == self.total_chunks
+
+    def contiguous_bytes(self):
+        """从第一块开始连续接收的字节数"""
+        return min(self.hashed_chunks * self.raw_chunk_size, self.image_size)
+
+    def missing_chunks(self):
+        """返回缺失的块索引列表"""
+        return [i for i in range(self.total_chunks) if not self.has_chunk(i)]
@@ -0,0 +1,96 @@
+"""接收端日志
+
+各接收器通过logging输出分级日志：逐条消息、逐块的明细为DEBUG级别，
+每张图片保存时输出一行汇总(INFO)，警告和错误分别为WARNING、ERROR。
+INFO及以下的输出经过限速，突发的大量日志会被丢弃，并在下一条日志后注明省略的条数；
+警告和错误不限速，也不占用限速额度。
+GUI通过有界队列接收日志，由Tk主循环定时批量取出，不在接收线程中操作界面。
+
+示例：
+    python windows_receiver.py --log-level DEBUG
+"""
+import logging
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler
+
+LOGGER_NAME = "esp32"
+LOG_LEVEL = "INFO"  # 默认日志级别
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
+LOG_RATE_LIMIT = 50  # 每秒平均最多输出的日志条数，0为不限速
+LOG_RATE_BURST = 200  # 允许的突发日志条数
+LOG_QUEUE_SIZE = 10000  # GUI日志队列长度，队列满时丢弃新日志
+
+def get_logger(name=None):
+    """获取接收端的logger"""
+    return logging.getLogger(LOGGER_NAME if name is None else f"{LOGGER_NAME}.{name}")
+
+class RateLimitFilter(logging.Filter):
+    """令牌桶限速，超出速率的日志被丢弃并计数，WARNING及以上级别的日志总是输出"""
+
+    def __init__(self, rate=LOG_RATE_LIMIT, burst=LOG_RATE_BURST):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+            if record.levelno < logging.WARNING:
+                if self.tokens < 1:
+                    self.suppressed += 1
+                    return False
+                self.tokens -= 1
+            suppressed, self.suppressed = self.suppressed, 0
+
+        if suppressed:
+            record.msg = f"{record.getMessage()} (期间省略 {suppressed} 条日志)"
+            record.args = None
+        return True
+
+class BoundedQueueHandler(QueueHandler):
+    """写入有界队列的日志处理器，队列满时丢弃日志而不阻塞接收线程"""
+
+    def __init__(self, maxsize=LOG_QUEUE_SIZE):
+        super().__init__(queue.Queue(maxsize))
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def drain(self, limit):
+        """取出最多limit条日志"""
+        records = []
+        while len(records) < limit:
+            try:
+                records.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return records
+
+def setup_logging(level=LOG_LEVEL, handler=None, rate_limit=LOG_RATE_LIMIT):
+    """配置接收端日志，未指定handler时输出到控制台"""
+    if handler is None:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+    if rate_limit:
+        handler.addFilter(RateLimitFilter(rate_limit))
+
+    logger = get_logger()
+    for old in list(logger.handlers):
+        logger.removeHandler(old)
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+    return handler
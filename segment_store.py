@@ -0,0 +1,321 @@
+"""段文件图片存储
+
+高帧率时每张图片一个文件会产生大量小文件，文件系统的inode、元数据同步和备份开销都随文件数增长。
+段文件存储把图片依次追加到较大的段文件(seg_*.dat)中，每个段文件有一个同名的偏移索引(seg_*.idx)，
+每行一条JSON记录: image_id、device_id、保存时间、偏移、长度、MD5、类型(image/partial)。
+段文件超过SEGMENT_MAX_BYTES后切换到新段，每次启动也从新段开始，已写完的段不再修改。
+
+读取时通过mmap映射段文件，返回memoryview切片，不复制图片数据。
+接收器中图片的位置记为 "段文件路径:偏移:长度"。
+
+示例：
+    python windows_receiver.py --store segment
+    python segment_store.py list --device wifitest --since 2024-01-01
+    python segment_store.py extract wifitest_1700000000 -o image.jpg
+    python segment_store.py export --since 2024-01-01 --until 2024-01-02 -o exported
+"""
+import argparse
+import json
+import mmap
+import os
+import threading
+import time
+from datetime import datetime
+
+from image_store import ImageStore, RecentDigests, safe_name, saved_size, FSYNC_BATCH
+
+SEGMENT_DIR = "segments"  # 段文件目录，位于图片保存目录下
+SEGMENT_MAX_BYTES = 256 * 1024 * 1024  # 单个段文件的最大字节数
+DATA_SUFFIX = ".dat"
+INDEX_SUFFIX = ".idx"
+
+def location(path, offset, size):
+    """图片在段文件中的位置"""
+    return f"{path}:{offset}:{size}"
+
+def parse_location(value):
+    """解析位置，返回(段文件路径, 偏移, 长度)，不是段文件位置时返回None"""
+    parts = value.rsplit(':', 2)
+    if len(parts) != 3 or not parts[0].endswith(DATA_SUFFIX):
+        return None
+    try:
+        return parts[0], int(parts[1]), int(parts[2])
+    except ValueError:
+        return None
+
+def stored(value, size):
+    """保存位置上是否有完整的size字节图片数据
+
+    位置可以是段文件位置或单独的图片文件（切换存储方式前保存的），
+    断电时尚未同步的数据可能不完整，不完整时视为不存在
+    """
+    parsed = parse_location(value)
+    if parsed is None:
+        return saved_size(value) == size
+    path, offset, length = parsed
+    file_size = saved_size(path)
+    return length == size and file_size is not None and file_size >= offset + length
+
+class SegmentImageStore(ImageStore):
+    """把图片追加写入滚动的段文件，按MD5去重"""
+
+    def __init__(self, save_dir, dedup=True, max_bytes=SEGMENT_MAX_BYTES):
+        self.directory = os.path.join(save_dir, SEGMENT_DIR)
+        self.dedup = dedup
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.recent = RecentDigests()
+        self.data_file = None
+        self.index_file = None
+        self.unsynced = 0  # 上次同步后写入的图片数
+        os.makedirs(self.directory, exist_ok=True)
+        self.start_flushing()
+
+    def set_digest_lookup(self, lookup):
+        self.recent.lookup = lookup
+
+    def save(self, image_id, device_id, data, md5):
+        if self.dedup:
+            existing = self.recent.get(md5)
+            if existing is not None and stored(existing, len(data)):
+                return existing, True
+
+        result = self.append("image", image_id, device_id, data, md5)
+        if self.dedup:
+            self.recent.add(md5, result)
+        return result, False
+
+    def save_partial(self, image_id, device_id, data):
+        return self.append("partial", image_id, device_id, data, None)
+
+    def append(self, kind, image_id, device_id, data, md5):
+        """追加一张图片和它的索引记录，返回位置"""
+        with self.lock:
+            if self.data_file is None or (self.data_file.tell() > 0 and
+                                          self.data_file.tell() + len(data) > self.max_bytes):
+                self._roll()
+
+            offset = self.data_file.tell()
+            self.data_file.write(data)
+            # 索引记录写在数据之后，崩溃时索引不会指向不存在的数据
+            entry = {
+                "image_id": image_id,
+                "device_id": device_id,
+                "timestamp": time.time(),
+                "offset": offset,
+                "size": len(data),
+                "md5": md5,
+                "kind": kind
+            }
+            self.index_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            # 写入后立即对读取方可见，只有fsync按批进行
+            self.index_file.flush()
+
+            self.unsynced += 1
+            due = self.unsynced >= FSYNC_BATCH
+            result = location(self.data_file.name, offset, len(data))
+        if due:
+            self.flush()
+        return result
+
+    def _roll(self):
+        """同步并关闭当前段，打开新段，需持有self.lock"""
+        if self.data_file is not None:
+            self._sync(self.data_file, self.index_file)
+            self.data_file.close()
+            self.index_file.close()
+
+        name = f"seg_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.getpid()}"
+        sequence = 0
+        while os.path.exists(os.path.join(self.directory, f"{name}_{sequence:04d}{DATA_SUFFIX}")):
+            sequence += 1
+        base = os.path.join(self.directory, f"{name}_{sequence:04d}")
+        self.data_file = open(base + DATA_SUFFIX, 'ab', buffering=0)
+        self.index_file = open(base + INDEX_SUFFIX, 'a', encoding='utf-8')
+
+    def _sync(self, data_file, index_file):
+        # 先同步数据再同步索引
+        os.fsync(data_file.fileno())
+        os.fsync(index_file.fileno())
+
+    def flush(self):
+        with self.sync_lock:
+            with self.lock:
+                if self.data_file is None or self.unsynced == 0:
+                    return
+                data_file, index_file = self.data_file, self.index_file
+                self.unsynced = 0
+            try:
+                # fsync不持有写入锁，同步期间其他线程可以继续追加
+                os.fsync(data_file.fileno())
+                os.fsync(index_file.fileno())
+            except (OSError, ValueError):
+                # 段已被切换关闭，关闭前已经同步过
+                pass
+
+    def close(self):
+        self.stop_flushing()
+        with self.sync_lock:
+            with self.lock:
+                if self.data_file is not None:
+                    self._sync(self.data_file, self.index_file)
+                    self.data_file.close()
+                    self.index_file.close()
+                    self.data_file = self.index_file = None
+
+class SegmentReader:
+    """通过mmap读取一个段文件"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        # 空文件不能mmap
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self.view = memoryview(self.map) if self.map is not None else memoryview(b'')
+
+    def read(self, offset, size):
+        """返回图片数据的memoryview，不复制"""
+        if offset < 0 or offset + size > len(self.view):
+            raise ValueError(f"超出段文件范围: {self.path} 偏移 {offset} 长度 {size}")
+        return self.view[offset:offset + size]
+
+    def entries(self):
+        """段的索引记录，跳过崩溃时写了一半的记录和数据不完整的记录"""
+        index_path = self.path[:-len(DATA_SUFFIX)] + INDEX_SUFFIX
+        try:
+            f = open(index_path, encoding='utf-8')
+        except OSError:
+            return []
+
+        entries = []
+        with f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry['offset'] + entry['size'] <= len(self.view):
+                    entries.append(entry)
+        return entries
+
+    def close(self):
+        # 释放memoryview后才能关闭mmap
+        self.view.release()
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def segment_paths(save_dir):
+    """保存目录下的全部段文件，按文件名（即创建时间）排序"""
+    directory = os.path.join(save_dir, SEGMENT_DIR)
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+    return [os.path.join(directory, name) for name in sorted(names)
+            if name.startswith("seg_") and name.endswith(DATA_SUFFIX)]
+
+def matches(entry, device_id=None, start=None, end=None):
+    """索引记录是否属于指定设备和保存时间范围[start, end)"""
+    return ((device_id is None or entry['device_id'] == device_id) and
+            (start is None or entry['timestamp'] >= start) and
+            (end is None or entry['timestamp'] < end))
+
+def iter_entries(save_dir, device_id=None, start=None, end=None):
+    """遍历段索引，按设备和保存时间过滤，产生(段文件路径, 索引记录)"""
+    for path in segment_paths(save_dir):
+        with SegmentReader(path) as reader:
+            entries = reader.entries()
+        for entry in entries:
+            if matches(entry, device_id, start, end):
+                yield path, entry
+
+def read_location(value):
+    """按位置读取图片，返回bytes"""
+    parsed = parse_location(value)
+    if parsed is None:
+        raise ValueError(f"不是段文件位置: {value}")
+    path, offset, size = parsed
+    with SegmentReader(path) as reader:
+        return bytes(reader.read(offset, size))
+
+def export_filename(entry):
+    """导出的文件名，与逐文件存储的命名一致，可被image_index.py重建索引"""
+    prefix = "image" if entry['kind'] == "image" else "partial"
+    saved = datetime.fromtimestamp(entry['timestamp']).strftime("%Y%m%d_%H%M%S")
+    return f"{prefix}_{safe_name(entry['image_id'])}_{saved}.jpg"
+
+def export_images(save_dir, output_dir, device_id=None, start=None, end=None):
+    """把时间范围内的图片导出为单独的JPEG文件，返回导出的图片数"""
+    os.makedirs(output_dir, exist_ok=True)
+    count = 0
+    for path in segment_paths(save_dir):
+        with SegmentReader(path) as reader:
+            for entry in reader.entries():
+                if not matches(entry, device_id, start, end):
+                    continue
+                with open(os.path.join(output_dir, export_filename(entry)), 'wb') as f:
+                    f.write(reader.read(entry['offset'], entry['size']))
+                count += 1
+    return count
+
+def find_image(save_dir, image_id):
+    """查找图片最后一次保存的位置，返回(段文件路径, 索引记录)，不存在时返回None"""
+    found = None
+    for path, entry in iter_entries(save_dir):
+        if entry['image_id'] == image_id:
+            found = (path, entry)
+    return found
+
+def main():
+    """命令行列出、提取和导出段文件中的图片"""
+    from windows_receiver import SAVE_DIR
+    from image_index import parse_time
+
+    parser = argparse.ArgumentParser(description="段文件图片存储工具")
+    parser.add_argument("--dir", default=SAVE_DIR, help="图片保存目录")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    listing = commands.add_parser("list", help="列出段文件中的图片")
+    export = commands.add_parser("export", help="把时间范围内的图片导出为JPEG文件")
+    for command in (listing, export):
+        command.add_argument("--device", help="设备ID")
+        command.add_argument("--since", type=parse_time, help="开始时间（含），时间戳或ISO格式")
+        command.add_argument("--until", type=parse_time, help="结束时间（不含），时间戳或ISO格式")
+    export.add_argument("-o", "--output", required=True, help="导出目录")
+
+    extract = commands.add_parser("extract", help="提取单张图片")
+    extract.add_argument("image_id", help="图片ID")
+    extract.add_argument("-o", "--output", help="输出文件，默认按图片ID命名")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        for path, entry in iter_entries(args.dir, args.device, args.since, args.until):
+            saved = datetime.fromtimestamp(entry['timestamp']).strftime("%Y-%m-%d %H:%M:%S")
+            print(f"{saved}  {entry['device_id']}  {entry['image_id']}  {entry['size']} 字节  "
+                  f"{entry['kind']}  {location(path, entry['offset'], entry['size'])}")
+    elif args.command == "export":
+        count = export_images(args.dir, args.output, args.device, args.since, args.until)
+        print(f"✅ 已导出 {count} 张图片到 {args.output}")
+    else:
+        found = find_image(args.dir, args.image_id)
+        if found is None:
+            print(f"❌ 未找到图片: {args.image_id}")
+            raise SystemExit(1)
+        path, entry = found
+        output = args.output or export_filename(entry)
+        with SegmentReader(path) as reader:
+            with open(output, 'wb') as f:
+                f.write(reader.read(entry['offset'], entry['size']))
+        print(f"✅ 已提取 {entry['size']} 字节到 {output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+"""多进程分片接收器
+
+调度进程负责MQTT连接，按device_id一致性哈希把消息转发给N个工作进程
+（设备命名空间的主题直接从主题中取device_id，无需查看消息内容），
+每个工作进程运行独立的ImageReceiver状态，绕开单进程GIL对JSON解析、
+校验和base64解码的限制。各工作进程定期上报状态，由调度进程合并，
+每SUMMARY_INTERVAL秒输出一行合并后的汇总日志。
+"""
+import bisect
+import hashlib
+import json
+import logging
+import multiprocessing
+import re
+import threading
+import time
+import queue
+
+import paho.mqtt.client as mqtt
+
+import chunk_protocol
+from windows_receiver import (ImageReceiver, MQTT_BROKER, MQTT_PORT, MQTT_USERNAME,
+                              MQTT_PASSWORD, SAVE_DIR, TIMEOUT_SECONDS, control_topic,
+                              subscribed_topics, topic_device_id, STORE_BACKEND)
+from fleet import Fleet, FLEET_FILE
+from image_store import create_store
+from receiver_log import get_logger, setup_logging, LOG_LEVEL
+
+# 分片配置
+VIRTUAL_NODES = 64  # 每个工作进程在哈希环上的虚拟节点数
+WORKER_QUEUE_SIZE = 10000  # 每个工作进程的消息队列长度
+STATUS_INTERVAL = 1  # 工作进程上报状态的间隔（秒）
+SUMMARY_INTERVAL = 10  # 调度进程输出合并状态汇总的间隔（秒），0为不输出
+
+# 从JSON消息中快速提取device_id，避免在调度进程中完整解析
+DEVICE_ID_PATTERN = re.compile(rb'"device_id"\s*:\s*"([^"]*)"')
+
+class ConsistentHashRing:
+    """一致性哈希环"""
+
+    def __init__(self, nodes, replicas=VIRTUAL_NODES):
+        self.ring = []
+        for node in nodes:
+            for i in range(replicas):
+                self.ring.append((self._hash(f"{node}:{i}"), node))
+        self.ring.sort()
+        self.keys = [h for h, _ in self.ring]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+    def get_node(self, key):
+        """返回key所属的节点"""
+        index = bisect.bisect(self.keys, self._hash(key)) % len(self.keys)
+        return self.ring[index][1]
+
+def peek_device_id(payload):
+    """只提取消息中的device_id"""
+    if chunk_protocol.is_binary_chunk(payload):
+        return chunk_protocol.peek_binary_device_id(payload)
+
+    match = DEVICE_ID_PATTERN.search(payload)
+    if match:
+        return match.group(1).decode('utf-8')
+
+    return json.loads(payload.decode('utf-8')).get('device_id', '')
+
+class ShardImageReceiver(ImageReceiver):
+    """工作进程中的接收器，消息由调度进程转发"""
+
+    def __init__(self, shard_index, outbox, store_backend=STORE_BACKEND, fleet_file=FLEET_FILE):
+        self.shard_index = shard_index
+        self.outbox = outbox
+        super().__init__(store=create_store(store_backend, SAVE_DIR), fleet=Fleet.load(fleet_file))
+
+    def log(self, message, level=logging.INFO):
+        """输出带分片编号的日志"""
+        super().log(f"[分片{self.shard_index}] {message}", level)
+
+    def publish_control(self, device_id, message):
+        """控制消息交给调度进程发送"""
+        self.outbox.put((control_topic(device_id, device_id in self.per_device_topics),
+                         json.dumps(message)))
+
+def shard_worker(shard_index, inbox, status_queue, outbox, log_level=LOG_LEVEL,
+                 store_backend=STORE_BACKEND, fleet_file=FLEET_FILE):
+    """工作进程主循环"""
+    setup_logging(log_level)
+    receiver = ShardImageReceiver(shard_index, outbox, store_backend, fleet_file)
+    receiver.start_workers()
+    next_report = time.time()
+
+    try:
+        while True:
+            try:
+                item = inbox.get(timeout=STATUS_INTERVAL)
+            except queue.Empty:
+                item = ()
+
+            if item is None:
+                break
+            if item:
+                receiver.process_message(*item)
+
+            if time.time() >= next_report:
+                status = receiver.get_status()
+                status.pop('completed_images', None)
+                status_queue.put((shard_index, status))
+                next_report = time.time() + STATUS_INTERVAL
+    except KeyboardInterrupt:
+        pass
+    finally:
+        receiver.running = False
+        receiver.writer_pool.stop()
+        receiver.store.close()
+        receiver.image_index.close()
+        status = receiver.get_status()
+        status.pop('completed_images', None)
+        status_queue.put((shard_index, status))
+
+class ShardedReceiver:
+    """调度进程：接收MQTT消息并按设备分发到工作进程"""
+
+    def __init__(self, workers, log_level=LOG_LEVEL, store_backend=STORE_BACKEND, fleet_file=FLEET_FILE):
+        self.workers = workers
+        self.log_level = log_level
+        self.store_backend = store_backend
+        self.fleet_file = fleet_file
+        self.fleet = Fleet.load(fleet_file)
+        self.ring = ConsistentHashRing(range(workers))
+        self.inboxes = [multiprocessing.Queue(WORKER_QUEUE_SIZE) for _ in range(workers)]
+        self.status_queue = multiprocessing.Queue()
+        self.outbox = multiprocessing.Queue()  # 工作进程发给设备的控制消息
+        self.processes = []
+        self.shard_status = {}
+        self.status_lock = threading.Lock()
+        self.running = False
+        self.logger = get_logger("sharded")
+
+        self.client = mqtt.Client()
+        self.client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+
+    def log(self, message, level=logging.INFO):
+        """输出日志"""
+        self.logger.log(level, message)
+
+    def on_connect(self, client, userdata, flags, rc):
+        """MQTT连接回调"""
+        if rc == 0:
+            self.log("✅ 成功连接到MQTT服务器!")
+            topics = subscribed_topics(self.fleet.subscribed_devices())
+            for topic in topics:
+                client.subscribe(topic)
+            self.log(f"已订阅主题: {', '.join(topics)}")
+        else:
+            self.log(f"❌ MQTT连接失败，错误代码: {rc}", logging.ERROR)
+
+    def on_message(self, client, userdata, msg):
+        """MQTT消息接收回调"""
+        self.dispatch(msg.topic, msg.payload)
+
+    def dispatch(self, topic, payload):
+        """按device_id将消息转发到对应的工作进程"""
+        try:
+            device_id = topic_device_id(topic)
+            if device_id is None:
+                # 旧版本设备共用的主题，从消息中取device_id
+                device_id = peek_device_id(payload)
+            shard = self.ring.get_node(device_id)
+            self.inboxes[shard].put((topic, payload))
+        except Exception as e:
+            self.log(f"❌ 分发消息时出错: {e}", logging.ERROR)
+
+    def start_workers(self):
+        """启动工作进程和状态收集线程"""
+        self.running = True
+        for i in range(self.workers):
+            process = multiprocessing.Process(target=shard_worker, name=f"receiver-shard-{i}",
+                                              args=(i, self.inboxes[i], self.status_queue,
+                                                    self.outbox, self.log_level,
+                                                    self.store_backend, self.fleet_file),
+                                              daemon=True)
+            process.start()
+            self.processes.append(process)
+
+        threading.Thread(target=self.collect_status, daemon=True).start()
+        threading.Thread(target=self.forward_control, daemon=True).start()
+
+    def stop_workers(self):
+        """通知工作进程保存剩余图片后退出"""
+        self.running = False
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for process in self.processes:
+            process.join()
+        self.processes = []
+
+        # 读取工作进程退出前上报的最终状态
+        while True:
+            try:
+                shard_index, status = self.status_queue.get(timeout=0.5)
+            except queue.Empty:
+                break
+            with self.status_lock:
+                self.shard_status[shard_index] = status
+
+    def forward_control(self):
+        """转发工作进程产生的控制消息"""
+        while True:
+            try:
+                topic, payload = self.outbox.get(timeout=STATUS_INTERVAL)
+            except queue.Empty:
+                if not self.running:
+                    return
+                continue
+            self.client.publish(topic, payload)
+
+    def collect_status(self):
+        """收集工作进程上报的状态，定期输出合并后的汇总"""
+        next_summary = time.time() + SUMMARY_INTERVAL
+        last_completed = 0
+        while True:
+            try:
+                shard_index, status = self.status_queue.get(timeout=STATUS_INTERVAL)
+                with self.status_lock:
+                    self.shard_status[shard_index] = status
+            except queue.Empty:
+                if not self.running:
+                    return
+
+            if SUMMARY_INTERVAL and time.time() >= next_summary:
+                last_completed = self.log_summary(last_completed)
+                next_summary = time.time() + SUMMARY_INTERVAL
+
+    def log_summary(self, last_completed):
+        """输出合并后的状态汇总，返回已完成的图片数"""
+        status = self.get_status()
+        completed = status['completed_count']
+        per_shard = ", ".join(f"{index}:{shard.get('pending_count', 0)}/{shard.get('completed_count', 0)}"
+                              for index, shard in sorted(status['shards'].items()))
+        self.log(f"📊 正在接收 {status['pending_count']} 张, 已完成 {completed} 张 "
+                 f"({(completed - last_completed) / SUMMARY_INTERVAL:.1f} 张/秒), "
+                 f"写入队列 {status['writer_queue']}, 各分片(接收中/已完成) {per_shard}")
+        return completed
+
+    def get_status(self):
+        """合并所有分片的状态"""
+        with self.status_lock:
+            shards = dict(self.shard_status)
+
+        pending_images = []
+        for status in shards.values():
+            pending_images.extend(status.get('pending_images', []))
+
+        return {
+            'pending_count': sum(s.get('pending_count', 0) for s in shards.values()),
+            'completed_count': sum(s.get('completed_count', 0) for s in shards.values()),
+            'writer_queue': sum(s.get('writer_queue', 0) for s in shards.values()),
+            'heartbeat_devices': sum(s.get('heartbeat_devices', 0) for s in shards.values()),
+            'pending_images': pending_images,
+            'shards': shards
+        }
+
+    def start(self):
+        """启动分片接收器"""
+        setup_logging(self.log_level)
+        try:
+            self.log("🚀 启动多进程分片接收器...")
+            self.log(f"MQTT服务器: {MQTT_BROKER}:{MQTT_PORT}")
+            self.log(f"工作进程数: {self.workers}")
+            self.log(f"保存目录: {SAVE_DIR}")
+            self.log(f"超时时间: {TIMEOUT_SECONDS} 秒")
+            self.log("=" * 50)
+
+            self.start_workers()
+            self.client.connect(MQTT_BROKER, MQTT_PORT, 60)
+            self.client.loop_forever()
+
+        except KeyboardInterrupt:
+            self.log("\n🛑 用户中断，正在关闭...")
+        except Exception as e:
+            self.log(f"❌ 启动失败: {e}", logging.ERROR)
+        finally:
+            self.client.disconnect()
+            self.stop_workers()
+            status = self.get_status()
+            self.log(f"接收器已关闭，共完成 {status['completed_count']} 张图片")
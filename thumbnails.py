@@ -0,0 +1,213 @@
+"""接收端缩略图
+
+图片保存后生成缩略图，供GUI显示各设备最新一帧。解码在进程池中进行，不占用MQTT回调线程、
+写入线程和Tk主线程；JPEG使用draft模式在解码时直接按1/2、1/4、1/8缩小，比完整解码再缩放快得多。
+缩略图按图片MD5缓存（未计算MD5时按保存位置），内存中保留最近THUMBNAIL_MEMORY_ITEMS张，磁盘上保存在缩略图目录中，
+超过THUMBNAIL_DISK_BYTES时删除最久未使用的文件。
+
+同一设备的图片来得比缩略图生成快时，只为最新的一张生成缩略图。
+需要Pillow，未安装时缩略图功能不可用，其他功能不受影响。
+"""
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from receiver_log import get_logger
+from segment_store import parse_location, read_location
+
+THUMBNAIL_DIR = "thumbnails"  # 缩略图目录，位于图片保存目录下
+THUMBNAIL_SIZE = (160, 120)  # 缩略图最大宽高
+THUMBNAIL_QUALITY = 75  # 缩略图JPEG质量
+THUMBNAIL_WORKERS = 2  # 生成缩略图的进程数
+THUMBNAIL_MEMORY_ITEMS = 256  # 内存中缓存的缩略图数
+THUMBNAIL_DISK_BYTES = 64 * 1024 * 1024  # 磁盘缓存的最大字节数
+
+def available():
+    """是否安装了Pillow"""
+    return Image is not None
+
+def render_thumbnail(source, size=THUMBNAIL_SIZE, quality=THUMBNAIL_QUALITY):
+    """生成缩略图（在工作进程中执行），返回(JPEG数据, PPM数据)
+
+    source为图片文件名、段文件位置或已缓存的缩略图JPEG数据。
+    PPM是未压缩的像素数据，Tk可以直接显示，无需在界面线程中解码。
+    """
+    if isinstance(source, bytes):
+        data = source
+    elif parse_location(source) is not None:
+        data = read_location(source)
+    else:
+        with open(source, 'rb') as f:
+            data = f.read()
+
+    image = Image.open(io.BytesIO(data))
+    # draft只对JPEG有效，解码时按不小于size的最大比例缩小
+    image.draft("RGB", size)
+    image = image.convert("RGB")
+    image.thumbnail(size)
+
+    jpeg = io.BytesIO()
+    image.save(jpeg, "JPEG", quality=quality)
+    ppm = io.BytesIO()
+    image.save(ppm, "PPM")
+    return jpeg.getvalue(), ppm.getvalue()
+
+class ThumbnailCache:
+    """缩略图LRU缓存，内存中保留最近的缩略图，全部缩略图保存在磁盘目录中"""
+
+    def __init__(self, directory, memory_items=THUMBNAIL_MEMORY_ITEMS, disk_bytes=THUMBNAIL_DISK_BYTES):
+        self.directory = directory
+        self.memory_items = memory_items
+        self.disk_bytes = disk_bytes
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()  # MD5 -> JPEG数据
+        self.disk = OrderedDict()  # MD5 -> 文件大小，按最近使用排序
+        self.disk_total = 0
+        os.makedirs(directory, exist_ok=True)
+
+        # 按修改时间恢复磁盘缓存的使用顺序
+        files = []
+        for name in os.listdir(directory):
+            if name.endswith(".jpg"):
+                stat = os.stat(os.path.join(directory, name))
+                files.append((stat.st_mtime, name[:-4], stat.st_size))
+        for _, key, size in sorted(files):
+            self.disk[key] = size
+            self.disk_total += size
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.jpg")
+
+    def get(self, key):
+        """取缩略图JPEG数据，不存在时返回None"""
+        with self.lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+                if key in self.disk:
+                    self.disk.move_to_end(key)
+                return data
+            if key not in self.disk:
+                return None
+            self.disk.move_to_end(key)
+
+        try:
+            with open(self.path(key), 'rb') as f:
+                data = f.read()
+        except OSError:
+            with self.lock:
+                self.disk_total -= self.disk.pop(key, 0)
+            return None
+
+        with self.lock:
+            self.remember(key, data)
+        return data
+
+    def put(self, key, data):
+        """保存缩略图"""
+        with open(self.path(key), 'wb') as f:
+            f.write(data)
+
+        with self.lock:
+            self.remember(key, data)
+            self.disk_total += len(data) - self.disk.pop(key, 0)
+            self.disk[key] = len(data)
+            evicted = []
+            while self.disk_total > self.disk_bytes and len(self.disk) > 1:
+                old, size = self.disk.popitem(last=False)
+                self.disk_total -= size
+                self.memory.pop(old, None)
+                evicted.append(old)
+
+        for old in evicted:
+            try:
+                os.remove(self.path(old))
+            except OSError:
+                pass
+
+    def remember(self, key, data):
+        """加入内存缓存（调用时需持有锁）"""
+        self.memory[key] = data
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+class ThumbnailPipeline:
+    """接收器的事件监听函数，图片保存后在进程池中生成缩略图
+
+    缩略图生成后在进程池的回调线程中调用on_ready(device_id, image_id, PPM数据)，
+    界面需要自行转到界面线程显示。
+    """
+
+    def __init__(self, cache, on_ready, workers=THUMBNAIL_WORKERS):
+        self.cache = cache
+        self.on_ready = on_ready
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.running = set()  # 正在生成缩略图的设备
+        self.waiting = {}  # 设备ID -> 等待生成的最新图片
+        self.closed = False
+        self.logger = get_logger("thumbnails")
+
+    def __call__(self, event):
+        if event['type'] != "completed":
+            return
+        # 存储不去重且使用crc32校验时没有MD5，按保存位置生成缓存键
+        key = event['md5'] or hashlib.md5(event['filename'].encode('utf-8')).hexdigest()
+        self.submit(event['device_id'], event['image_id'], event['filename'], key)
+
+    def submit(self, device_id, image_id, filename, md5):
+        """为图片生成缩略图，同一设备正在生成时只保留最新的一张"""
+        with self.lock:
+            if self.closed:
+                return
+            job = (device_id, image_id, filename, md5)
+            if device_id in self.running:
+                self.waiting[device_id] = job
+                return
+            self.running.add(device_id)
+        self.start(job)
+
+    def start(self, job):
+        device_id, image_id, filename, md5 = job
+        cached = self.cache.get(md5)
+        try:
+            # 已有缩略图时只需转换为PPM，传缩略图数据而不是原图
+            future = self.executor.submit(render_thumbnail, cached if cached is not None else filename)
+        except RuntimeError:
+            # 进程池已关闭
+            return
+        future.add_done_callback(lambda f: self.finished(job, cached is None, f))
+
+    def finished(self, job, store, future):
+        device_id, image_id, _, md5 = job
+        try:
+            jpeg, ppm = future.result()
+            if store:
+                self.cache.put(md5, jpeg)
+            self.on_ready(device_id, image_id, ppm)
+        except Exception as e:
+            # 图片损坏时不显示缩略图
+            self.logger.debug(f"⚠️ 无法生成图片 {image_id} 的缩略图: {e}")
+
+        with self.lock:
+            job = self.waiting.pop(device_id, None)
+            if job is None or self.closed:
+                self.running.discard(device_id)
+                return
+        self.start(job)
+
+    def close(self):
+        """停止生成缩略图，等待进程池退出"""
+        with self.lock:
+            self.closed = True
+            self.waiting.clear()
+        self.executor.shutdown(wait=True)
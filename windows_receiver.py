@@ -1,13 +1,23 @@
 import paho.mqtt.client as mqtt
+import argparse
+import logging
 import json
-import base64
 import hashlib
+import heapq
 import os
 import time
-from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import threading
 import queue
+import chunk_protocol
+from chunk_protocol import FORMAT_BINARY, FORMAT_JSON, CHECKSUM_CRC32, CHECKSUM_MD5, CHECKSUMS
+from reassembly import ImageAssembler
+from image_writer import ImageWriterPool
+from image_index import ImageIndex, INDEX_FILENAME
+from image_store import create_store, STORE_BACKENDS
+from fleet import Fleet, FLEET_FILE
+from metrics import ReceiverMetrics, MetricsServer, METRICS_PORT
+from receiver_log import get_logger, setup_logging, LOG_LEVEL, LOG_LEVELS
 
 # MQTT配置
 MQTT_BROKER = "emqx.cidatahub.com"
@@ -15,59 +25,338 @@ MQTT_PORT = 26701
 MQTT_USERNAME = "nolan"
 MQTT_PASSWORD = "opeioe"
 MQTT_TOPIC = "esp32/camera"
+MESSAGE_TOPICS = ("header", "chunk", "completion", "heartbeat", "stats")  # 设备发布消息的子主题
+LEGACY_TOPICS = True  # 同时订阅旧版本设备共用的主题（esp32/camera/header等）
 
 # 接收配置
 SAVE_DIR = "received_images"
-TIMEOUT_SECONDS = 60  # 图片接收超时时间
+STORE_BACKEND = "sharded"  # 存储方式: sharded(按日期/设备分目录并按MD5去重), flat(全部保存在同一目录), segment(追加写入段文件)
+TIMEOUT_SECONDS = 60  # 图片超过此时间没有收到新数据视为超时（秒），每收到一块重新计时
+TIMER_MAX_WAIT = 1  # 超时线程的最长休眠时间（秒）
+SALVAGE_PARTIAL_IMAGES = True  # 超时仍不完整时，保存从第一块开始连续收到的部分
+
+# 落盘配置
+WRITER_THREADS = 2  # 图片校验和保存线程数
+WRITER_QUEUE_SIZE = 32  # 等待保存的图片队列长度
+WRITER_QUEUE_TIMEOUT = 5  # 队列已满时的最长等待时间（秒）
+COMPLETED_HISTORY = 1000  # 内存中保留的最近保存图片数，完整记录见保存目录下的索引
+
+# 重传配置
+NACK_MAX_ROUNDS = 3  # 每张图片最多请求重传的轮数
+NACK_WAIT_SECONDS = 10  # 发出重传请求后等待补发的时间（秒），期间没有收到新数据视为超时
+
+def decode_message(topic, payload):
+    """解析MQTT消息，自动识别二进制块，其余消息按JSON解析"""
+    if topic.endswith("/chunk") and chunk_protocol.is_binary_chunk(payload):
+        return chunk_protocol.unpack_binary_chunk(payload)
+    return json.loads(payload.decode('utf-8'))
+
+def device_topic(device_id, suffix):
+    """设备命名空间下的主题: esp32/camera/{device_id}/{suffix}"""
+    return f"{MQTT_TOPIC}/{device_id}/{suffix}"
+
+def topic_device_id(topic):
+    """设备命名空间主题中的设备ID，旧版本设备共用的主题返回None"""
+    parts = topic[len(MQTT_TOPIC) + 1:].split('/')
+    return parts[0] if len(parts) == 2 else None
+
+def control_topic(device_id, per_device=True):
+    """设备的控制主题，用于发送确认(ack)和重传请求(nack)
+    
+    使用设备命名空间的设备为esp32/camera/{device_id}/control，旧版本设备为esp32/camera/control/{device_id}
+    """
+    if per_device:
+        return device_topic(device_id, "control")
+    return f"{MQTT_TOPIC}/control/{device_id}"
+
+def subscribed_topics(device_ids=None):
+    """接收端订阅的全部主题，device_ids为None时用通配符订阅所有设备，否则只订阅这些设备"""
+    if device_ids is None:
+        topics = [device_topic("+", suffix) for suffix in MESSAGE_TOPICS]
+    else:
+        topics = [device_topic(device_id, suffix) for device_id in device_ids for suffix in MESSAGE_TOPICS]
+    if LEGACY_TOPICS:
+        topics += [f"{MQTT_TOPIC}/{suffix}" for suffix in MESSAGE_TOPICS]
+    return topics
+
+def message_device(topic, data):
+    """消息所属的设备，返回(device_id, 是否使用设备命名空间)
+    
+    设备命名空间主题中的设备ID与消息中的不一致时抛出ValueError，避免设备冒用其他设备的主题
+    """
+    device_id = data.get('device_id', '')
+    topic_device = topic_device_id(topic)
+    if topic_device is not None and topic_device != device_id:
+        raise ValueError(f"主题 {topic} 与消息中的设备ID {device_id} 不符")
+    return device_id, topic_device is not None
+
+def new_pending_image(data, md5=True):
+    """根据图片信息头创建接收任务，返回(image_id, img_data)
+
+    md5为False时（存储不去重）使用crc32校验的图片不计算MD5
+    """
+    # 新版本设备带有image_id，旧版本按时间戳区分图片
+    image_id = f"{data['device_id']}_{data.get('image_id', data['timestamp'])}"
+    
+    # 按图片大小预分配重组缓冲区
+    chunk_format = data.get('format', FORMAT_JSON)
+    checksum = data.get('checksum', CHECKSUM_MD5)
+    try:
+        assembler = ImageAssembler(data['image_size'], data['chunk_size'],
+                                   data['total_chunks'], chunk_format, checksum, md5)
+        # 按声明的校验方式取整张图片的期望校验值
+        expected = data['image_crc32' if checksum == CHECKSUM_CRC32 else 'image_md5']
+    except KeyError as e:
+        raise ValueError(f"图片 {image_id} 信息头缺少字段: {e}")
+    except ValueError as e:
+        raise ValueError(f"图片 {image_id} 信息头无效: {e}")
+    
+    start_time = time.time()
+    return image_id, {
+        'header': data,
+        'assembler': assembler,
+        'total_chunks': data['total_chunks'],
+        'start_time': start_time,
+        'deadline': start_time + TIMEOUT_SECONDS,
+        'nack_rounds': 0,
+        'duplicates': 0,
+        'checksum': checksum,
+        'expected_checksum': expected,
+        'device_id': data['device_id'],
+        'image_id': data.get('image_id'),
+        'format': chunk_format
+    }
+
+def touch_pending_image(img_data, timeout=TIMEOUT_SECONDS):
+    """收到新数据，推后超时时间；重传阶段按重传等待时间计时"""
+    img_data['deadline'] = time.time() + (NACK_WAIT_SECONDS if img_data['nack_rounds'] else timeout)
+
+def verify_chunk(data):
+    """校验数据块，成功返回校验值描述，失败抛出ValueError"""
+    chunk_index = data['chunk_index']
+    chunk_data = data['chunk_data']
+    
+    if 'chunk_crc32' in data:
+        # 二进制块和使用crc32校验的JSON块：验证块的CRC32，JSON块按base64文本计算
+        if data.get('format') != FORMAT_BINARY:
+            chunk_data = chunk_data.encode('utf-8')
+        if chunk_protocol.crc32(chunk_data) != data['chunk_crc32']:
+            raise ValueError(f"块 {chunk_index} CRC32校验失败")
+        return f"CRC32: {data['chunk_crc32']:08x}"
+    
+    # 验证块的MD5
+    chunk_md5 = hashlib.md5(chunk_data.encode('utf-8')).hexdigest()
+    if chunk_md5 != data['chunk_md5']:
+        raise ValueError(f"块 {chunk_index} MD5校验失败")
+    return f"MD5: {chunk_md5[:8]}..."
+
+def build_nack(img_data):
+    """生成重传请求，旧版本设备不支持重传或重传次数用尽时返回None"""
+    if img_data['image_id'] is None or img_data['nack_rounds'] >= NACK_MAX_ROUNDS:
+        return None
+    
+    img_data['nack_rounds'] += 1
+    img_data['deadline'] = time.time() + NACK_WAIT_SECONDS
+    return {
+        "type": "nack",
+        "image_id": img_data['image_id'],
+        "round": img_data['nack_rounds'],
+        "missing": img_data['assembler'].missing_chunks()
+    }
+
+def build_ack(img_data):
+    """生成图片保存成功的确认，旧版本设备返回None
+    
+    确认中列出接收端支持的校验方式，设备据此决定之后的图片是否改用crc32
+    """
+    if img_data['image_id'] is None:
+        return None
+    return {"type": "ack", "image_id": img_data['image_id'], "checksums": list(CHECKSUMS)}
+
+def image_summary(filename, img_data, saved_time):
+    """图片保存后的一行汇总日志"""
+    assembler = img_data['assembler']
+    summary = (f"💾 图片保存成功: {filename} ({assembler.image_size} 字节, {img_data['total_chunks']} 块, "
+               f"用时 {saved_time - img_data['start_time']:.2f} 秒")
+    if img_data['duplicates']:
+        summary += f", 重复 {img_data['duplicates']} 块"
+    if img_data['nack_rounds']:
+        summary += f", 重传 {img_data['nack_rounds']} 轮"
+    if img_data.get('deduplicated'):
+        summary += ", 内容与已保存的图片相同"
+    return summary + ")"
+
+def write_partial_image(image_id, img_data, store):
+    """保存超时图片从第一块开始连续收到的部分，返回(filename, 字节数)，没有可用数据时返回(None, 0)"""
+    assembler = img_data['assembler']
+    size = assembler.contiguous_bytes()
+    if size == 0:
+        return None, 0
+    
+    data = assembler.buffer[:size]
+    # 补上JPEG结束标记，多数看图软件可以显示已收到的上半部分
+    if data[-2:] != b'\xff\xd9':
+        data += b'\xff\xd9'
+    
+    return store.save_partial(image_id, img_data['device_id'], data), size
+
+def verify_image(img_data):
+    """按设备声明的校验方式校验整张图片，返回图片MD5（未计算时为None），失败抛出ValueError
+    
+    校验值在各块到达时已增量计算，这里不再读取图片数据
+    """
+    assembler = img_data['assembler']
+    if img_data['checksum'] == CHECKSUM_CRC32:
+        actual = assembler.image_crc32()
+    else:
+        actual = assembler.image_md5()
+    
+    if actual != img_data['expected_checksum']:
+        raise ValueError(f"图片{img_data['checksum'].upper()}校验失败，"
+                         f"期望: {img_data['expected_checksum']}, 实际: {actual}")
+    return assembler.image_md5()
+
+def write_image(image_id, img_data, store):
+    """校验图片并保存，返回(filename, image_md5, 是否与已保存的图片内容相同)"""
+    # 各块已解码写入连续缓冲区，无需拼接
+    image_binary = img_data['assembler'].buffer
+    image_md5 = verify_image(img_data)
+    
+    # 保存图片
+    filename, deduplicated = store.save(image_id, img_data['device_id'], image_binary, image_md5)
+    return filename, image_md5, deduplicated
 
 class ImageReceiver:
-    def __init__(self):
-        self.client = mqtt.Client()
+    def __init__(self, client=None, save_dir=SAVE_DIR, metrics_port=None,
+                 history_size=COMPLETED_HISTORY, store=None, fleet=None):
+        # 可传入与paho接口兼容的客户端（如进程内代理客户端）用于测试和压测
+        self.client = client if client is not None else mqtt.Client()
         self.client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
         self.client.on_disconnect = self.on_disconnect
         
+        # 日志级别和输出位置由setup_logging配置
+        self.logger = get_logger("receiver")
+        
         # 图片接收状态
         self.pending_images = {}  # 存储正在接收的图片
-        self.completed_images = {}  # 存储已完成的图片
+        self.pending_index = {}  # (device_id, image_id) -> 正在接收的图片，用于快速路由
+        self.completed_images = OrderedDict()  # 最近保存的图片，最多history_size张
+        self.completed_count = 0  # 本次运行保存的图片数
+        self.history_size = history_size
+        self.heartbeats = {}  # device_id -> 最近一次画面无变化的心跳
         self.lock = threading.Lock()
         
+        # 设备清单，决定订阅哪些设备的主题和接收哪些设备的图片
+        self.fleet = fleet if fleet is not None else Fleet.load(FLEET_FILE)
+        self.per_device_topics = set()  # 使用设备命名空间主题的设备，控制消息发到对应的命名空间
+        self.rejected_devices = set()  # 已提示过的被忽略设备
+        
+        # 超时截止时间的最小堆: (截止时间, image_id)，收到新块时只更新img_data['deadline']，
+        # 堆顶到期时再检查，未到期则按新的截止时间放回，每张图片在堆中只有一条有效记录
+        self.deadlines = []
+        self.timer = threading.Condition(self.lock)
+        
         # 创建保存目录
-        if not os.path.exists(SAVE_DIR):
-            os.makedirs(SAVE_DIR)
+        self.save_dir = save_dir
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+        
+        # 图片存储，可传入其他ImageStore实现
+        self.store = store if store is not None else create_store(STORE_BACKEND, save_dir)
+        
+        # 全部已保存图片的索引，按设备和时间查询
+        self.image_index = ImageIndex(os.path.join(save_dir, INDEX_FILENAME))
+        # 去重时查询索引，重启后和其他工作进程保存过的图片也不重复保存
+        self.store.set_digest_lookup(self.image_index.find_md5)
+        
+        # 控制标志
+        self.running = False
+        self.timer_thread = None
+        
+        # 图片校验和保存在线程池中进行，不占用MQTT回调线程
+        self.writer_pool = ImageWriterPool(self.assemble_image, WRITER_THREADS, WRITER_QUEUE_SIZE,
+                                           log=lambda message: self.log(message, logging.ERROR))
+        
+        # 各阶段指标，metrics_port不为None时通过HTTP输出
+        self.metrics = ReceiverMetrics(pending=lambda: len(self.pending_images),
+                                       writer_queue=self.writer_pool.pending)
+        self.device_stats = {}  # device_id -> 最近一次上报的统计
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        
+        # 状态变化的监听函数（如GUI），见add_listener
+        self.listeners = []
+    
+    def log(self, message, level=logging.INFO):
+        """输出日志"""
+        self.logger.log(level, message)
+    
+    def debug(self, message):
+        """输出逐条消息、逐块的详细日志"""
+        self.log(message, logging.DEBUG)
+    
+    def add_listener(self, listener):
+        """注册状态变化的监听函数
+        
+        图片开始接收(started)、收到新块(progress)、保存成功(completed)、失败(failed)时
+        以事件字典调用listener，字典包含type、image_id及各事件的字段。
+        listener在接收线程中调用（可能持有接收器的锁），应尽快返回，不要回调接收器
+        """
+        self.listeners.append(listener)
+    
+    def emit(self, event_type, image_id, **fields):
+        """通知监听函数"""
+        if not self.listeners:
+            return
         
-        # 启动清理线程
-        self.cleanup_thread = threading.Thread(target=self.cleanup_timeout_images, daemon=True)
-        self.cleanup_thread.start()
+        fields['type'] = event_type
+        fields['image_id'] = image_id
+        for listener in self.listeners:
+            try:
+                listener(fields)
+            except Exception as e:
+                self.log(f"❌ 事件监听函数出错: {e}", logging.ERROR)
     
     def on_connect(self, client, userdata, flags, rc):
         """MQTT连接回调"""
         if rc == 0:
-            print("✅ 成功连接到MQTT服务器!")
+            self.log("✅ 成功连接到MQTT服务器!")
             # 订阅相关主题
-            client.subscribe(f"{MQTT_TOPIC}/header")
-            client.subscribe(f"{MQTT_TOPIC}/chunk")
-            client.subscribe(f"{MQTT_TOPIC}/completion")
-            print(f"已订阅主题: {MQTT_TOPIC}/header, {MQTT_TOPIC}/chunk, {MQTT_TOPIC}/completion")
+            topics = subscribed_topics(self.fleet.subscribed_devices())
+            for topic in topics:
+                client.subscribe(topic)
+            self.log(f"已订阅主题: {', '.join(topics)}")
         else:
-            print(f"❌ MQTT连接失败，错误代码: {rc}")
+            self.log(f"❌ MQTT连接失败，错误代码: {rc}", logging.ERROR)
     
     def on_disconnect(self, client, userdata, rc):
         """MQTT断开连接回调"""
         if rc != 0:
-            print(f"⚠️ MQTT连接意外断开，错误代码: {rc}")
+            self.log(f"⚠️ MQTT连接意外断开，错误代码: {rc}", logging.WARNING)
         else:
-            print("MQTT连接已断开")
+            self.log("MQTT连接已断开")
     
     def on_message(self, client, userdata, msg):
         """MQTT消息接收回调"""
+        self.process_message(msg.topic, msg.payload)
+    
+    def process_message(self, topic, payload):
+        """处理一条消息（MQTT回调或分片调度进程转发）"""
         try:
-            topic = msg.topic
-            payload = msg.payload.decode('utf-8')
-            data = json.loads(payload)
+            self.metrics.messages.inc(topic=topic.rsplit('/', 1)[-1])
+            self.metrics.bytes_received.inc(len(payload))
+            data = decode_message(topic, payload)
+            
+            self.debug(f"📨 收到消息: {topic}")
             
-            print(f"📨 收到消息: {topic}")
+            device_id, per_device = message_device(topic, data)
+            if not self.fleet.allowed(device_id):
+                self.reject_device(device_id)
+                return
+            if per_device:
+                self.per_device_topics.add(device_id)
             
             if topic.endswith("/header"):
                 self.handle_header(data)
@@ -75,210 +364,421 @@ class ImageReceiver:
                 self.handle_chunk(data)
             elif topic.endswith("/completion"):
                 self.handle_completion(data)
+            elif topic.endswith("/heartbeat"):
+                self.handle_heartbeat(data)
+            elif topic.endswith("/stats"):
+                self.handle_stats(data)
                 
         except Exception as e:
-            print(f"❌ 处理消息时出错: {e}")
+            self.log(f"❌ 处理消息时出错: {e}", logging.ERROR)
+    
+    def reject_device(self, device_id):
+        """忽略设备清单中禁用或不在清单中的设备，每个设备只提示一次"""
+        self.metrics.messages_rejected.inc(reason="fleet")
+        if device_id not in self.rejected_devices:
+            self.rejected_devices.add(device_id)
+            self.log(f"⚠️ 设备 {device_id} 不在设备清单中或已禁用，忽略其消息", logging.WARNING)
     
     def handle_header(self, data):
         """处理图片信息头"""
+        try:
+            image_id, img_data = new_pending_image(data, self.store.dedup)
+        except ValueError as e:
+            self.log(f"❌ {e}", logging.ERROR)
+            return
+        
         with self.lock:
-            image_id = f"{data['device_id']}_{data['timestamp']}"
-            
             # 检查是否已存在
             if image_id in self.pending_images:
-                print(f"⚠️ 图片 {image_id} 已存在，跳过重复的头信息")
+                self.log(f"⚠️ 图片 {image_id} 已存在，跳过重复的头信息", logging.WARNING)
                 return
             
             # 创建新的图片接收任务
-            self.pending_images[image_id] = {
-                'header': data,
-                'chunks': {},
-                'received_chunks': 0,
-                'total_chunks': data['total_chunks'],
-                'start_time': time.time(),
-                'image_md5': data['image_md5'],
-                'device_id': data['device_id']
-            }
+            self.pending_images[image_id] = img_data
+            self.metrics.images_started.inc()
+            
+            # 建立路由索引；旧版本消息不带image_id，按设备最近一张图片路由
+            self.pending_index[(data['device_id'], data.get('image_id'))] = image_id
+            self.pending_index[(data['device_id'], None)] = image_id
+            self.schedule_timeout(image_id, img_data)
             
-            print(f"📸 开始接收图片: {image_id}")
-            print(f"   总分块数: {data['total_chunks']}")
-            print(f"   图片大小: {data['image_size']} 字节")
-            print(f"   图片MD5: {data['image_md5']}")
+            self.emit("started", image_id, device_id=data['device_id'],
+                      total_chunks=data['total_chunks'], image_size=data['image_size'])
+            self.debug(f"📸 开始接收图片: {image_id} ({img_data['format']}, {data['total_chunks']} 块, "
+                       f"{data['image_size']} 字节, {img_data['checksum'].upper()}: {img_data['expected_checksum']})")
     
     def handle_chunk(self, data):
         """处理图片数据块"""
+        finished = None
+        
         with self.lock:
             # 查找对应的图片
-            image_id = None
-            for img_id, img_data in self.pending_images.items():
-                if img_data['device_id'] == data.get('device_id', ''):
-                    image_id = img_id
-                    break
+            image_id = self.find_pending_image(data)
             
             if image_id is None:
-                print(f"⚠️ 未找到对应的图片头信息，跳过块 {data['chunk_index']}")
+                self.debug(f"⚠️ 未找到对应的图片头信息，跳过块 {data['chunk_index']}")
                 return
             
             img_data = self.pending_images[image_id]
+            assembler = img_data['assembler']
             chunk_index = data['chunk_index']
             
             # 检查块是否已接收
-            if chunk_index in img_data['chunks']:
-                print(f"⚠️ 块 {chunk_index} 已接收，跳过重复")
+            if chunk_index < assembler.total_chunks and assembler.has_chunk(chunk_index):
+                self.metrics.duplicates.inc()
+                img_data['duplicates'] += 1
+                self.debug(f"⚠️ 块 {chunk_index} 已接收，跳过重复")
                 return
             
-            # 验证块的MD5
-            chunk_data = data['chunk_data']
-            chunk_md5 = hashlib.md5(chunk_data.encode('utf-8')).hexdigest()
-            
-            if chunk_md5 != data['chunk_md5']:
-                print(f"❌ 块 {chunk_index} MD5校验失败")
+            try:
+                checksum = verify_chunk(data)
+            except ValueError as e:
+                self.metrics.checksum_failures.inc(kind="chunk")
+                self.log(f"❌ 图片 {image_id} {e}", logging.ERROR)
                 return
             
-            # 保存块数据
-            img_data['chunks'][chunk_index] = chunk_data
-            img_data['received_chunks'] += 1
+            # 直接写入重组缓冲区
+            try:
+                assembler.add_chunk(chunk_index, data['chunk_data'])
+            except ValueError as e:
+                self.log(f"❌ 图片 {image_id} 块 {chunk_index} 写入失败: {e}", logging.ERROR)
+                return
             
-            print(f"✅ 接收块 {chunk_index + 1}/{img_data['total_chunks']} (MD5: {chunk_md5[:8]}...)")
+            touch_pending_image(img_data)
+            self.debug(f"✅ 接收块 {chunk_index + 1}/{img_data['total_chunks']} ({checksum})")
+            self.emit("progress", image_id, received=assembler.received_chunks,
+                      total=assembler.total_chunks)
             
             # 检查是否接收完成
-            if img_data['received_chunks'] == img_data['total_chunks']:
-                print(f"🎉 图片 {image_id} 所有块接收完成!")
-                self.assemble_image(image_id)
+            if assembler.is_complete():
+                self.debug(f"🎉 图片 {image_id} 所有块接收完成!")
+                self.metrics.transfer_seconds.observe(time.time() - img_data['start_time'])
+                finished = (image_id, img_data)
+                self.remove_pending_image(image_id)
+        
+        if finished:
+            self.submit_image(*finished)
     
     def handle_completion(self, data):
         """处理完成信号"""
+        finished = None
+        
         with self.lock:
             # 查找对应的图片
-            image_id = None
-            for img_id, img_data in self.pending_images.items():
-                if img_data['device_id'] == data.get('device_id', ''):
-                    image_id = img_id
-                    break
+            image_id = self.find_pending_image(data)
             
             if image_id is None:
-                print(f"⚠️ 未找到对应的图片，跳过完成信号")
+                self.debug("⚠️ 未找到对应的图片，跳过完成信号")
                 return
             
             img_data = self.pending_images[image_id]
             
             # 检查是否所有块都已接收
-            if img_data['received_chunks'] == img_data['total_chunks']:
-                print(f"✅ 收到完成信号，图片 {image_id} 传输完成")
-                self.assemble_image(image_id)
+            assembler = img_data['assembler']
+            if assembler.is_complete():
+                self.debug(f"✅ 收到完成信号，图片 {image_id} 传输完成")
+                finished = (image_id, img_data)
+                self.remove_pending_image(image_id)
             else:
-                print(f"⚠️ 收到完成信号，但图片 {image_id} 还有 {img_data['total_chunks'] - img_data['received_chunks']} 个块未接收")
+                self.log(f"⚠️ 收到完成信号，但图片 {image_id} 还有 {assembler.total_chunks - assembler.received_chunks} 个块未接收",
+                         logging.WARNING)
+                self.request_retransmission(image_id, img_data)
+        
+        if finished:
+            self.submit_image(*finished)
+    
+    def handle_heartbeat(self, data):
+        """处理画面无变化的心跳，设备未上传图片"""
+        with self.lock:
+            self.heartbeats[data['device_id']] = data
+        self.metrics.heartbeats.inc()
+        self.debug(f"💓 设备 {data['device_id']} 画面无变化 (连续 {data.get('unchanged', 1)} 张)")
+    
+    def handle_stats(self, data):
+        """处理设备定期上报的统计"""
+        with self.lock:
+            self.device_stats[data['device_id']] = data
+        self.metrics.record_device_stats(data)
+    
+    def find_pending_image(self, data):
+        """查找消息对应的正在接收的图片"""
+        return self.pending_index.get((data.get('device_id', ''), data.get('image_id')))
+    
+    def remove_pending_image(self, image_id):
+        """从待处理列表和路由索引中移除图片"""
+        img_data = self.pending_images.pop(image_id)
+        
+        for key in ((img_data['device_id'], img_data['image_id']), (img_data['device_id'], None)):
+            if self.pending_index.get(key) == image_id:
+                del self.pending_index[key]
     
-    def assemble_image(self, image_id):
-        """组装图片"""
+    def publish_control(self, device_id, message):
+        """向设备发送控制消息"""
+        self.client.publish(control_topic(device_id, device_id in self.per_device_topics),
+                            json.dumps(message))
+    
+    def request_retransmission(self, image_id, img_data):
+        """请求设备重传缺失的块，返回是否已发送请求"""
+        nack = build_nack(img_data)
+        if nack is None:
+            return False
+        
+        self.log(f"🔁 请求重传图片 {image_id} 的 {len(nack['missing'])} 个块 (第 {nack['round']} 轮)")
+        self.metrics.nacks.inc()
+        self.publish_control(img_data['device_id'], nack)
+        self.schedule_timeout(image_id, img_data)
+        return True
+    
+    def submit_image(self, image_id, img_data):
+        """将接收完成的图片交给写入线程池"""
+        if not self.writer_pool.submit((image_id, img_data), timeout=WRITER_QUEUE_TIMEOUT):
+            self.metrics.images_failed.inc(reason="queue_full")
+            self.emit("failed", image_id, reason="queue_full")
+            self.log(f"❌ 写入队列已满，丢弃图片 {image_id}", logging.ERROR)
+    
+    def assemble_image(self, job):
+        """校验并保存图片（在写入线程中执行）"""
+        image_id, img_data = job
+        if img_data.get('partial'):
+            self.salvage_image(image_id, img_data)
+            return
+        
         try:
-            img_data = self.pending_images[image_id]
-            
-            # 按顺序拼接所有块
-            chunks = []
-            for i in range(img_data['total_chunks']):
-                if i not in img_data['chunks']:
-                    print(f"❌ 缺少块 {i}，无法组装图片")
-                    return
-                chunks.append(img_data['chunks'][i])
+            write_start = time.time()
+            filename, image_md5, deduplicated = write_image(image_id, img_data, self.store)
+            img_data['deduplicated'] = deduplicated
+            size = img_data['assembler'].image_size
+            saved_time = time.time()
             
-            # 拼接Base64数据
-            image_base64 = ''.join(chunks)
-            
-            # 解码为二进制数据 - 处理ubinascii编码的数据
-            try:
-                # 首先尝试标准base64解码
-                image_binary = base64.b64decode(image_base64)
-            except Exception:
-                # 如果失败，尝试添加padding
-                padding = 4 - (len(image_base64) % 4)
-                if padding != 4:
-                    image_base64 += '=' * padding
-                image_binary = base64.b64decode(image_base64)
-            
-            # 验证图片MD5
-            image_md5 = hashlib.md5(image_binary).hexdigest()
-            if image_md5 != img_data['image_md5']:
-                print(f"❌ 图片MD5校验失败，期望: {img_data['image_md5']}, 实际: {image_md5}")
-                return
-            
-            # 保存图片
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"{SAVE_DIR}/image_{image_id}_{timestamp}.jpg"
+            self.metrics.write_seconds.observe(saved_time - write_start)
+            self.metrics.save_latency_seconds.observe(saved_time - img_data['start_time'])
+            if deduplicated:
+                self.metrics.images_deduplicated.inc()
+            else:
+                self.metrics.bytes_written.inc(size)
+            self.metrics.images_completed.inc()
             
-            with open(filename, 'wb') as f:
-                f.write(image_binary)
+            self.log(image_summary(filename, img_data, saved_time))
+            self.emit("completed", image_id, device_id=img_data['device_id'], filename=filename,
+                      size=size, md5=image_md5, seconds=saved_time - img_data['start_time'])
             
-            print(f"💾 图片保存成功: {filename}")
-            print(f"   文件大小: {len(image_binary)} 字节")
-            print(f"   MD5校验: {image_md5}")
+            # 通知设备图片已保存，设备可以释放缓存
+            ack = build_ack(img_data)
+            if ack:
+                self.publish_control(img_data['device_id'], ack)
             
             # 移动到已完成列表
-            self.completed_images[image_id] = {
+            record = {
                 'filename': filename,
-                'size': len(image_binary),
+                'size': size,
                 'md5': image_md5,
                 'device_id': img_data['device_id'],
-                'timestamp': img_data['header']['timestamp']
+                'timestamp': img_data['header']['timestamp'],
+                'start_time': img_data['start_time'],
+                'saved_time': saved_time
             }
+            with self.lock:
+                self.add_completed(image_id, record)
             
-            # 从待处理列表中移除
-            del self.pending_images[image_id]
-            
+        except ValueError as e:
+            # 图片校验失败
+            self.metrics.checksum_failures.inc(kind="image")
+            self.metrics.images_failed.inc(reason="checksum")
+            self.emit("failed", image_id, reason="checksum")
+            self.log(f"❌ 组装图片时出错: {e}", logging.ERROR)
+        except Exception as e:
+            self.metrics.images_failed.inc(reason="write")
+            self.emit("failed", image_id, reason="write")
+            self.log(f"❌ 组装图片时出错: {e}", logging.ERROR)
+            return
+        
+        # 图片已保存并确认，索引写入失败不影响图片的结果，可用image_index.py rebuild补建
+        try:
+            self.image_index.add(image_id, record)
+        except Exception as e:
+            self.log(f"⚠️ 写入图片索引失败 {image_id}: {e}", logging.WARNING)
+    
+    def add_completed(self, image_id, record):
+        """记录已保存的图片，超出history_size时淘汰最早的记录（调用时需持有锁）"""
+        self.completed_images[image_id] = record
+        self.completed_images.move_to_end(image_id)
+        while len(self.completed_images) > self.history_size:
+            self.completed_images.popitem(last=False)
+        self.completed_count += 1
+    
+    def salvage_image(self, image_id, img_data):
+        """保存超时图片已收到的部分（在写入线程中执行）"""
+        try:
+            filename, size = write_partial_image(image_id, img_data, self.store)
         except Exception as e:
-            print(f"❌ 组装图片时出错: {e}")
+            self.log(f"❌ 保存不完整的图片 {image_id} 时出错: {e}", logging.ERROR)
+            return
+        
+        if filename is not None:
+            self.metrics.images_salvaged.inc()
+            self.log(f"🩹 图片 {image_id} 不完整，已保存前 {size}/{img_data['assembler'].image_size} 字节: {filename}",
+                     logging.WARNING)
     
-    def cleanup_timeout_images(self):
-        """清理超时的图片"""
-        while True:
-            time.sleep(10)  # 每10秒检查一次
+    def schedule_timeout(self, image_id, img_data):
+        """按img_data['deadline']登记超时（调用时需持有锁），早于原有记录时唤醒超时线程"""
+        deadline = img_data['deadline']
+        img_data['scheduled'] = deadline
+        heapq.heappush(self.deadlines, (deadline, image_id))
+        if self.deadlines[0][1] == image_id:
+            self.timer.notify()
+    
+    def expire_images(self, now):
+        """处理到期的图片（调用时需持有锁），返回已放弃的图片列表
+        
+        只检查到期的堆顶记录，开销与到期数量成正比，与正在接收的图片总数无关
+        """
+        expired = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, image_id = heapq.heappop(self.deadlines)
+            img_data = self.pending_images.get(image_id)
+            if img_data is None or img_data['scheduled'] != deadline:
+                # 图片已完成，或已按更早的截止时间重新登记
+                continue
             
-            with self.lock:
-                current_time = time.time()
-                timeout_images = []
-                
-                for image_id, img_data in self.pending_images.items():
-                    if current_time - img_data['start_time'] > TIMEOUT_SECONDS:
-                        timeout_images.append(image_id)
-                
-                for image_id in timeout_images:
-                    print(f"⏰ 图片 {image_id} 接收超时，已清理")
-                    del self.pending_images[image_id]
+            if img_data['deadline'] > now:
+                # 期间收到过新块
+                self.schedule_timeout(image_id, img_data)
+                continue
+            
+            # 超时不再请求重传：设备发送完成信号后只等待几秒（设备端的NACK_WAIT_SECONDS），
+            # 超时时设备已放弃这张图片，重传请求只在收到完成信号时发送
+            self.metrics.images_failed.inc(reason="timeout")
+            self.emit("failed", image_id, reason="timeout")
+            self.remove_pending_image(image_id)
+            expired.append((image_id, img_data))
+        
+        return expired
+    
+    def run_timers(self):
+        """超时线程：休眠到最早的截止时间，处理到期的图片"""
+        while self.running:
+            with self.timer:
+                expired = self.expire_images(time.time())
+                if not expired:
+                    wait = TIMER_MAX_WAIT
+                    if self.deadlines:
+                        wait = max(0, min(wait, self.deadlines[0][0] - time.time()))
+                    self.timer.wait(wait)
+            
+            # 日志和保存部分图片不占用锁
+            for image_id, img_data in expired:
+                assembler = img_data['assembler']
+                self.log(f"⏰ 图片 {image_id} 接收超时 (已收到 {assembler.received_chunks}/{assembler.total_chunks} 块)",
+                         logging.WARNING)
+                if SALVAGE_PARTIAL_IMAGES and assembler.received_chunks:
+                    img_data['partial'] = True
+                    self.writer_pool.submit((image_id, img_data), timeout=0)
     
     def start(self):
         """启动接收器"""
         try:
-            print("🚀 启动图片接收器...")
-            print(f"MQTT服务器: {MQTT_BROKER}:{MQTT_PORT}")
-            print(f"保存目录: {SAVE_DIR}")
-            print(f"超时时间: {TIMEOUT_SECONDS} 秒")
-            print("=" * 50)
+            self.log("🚀 启动图片接收器...")
+            self.log(f"MQTT服务器: {MQTT_BROKER}:{MQTT_PORT}")
+            self.log(f"保存目录: {self.save_dir}")
+            self.log(f"超时时间: {TIMEOUT_SECONDS} 秒")
+            self.log("=" * 50)
             
+            self.start_workers()
             self.client.connect(MQTT_BROKER, MQTT_PORT, 60)
             self.client.loop_forever()
             
         except KeyboardInterrupt:
-            print("\n🛑 用户中断，正在关闭...")
+            self.log("\n🛑 用户中断，正在关闭...")
         except Exception as e:
-            print(f"❌ 启动失败: {e}")
+            self.log(f"❌ 启动失败: {e}", logging.ERROR)
         finally:
+            self.running = False
             self.client.disconnect()
-            print("接收器已关闭")
+            self.writer_pool.stop()
+            self.store.close()
+            self.image_index.close()
+            self.stop_metrics()
+            self.log("接收器已关闭")
+    
+    def start_workers(self):
+        """启动超时线程、写入线程池和指标HTTP服务"""
+        self.running = True
+        if self.metrics_port is not None and self.metrics_server is None:
+            self.metrics_server = MetricsServer(self.metrics.render, self.metrics_port)
+            self.metrics_server.start()
+            self.log(f"📊 指标地址: http://{self.metrics_server.host}:{self.metrics_port}/metrics")
+        self.timer_thread = threading.Thread(target=self.run_timers, name="image-timer", daemon=True)
+        self.timer_thread.start()
+        self.writer_pool.start()
+    
+    def start_background(self):
+        """在后台启动接收器"""
+        self.start_workers()
+        
+        # 启动MQTT客户端
+        self.client.connect(MQTT_BROKER, MQTT_PORT, 60)
+        self.client.loop_start()
+    
+    def stop(self):
+        """停止接收器"""
+        self.running = False
+        
+        if self.client:
+            self.client.loop_stop()
+            self.client.disconnect()
+        
+        # 保存队列中剩余的图片
+        self.writer_pool.stop()
+        self.store.close()
+        self.image_index.close()
+        self.stop_metrics()
+    
+    def stop_metrics(self):
+        """停止指标HTTP服务"""
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
     
     def get_status(self):
         """获取当前状态"""
         with self.lock:
             return {
                 'pending_count': len(self.pending_images),
-                'completed_count': len(self.completed_images),
+                'completed_count': self.completed_count,
+                'writer_queue': self.writer_pool.pending(),
+                'heartbeat_devices': len(self.heartbeats),
                 'pending_images': list(self.pending_images.keys()),
                 'completed_images': list(self.completed_images.keys())
             }
 
 def main():
     """主函数"""
-    receiver = ImageReceiver()
-    receiver.start()
+    parser = argparse.ArgumentParser(description="ESP32-S3 图片接收器")
+    parser.add_argument("--engine", choices=["thread", "asyncio"], default="thread",
+                        help="接收引擎: thread(paho回调线程), asyncio(单线程事件循环，适合大量设备)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="工作进程数，大于1时按device_id分片到多个进程处理")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="Prometheus指标HTTP端口，0为关闭（多进程模式不支持）")
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default=LOG_LEVEL,
+                        help="日志级别，DEBUG输出逐块的详细日志")
+    parser.add_argument("--store", choices=STORE_BACKENDS, default=STORE_BACKEND,
+                        help="存储方式: sharded(按日期/设备分目录并去重), flat(全部保存在同一目录), segment(追加写入段文件)")
+    parser.add_argument("--fleet", default=FLEET_FILE, help="设备清单文件，不存在时接收所有设备")
+    args = parser.parse_args()
+    metrics_port = args.metrics_port or None
+    setup_logging(args.log_level)
+    
+    if args.workers > 1:
+        from sharded_receiver import ShardedReceiver
+        ShardedReceiver(args.workers, args.log_level, args.store, args.fleet).start()
+    elif args.engine == "asyncio":
+        from async_receiver import run_receiver
+        run_receiver(metrics_port, args.store, args.fleet)
+    else:
+        receiver = ImageReceiver(metrics_port=metrics_port, store=create_store(args.store, SAVE_DIR),
+                                 fleet=Fleet.load(args.fleet))
+        receiver.start()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
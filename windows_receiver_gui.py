@@ -1,43 +1,105 @@
-import paho.mqtt.client as mqtt
-import json
-import base64
-import hashlib
 import os
 import time
+import logging
 import threading
+from collections import deque
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox
-from datetime import datetime
 import subprocess
 import webbrowser
 
-# MQTT配置
-MQTT_BROKER = "emqx.cidatahub.com"
-MQTT_PORT = 26701
-MQTT_USERNAME = "nolan"
-MQTT_PASSWORD = "opeioe"
-MQTT_TOPIC = "esp32/camera"
+# MQTT和接收配置与命令行版本共用
+from windows_receiver import ImageReceiver, SAVE_DIR
+from receiver_log import BoundedQueueHandler, get_logger, setup_logging
+from thumbnails import ThumbnailCache, ThumbnailPipeline, THUMBNAIL_DIR
+import thumbnails
 
-# 接收配置
-SAVE_DIR = "received_images"
-TIMEOUT_SECONDS = 60
+# 日志显示配置
+LOG_POLL_MS = 100  # 从日志队列取日志的间隔（毫秒）
+LOG_BATCH_SIZE = 500  # 每次最多取出的日志条数
+LOG_MAX_LINES = 1000  # 日志区域超过此行数时裁剪
+LOG_KEEP_LINES = 500  # 裁剪后保留的行数
+
+# 状态显示配置
+STATUS_POLL_MS = 200  # 应用接收器事件的间隔（毫秒）
+MAX_PROGRESS_ROWS = 8  # 最多同时显示的图片进度条数
+THROUGHPUT_WINDOW = 10  # 吞吐量统计的时间窗口（秒）
+THUMBNAIL_COLUMNS = 4  # 缩略图网格的列数
+
+class EventBuffer:
+    """收集接收器事件，同一张图片的进度事件只保留最新一条，由Tk主循环定时取出"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []  # started/completed/failed，按发生顺序
+        self.progress = {}  # image_id -> 最新的progress事件
+    
+    def __call__(self, event):
+        with self.lock:
+            if event['type'] == "progress":
+                self.progress[event['image_id']] = event
+            else:
+                self.events.append(event)
+    
+    def take(self):
+        """取出并清空已收集的事件，返回(事件列表, 进度字典)"""
+        with self.lock:
+            events, self.events = self.events, []
+            progress, self.progress = self.progress, {}
+        return events, progress
+
+class ThumbnailBuffer:
+    """收集生成好的缩略图，每个设备只保留最新一张，由Tk主循环定时取出"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latest = {}  # device_id -> (image_id, PPM数据)
+    
+    def __call__(self, device_id, image_id, ppm):
+        with self.lock:
+            self.latest[device_id] = (image_id, ppm)
+    
+    def take(self):
+        """取出并清空已收集的缩略图"""
+        with self.lock:
+            latest, self.latest = self.latest, {}
+        return latest
 
 class ImageReceiverGUI:
     def __init__(self, root):
         self.root = root
         self.root.title("ESP32-S3 图片接收器")
-        self.root.geometry("800x600")
+        self.root.geometry("800x780")
         
         # 接收器实例
         self.receiver = None
         self.is_running = False
         
+        # 接收线程的日志先进入队列，由主循环定时批量显示
+        self.log_handler = BoundedQueueHandler()
+        self.log_handler.setFormatter(logging.Formatter("[%(asctime)s] %(message)s", "%H:%M:%S"))
+        setup_logging(handler=self.log_handler)
+        self.logger = get_logger("gui")
+        self.log_lines = 0  # 日志区域当前行数
+        self.log_dropped = 0
+        
+        # 接收器通过事件通知状态变化，界面不读取接收器状态，不占用接收器的锁
+        self.events = EventBuffer()
+        self.images = {}  # 正在接收的图片: image_id -> {'received', 'total', 'row'}
+        self.completed_count = 0
+        self.failed_count = 0
+        self.recent = deque()  # 最近保存的图片: (保存时间, 字节数)
+        
+        # 缩略图在进程池中生成，界面只显示生成好的像素数据
+        self.thumbnail_buffer = ThumbnailBuffer()
+        self.thumbnail_cache = None
+        self.thumbnail_pipeline = None
+        self.tiles = {}  # device_id -> {'image', 'caption', 'photo'}
+        
         # 创建界面
         self.create_widgets()
-        
-        # 启动状态更新线程
-        self.update_thread = threading.Thread(target=self.update_status, daemon=True)
-        self.update_thread.start()
+        self.root.after(LOG_POLL_MS, self.drain_log)
+        self.root.after(STATUS_POLL_MS, self.apply_events)
     
     def create_widgets(self):
         """创建GUI组件"""
@@ -49,7 +111,7 @@ class ImageReceiverGUI:
         self.root.columnconfigure(0, weight=1)
         self.root.rowconfigure(0, weight=1)
         main_frame.columnconfigure(1, weight=1)
-        main_frame.rowconfigure(3, weight=1)
+        main_frame.rowconfigure(5, weight=1)
         
         # 连接状态
         ttk.Label(main_frame, text="连接状态:").grid(row=0, column=0, sticky=tk.W, pady=5)
@@ -69,6 +131,10 @@ class ImageReceiverGUI:
         ttk.Button(button_frame, text="打开图片文件夹", command=self.open_image_folder).pack(side=tk.LEFT, padx=5)
         ttk.Button(button_frame, text="清空日志", command=self.clear_log).pack(side=tk.LEFT, padx=5)
         
+        self.verbose_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(button_frame, text="逐块日志", variable=self.verbose_var,
+                        command=self.toggle_verbose).pack(side=tk.LEFT, padx=5)
+        
         # 统计信息
         stats_frame = ttk.LabelFrame(main_frame, text="统计信息", padding="5")
         stats_frame.grid(row=2, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=5)
@@ -83,40 +149,79 @@ class ImageReceiverGUI:
         self.completed_label = ttk.Label(stats_frame, text="0")
         self.completed_label.grid(row=0, column=3, sticky=tk.W, padx=10)
         
+        ttk.Label(stats_frame, text="失败:").grid(row=1, column=0, sticky=tk.W)
+        self.failed_label = ttk.Label(stats_frame, text="0")
+        self.failed_label.grid(row=1, column=1, sticky=tk.W, padx=10)
+        
+        ttk.Label(stats_frame, text="吞吐量:").grid(row=1, column=2, sticky=tk.W)
+        self.throughput_label = ttk.Label(stats_frame, text="0.0 张/分钟, 0.0 KB/秒")
+        self.throughput_label.grid(row=1, column=3, sticky=tk.W, padx=10)
+        
+        # 各图片的接收进度
+        self.progress_frame = ttk.LabelFrame(main_frame, text="接收进度", padding="5")
+        self.progress_frame.grid(row=3, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=5)
+        self.progress_frame.columnconfigure(1, weight=1)
+        self.more_label = ttk.Label(self.progress_frame, text="")
+        self.more_label.grid(row=MAX_PROGRESS_ROWS, column=0, columnspan=3, sticky=tk.W)
+        self.free_rows = list(range(MAX_PROGRESS_ROWS))
+        
+        # 各设备最新画面的缩略图
+        self.thumbnail_frame = ttk.LabelFrame(main_frame, text="最新画面", padding="5")
+        self.thumbnail_frame.grid(row=4, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=5)
+        self.thumbnail_hint = ttk.Label(self.thumbnail_frame,
+                                        text="等待图片..." if thumbnails.available() else "未安装Pillow，不显示缩略图")
+        self.thumbnail_hint.grid(row=0, column=0, sticky=tk.W)
+        
         # 日志区域
         log_frame = ttk.LabelFrame(main_frame, text="接收日志", padding="5")
-        log_frame.grid(row=3, column=0, columnspan=2, sticky=(tk.W, tk.E, tk.N, tk.S), pady=5)
+        log_frame.grid(row=5, column=0, columnspan=2, sticky=(tk.W, tk.E, tk.N, tk.S), pady=5)
         log_frame.columnconfigure(0, weight=1)
         log_frame.rowconfigure(0, weight=1)
         
-        self.log_text = scrolledtext.ScrolledText(log_frame, height=20, width=80)
+        self.log_text = scrolledtext.ScrolledText(log_frame, height=12, width=80)
         self.log_text.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
         
         # 进度条
         self.progress = ttk.Progressbar(main_frame, mode='indeterminate')
-        self.progress.grid(row=4, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=5)
+        self.progress.grid(row=6, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=5)
     
-    def log_message(self, message):
+    def log_message(self, message, level=logging.INFO):
         """添加日志消息"""
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        log_entry = f"[{timestamp}] {message}\n"
-        
-        # 在主线程中更新GUI
-        self.root.after(0, self._update_log, log_entry)
+        self.logger.log(level, message)
     
-    def _update_log(self, message):
-        """在主线程中更新日志"""
-        self.log_text.insert(tk.END, message)
-        self.log_text.see(tk.END)
-        
-        # 限制日志行数
-        lines = self.log_text.get("1.0", tk.END).split('\n')
-        if len(lines) > 1000:
-            self.log_text.delete("1.0", f"{len(lines)-500}.0")
+    def drain_log(self):
+        """在主线程中批量取出日志并显示"""
+        try:
+            lines = [record.getMessage() for record in self.log_handler.drain(LOG_BATCH_SIZE)]
+            
+            dropped = self.log_handler.dropped
+            if dropped > self.log_dropped:
+                lines.append(f"⚠️ 日志过多，已丢弃 {dropped - self.log_dropped} 条")
+                self.log_dropped = dropped
+            
+            if lines:
+                text = "\n".join(lines) + "\n"
+                self.log_text.insert(tk.END, text)
+                self.log_lines += text.count("\n")
+                
+                # 按行数计数裁剪，无需读取整个日志内容
+                if self.log_lines > LOG_MAX_LINES:
+                    remove = self.log_lines - LOG_KEEP_LINES
+                    self.log_text.delete("1.0", f"{remove + 1}.0")
+                    self.log_lines -= remove
+                
+                self.log_text.see(tk.END)
+        finally:
+            self.root.after(LOG_POLL_MS, self.drain_log)
     
     def clear_log(self):
         """清空日志"""
         self.log_text.delete("1.0", tk.END)
+        self.log_lines = 0
+    
+    def toggle_verbose(self):
+        """切换是否显示逐条消息、逐块的日志"""
+        get_logger().setLevel(logging.DEBUG if self.verbose_var.get() else logging.INFO)
     
     def start_receiver(self):
         """启动接收器"""
@@ -124,7 +229,13 @@ class ImageReceiverGUI:
             return
         
         try:
-            self.receiver = ImageReceiver(self)
+            self.receiver = ImageReceiver()
+            self.receiver.add_listener(self.events)
+            if thumbnails.available():
+                if self.thumbnail_cache is None:
+                    self.thumbnail_cache = ThumbnailCache(os.path.join(SAVE_DIR, THUMBNAIL_DIR))
+                self.thumbnail_pipeline = ThumbnailPipeline(self.thumbnail_cache, self.thumbnail_buffer)
+                self.receiver.add_listener(self.thumbnail_pipeline)
             self.receiver.start_background()
             
             self.is_running = True
@@ -137,7 +248,7 @@ class ImageReceiverGUI:
             
         except Exception as e:
             messagebox.showerror("错误", f"启动接收器失败: {e}")
-            self.log_message(f"❌ 启动失败: {e}")
+            self.log_message(f"❌ 启动失败: {e}", logging.ERROR)
     
     def stop_receiver(self):
         """停止接收器"""
@@ -147,6 +258,9 @@ class ImageReceiverGUI:
         try:
             if self.receiver:
                 self.receiver.stop()
+            if self.thumbnail_pipeline:
+                self.thumbnail_pipeline.close()
+                self.thumbnail_pipeline = None
             
             self.is_running = False
             self.start_button.config(state=tk.NORMAL)
@@ -154,6 +268,12 @@ class ImageReceiverGUI:
             self.status_label.config(text="未连接", foreground="red")
             self.progress.stop()
             
+            # 清除未完成图片的进度条
+            self.events.take()
+            for image_id in list(self.images):
+                self.remove_image(image_id)
+            self.update_counters()
+            
             self.log_message("🛑 接收器已停止")
             
         except Exception as e:
@@ -172,262 +292,118 @@ class ImageReceiverGUI:
         except Exception as e:
             messagebox.showerror("错误", f"无法打开文件夹: {e}")
     
-    def update_status(self):
-        """更新状态信息"""
-        while True:
-            if self.is_running and self.receiver:
-                try:
-                    status = self.receiver.get_status()
-                    
-                    # 在主线程中更新GUI
-                    self.root.after(0, self._update_status_labels, status)
-                except:
-                    pass
-            
-            time.sleep(1)
-    
-    def _update_status_labels(self, status):
-        """在主线程中更新状态标签"""
-        self.pending_label.config(text=str(status['pending_count']))
-        self.completed_label.config(text=str(status['completed_count']))
-
-class ImageReceiver:
-    def __init__(self, gui):
-        self.gui = gui
-        self.client = mqtt.Client()
-        self.client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
-        self.client.on_connect = self.on_connect
-        self.client.on_message = self.on_message
-        self.client.on_disconnect = self.on_disconnect
-        
-        # 图片接收状态
-        self.pending_images = {}
-        self.completed_images = {}
-        self.lock = threading.Lock()
-        
-        # 创建保存目录
-        if not os.path.exists(SAVE_DIR):
-            os.makedirs(SAVE_DIR)
-        
-        # 控制标志
-        self.running = False
-        self.cleanup_thread = None
-    
-    def on_connect(self, client, userdata, flags, rc):
-        """MQTT连接回调"""
-        if rc == 0:
-            self.gui.log_message("✅ 成功连接到MQTT服务器!")
-            client.subscribe(f"{MQTT_TOPIC}/header")
-            client.subscribe(f"{MQTT_TOPIC}/chunk")
-            client.subscribe(f"{MQTT_TOPIC}/completion")
-            self.gui.log_message(f"已订阅主题: {MQTT_TOPIC}/header, {MQTT_TOPIC}/chunk, {MQTT_TOPIC}/completion")
-        else:
-            self.gui.log_message(f"❌ MQTT连接失败，错误代码: {rc}")
-    
-    def on_disconnect(self, client, userdata, rc):
-        """MQTT断开连接回调"""
-        if rc != 0:
-            self.gui.log_message(f"⚠️ MQTT连接意外断开，错误代码: {rc}")
-        else:
-            self.gui.log_message("MQTT连接已断开")
-    
-    def on_message(self, client, userdata, msg):
-        """MQTT消息接收回调"""
+    def apply_events(self):
+        """在主线程中应用接收器事件，更新进度条和统计"""
         try:
-            topic = msg.topic
-            payload = msg.payload.decode('utf-8')
-            data = json.loads(payload)
-            
-            self.gui.log_message(f"📨 收到消息: {topic}")
-            
-            if topic.endswith("/header"):
-                self.handle_header(data)
-            elif topic.endswith("/chunk"):
-                self.handle_chunk(data)
-            elif topic.endswith("/completion"):
-                self.handle_completion(data)
-                
-        except Exception as e:
-            self.gui.log_message(f"❌ 处理消息时出错: {e}")
-    
-    def handle_header(self, data):
-        """处理图片信息头"""
-        with self.lock:
-            image_id = f"{data['device_id']}_{data['timestamp']}"
-            
-            if image_id in self.pending_images:
-                self.gui.log_message(f"⚠️ 图片 {image_id} 已存在，跳过重复的头信息")
-                return
-            
-            self.pending_images[image_id] = {
-                'header': data,
-                'chunks': {},
-                'received_chunks': 0,
-                'total_chunks': data['total_chunks'],
-                'start_time': time.time(),
-                'image_md5': data['image_md5'],
-                'device_id': data['device_id']
-            }
-            
-            self.gui.log_message(f"📸 开始接收图片: {image_id}")
-            self.gui.log_message(f"   总分块数: {data['total_chunks']}")
-            self.gui.log_message(f"   图片大小: {data['image_size']} 字节")
-    
-    def handle_chunk(self, data):
-        """处理图片数据块"""
-        with self.lock:
-            image_id = None
-            for img_id, img_data in self.pending_images.items():
-                if img_data['device_id'] == data.get('device_id', ''):
-                    image_id = img_id
+            events, progress = self.events.take()
+            now = time.time()
+            
+            for event in events:
+                image_id = event['image_id']
+                if event['type'] == "started":
+                    self.add_image(image_id, event['total_chunks'])
+                elif event['type'] == "completed":
+                    self.remove_image(image_id)
+                    self.completed_count += 1
+                    self.recent.append((now, event['size']))
+                elif event['type'] == "failed":
+                    self.remove_image(image_id)
+                    self.failed_count += 1
+            
+            for image_id, event in progress.items():
+                image = self.images.get(image_id)
+                if image is not None:
+                    image['received'] = event['received']
+                    self.show_progress(image_id, image)
+            
+            # 已显示的进度条空出时，补上等待显示的图片
+            for image_id, image in self.images.items():
+                if not self.free_rows:
                     break
+                if image['row'] is None:
+                    self.show_progress(image_id, image)
             
-            if image_id is None:
-                self.gui.log_message(f"⚠️ 未找到对应的图片头信息，跳过块 {data['chunk_index']}")
-                return
-            
-            img_data = self.pending_images[image_id]
-            chunk_index = data['chunk_index']
+            for device_id, (_, ppm) in self.thumbnail_buffer.take().items():
+                self.show_thumbnail(device_id, ppm)
             
-            if chunk_index in img_data['chunks']:
-                self.gui.log_message(f"⚠️ 块 {chunk_index} 已接收，跳过重复")
-                return
+            while self.recent and now - self.recent[0][0] > THROUGHPUT_WINDOW:
+                self.recent.popleft()
             
-            chunk_data = data['chunk_data']
-            chunk_md5 = hashlib.md5(chunk_data.encode('utf-8')).hexdigest()
-            
-            if chunk_md5 != data['chunk_md5']:
-                self.gui.log_message(f"❌ 块 {chunk_index} MD5校验失败")
-                return
-            
-            img_data['chunks'][chunk_index] = chunk_data
-            img_data['received_chunks'] += 1
-            
-            self.gui.log_message(f"✅ 接收块 {chunk_index + 1}/{img_data['total_chunks']}")
-            
-            if img_data['received_chunks'] == img_data['total_chunks']:
-                self.gui.log_message(f"🎉 图片 {image_id} 所有块接收完成!")
-                self.assemble_image(image_id)
+            self.update_counters()
+        finally:
+            self.root.after(STATUS_POLL_MS, self.apply_events)
     
-    def handle_completion(self, data):
-        """处理完成信号"""
-        with self.lock:
-            image_id = None
-            for img_id, img_data in self.pending_images.items():
-                if img_data['device_id'] == data.get('device_id', ''):
-                    image_id = img_id
-                    break
-            
-            if image_id is None:
-                self.gui.log_message(f"⚠️ 未找到对应的图片，跳过完成信号")
-                return
-            
-            img_data = self.pending_images[image_id]
-            
-            if img_data['received_chunks'] == img_data['total_chunks']:
-                self.gui.log_message(f"✅ 收到完成信号，图片 {image_id} 传输完成")
-                self.assemble_image(image_id)
-            else:
-                self.gui.log_message(f"⚠️ 收到完成信号，但图片 {image_id} 还有 {img_data['total_chunks'] - img_data['received_chunks']} 个块未接收")
+    def add_image(self, image_id, total_chunks):
+        """开始接收一张图片"""
+        image = {'received': 0, 'total': total_chunks, 'row': None}
+        self.images[image_id] = image
+        self.show_progress(image_id, image)
     
-    def assemble_image(self, image_id):
-        """组装图片"""
-        try:
-            img_data = self.pending_images[image_id]
-            
-            chunks = []
-            for i in range(img_data['total_chunks']):
-                if i not in img_data['chunks']:
-                    self.gui.log_message(f"❌ 缺少块 {i}，无法组装图片")
-                    return
-                chunks.append(img_data['chunks'][i])
-            
-            image_base64 = ''.join(chunks)
-            
-            # 解码为二进制数据 - 处理ubinascii编码的数据
-            try:
-                # 首先尝试标准base64解码
-                image_binary = base64.b64decode(image_base64)
-            except Exception:
-                # 如果失败，尝试添加padding
-                padding = 4 - (len(image_base64) % 4)
-                if padding != 4:
-                    image_base64 += '=' * padding
-                image_binary = base64.b64decode(image_base64)
-            
-            image_md5 = hashlib.md5(image_binary).hexdigest()
-            if image_md5 != img_data['image_md5']:
-                self.gui.log_message(f"❌ 图片MD5校验失败")
-                return
-            
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"{SAVE_DIR}/image_{image_id}_{timestamp}.jpg"
-            
-            with open(filename, 'wb') as f:
-                f.write(image_binary)
-            
-            self.gui.log_message(f"💾 图片保存成功: {filename}")
-            self.gui.log_message(f"   文件大小: {len(image_binary)} 字节")
-            
-            self.completed_images[image_id] = {
-                'filename': filename,
-                'size': len(image_binary),
-                'md5': image_md5,
-                'device_id': img_data['device_id'],
-                'timestamp': img_data['header']['timestamp']
-            }
-            
-            del self.pending_images[image_id]
-            
-        except Exception as e:
-            self.gui.log_message(f"❌ 组装图片时出错: {e}")
-    
-    def cleanup_timeout_images(self):
-        """清理超时的图片"""
-        while self.running:
-            time.sleep(10)
-            
-            with self.lock:
-                current_time = time.time()
-                timeout_images = []
-                
-                for image_id, img_data in self.pending_images.items():
-                    if current_time - img_data['start_time'] > TIMEOUT_SECONDS:
-                        timeout_images.append(image_id)
-                
-                for image_id in timeout_images:
-                    self.gui.log_message(f"⏰ 图片 {image_id} 接收超时，已清理")
-                    del self.pending_images[image_id]
+    def remove_image(self, image_id):
+        """图片接收结束，释放进度条"""
+        image = self.images.pop(image_id, None)
+        if image is None or image['row'] is None:
+            return
+        for widget in image['widgets']:
+            widget.destroy()
+        self.free_rows.append(image['row'])
+        self.free_rows.sort()
     
-    def start_background(self):
-        """在后台启动接收器"""
-        self.running = True
+    def show_progress(self, image_id, image):
+        """更新图片的进度条，没有进度条时在有空位的情况下创建"""
+        text = f"{image['received']}/{image['total']}"
+        if image['row'] is not None:
+            bar, count = image['widgets'][1:]
+            bar.config(value=image['received'])
+            count.config(text=text)
+            return
         
-        # 启动清理线程
-        self.cleanup_thread = threading.Thread(target=self.cleanup_timeout_images, daemon=True)
-        self.cleanup_thread.start()
+        if not self.free_rows:
+            return
         
-        # 启动MQTT客户端
-        self.client.connect(MQTT_BROKER, MQTT_PORT, 60)
-        self.client.loop_start()
+        row = image['row'] = self.free_rows.pop(0)
+        name = ttk.Label(self.progress_frame, text=image_id)
+        name.grid(row=row, column=0, sticky=tk.W)
+        bar = ttk.Progressbar(self.progress_frame, maximum=max(image['total'], 1),
+                              value=image['received'])
+        bar.grid(row=row, column=1, sticky=(tk.W, tk.E), padx=10)
+        count = ttk.Label(self.progress_frame, text=text)
+        count.grid(row=row, column=2, sticky=tk.E)
+        image['widgets'] = (name, bar, count)
     
-    def stop(self):
-        """停止接收器"""
-        self.running = False
+    def show_thumbnail(self, device_id, ppm):
+        """显示设备的最新缩略图，新设备在网格中新增一格"""
+        # PPM为未压缩的像素数据，Tk无需解码
+        photo = tk.PhotoImage(data=ppm, format="PPM")
+        tile = self.tiles.get(device_id)
+        if tile is None:
+            self.thumbnail_hint.grid_remove()
+            index = len(self.tiles)
+            frame = ttk.Frame(self.thumbnail_frame)
+            frame.grid(row=index // THUMBNAIL_COLUMNS, column=index % THUMBNAIL_COLUMNS, padx=5, pady=5)
+            image = ttk.Label(frame)
+            image.pack()
+            caption = ttk.Label(frame)
+            caption.pack()
+            tile = self.tiles[device_id] = {'image': image, 'caption': caption}
         
-        if self.client:
-            self.client.loop_stop()
-            self.client.disconnect()
+        tile['image'].config(image=photo)
+        tile['caption'].config(text=f"{device_id}  {time.strftime('%H:%M:%S')}")
+        # 保留引用，否则图片会被回收
+        tile['photo'] = photo
     
-    def get_status(self):
-        """获取当前状态"""
-        with self.lock:
-            return {
-                'pending_count': len(self.pending_images),
-                'completed_count': len(self.completed_images),
-                'pending_images': list(self.pending_images.keys()),
-                'completed_images': list(self.completed_images.keys())
-            }
+    def update_counters(self):
+        """更新统计标签"""
+        self.pending_label.config(text=str(len(self.images)))
+        self.completed_label.config(text=str(self.completed_count))
+        self.failed_label.config(text=str(self.failed_count))
+        
+        images_per_minute = len(self.recent) * 60 / THROUGHPUT_WINDOW
+        kb_per_second = sum(size for _, size in self.recent) / 1024 / THROUGHPUT_WINDOW
+        self.throughput_label.config(text=f"{images_per_minute:.1f} 张/分钟, {kb_per_second:.1f} KB/秒")
+        
+        hidden = len(self.images) - (MAX_PROGRESS_ROWS - len(self.free_rows))
+        self.more_label.config(text=f"另有 {hidden} 张图片正在接收" if hidden > 0 else "")
 
 def main():
     """主函数"""